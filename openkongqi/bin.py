@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import argparse
+from datetime import datetime
 import distutils.spawn
+import json
 import os
 import sys
 
@@ -47,6 +49,131 @@ def okq_init():
     openkongqi.conf.recsdb.db_init()
 
 
+def okq_migrate():
+    parser = argparse.ArgumentParser(
+        description="upgrade the records database (tables and indexes)")
+    parser.add_argument('--okqconf', dest='confmod', action='store',
+                        type=str, help='path to a configuration file')
+    args = parser.parse_args()
+
+    load_confmod(parser, args.confmod)
+
+    # run magic configuration after environment variable is set
+    import openkongqi.conf
+    created = openkongqi.conf.recsdb.db_migrate()
+    for name in created:
+        print("created index {}".format(name))
+    if not created:
+        print("database is up to date")
+
+
+def parse_datetime(value):
+    """Parse a UTC date (``2016-07-13``) or datetime
+    (``2016-07-13T02:00:00``) argument.
+    """
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: {}".format(value))
+
+
+def okq_export():
+    parser = argparse.ArgumentParser(
+        description="export records to Parquet or Arrow, partitioned by "
+        "station and month")
+    parser.add_argument('--okqconf', dest='confmod', action='store',
+                        type=str, help='path to a configuration file')
+    parser.add_argument('--start', type=parse_datetime, required=True,
+                        help='UTC start date (YYYY-MM-DD[THH:MM:SS])')
+    parser.add_argument('--end', type=parse_datetime, required=True,
+                        help='UTC end date (YYYY-MM-DD[THH:MM:SS])')
+    parser.add_argument('--fields', type=lambda v: v.split(','),
+                        help='comma separated list of fields')
+    parser.add_argument('--format', dest='fmt', default='parquet',
+                        choices=('parquet', 'arrow'), help='output format')
+    parser.add_argument('--moduuid', help='source module of the records')
+    parser.add_argument('output', help="output directory, or '-' to write "
+                        "an Arrow IPC stream to stdout")
+    parser.add_argument('uuids', nargs='+',
+                        help='station or wildcard region uuids (cn:*)')
+    args = parser.parse_args()
+
+    load_confmod(parser, args.confmod)
+
+    # run magic configuration after environment variable is set
+    import openkongqi.conf
+    # pyarrow is an optional dependency, import only when needed
+    from openkongqi.records import export
+
+    context = {'moduuid': args.moduuid} if args.moduuid else None
+    if args.output == '-':
+        export.export_stream(openkongqi.conf.recsdb, sys.stdout.buffer,
+                             args.uuids, args.start, args.end,
+                             fields=args.fields, context=context)
+    else:
+        written = export.export_dataset(
+            openkongqi.conf.recsdb, args.output, args.uuids, args.start,
+            args.end, fields=args.fields, context=context, fmt=args.fmt)
+        for fpath in written:
+            print(fpath)
+
+
+def iter_record_chunks(files, size):
+    """Read JSON lines records (``{"uuid": ..., "ts": ..., "fields": ...}``,
+    ``ts`` as ``2016-07-13T02:00:00Z``) in chunks of records per uuid.
+    """
+    import pytz
+
+    chunk = {}
+    count = 0
+    for f in files:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            ts = datetime.strptime(data['ts'], '%Y-%m-%dT%H:%M:%SZ')
+            chunk.setdefault(data['uuid'], []).append({
+                'ts': ts.replace(tzinfo=pytz.utc),
+                'fields': data['fields'],
+            })
+            count += 1
+            if count >= size:
+                yield chunk
+                chunk = {}
+                count = 0
+    if chunk:
+        yield chunk
+
+
+def okq_load():
+    parser = argparse.ArgumentParser(
+        description="bulk load records from JSON lines files, e.g. to "
+        "backfill history (COPY on PostgreSQL)")
+    parser.add_argument('--okqconf', dest='confmod', action='store',
+                        type=str, help='path to a configuration file')
+    parser.add_argument('--moduuid', help='source module of the records')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=500000, help='records loaded at once')
+    parser.add_argument('files', nargs='*', type=argparse.FileType('r'),
+                        default=[sys.stdin],
+                        help="JSON lines files, stdin by default")
+    args = parser.parse_args()
+
+    load_confmod(parser, args.confmod)
+
+    # run magic configuration after environment variable is set
+    import openkongqi.conf
+
+    context = {'moduuid': args.moduuid} if args.moduuid else None
+    for records in iter_record_chunks(args.files, args.chunk_size):
+        openkongqi.conf.recsdb.bulk_load(records, context=context)
+        print("loaded {} records".format(
+            sum(len(r) for r in records.values())))
+
+
 def okq_server():
     # import here so we can fix the sys.path when running the script directly
     from openkongqi.exceptions import OpenKongqiError
@@ -16,12 +16,70 @@ class BaseCacheWrapper(object):
         """
         raise NotImplementedError
 
-    def set(self, key, value):
+    def set(self, key, value, ttl=None):
+        """Set the value of ``key``, expiring after ``ttl`` seconds if set.
+
+        .. warning:: This method has to be overwritten
+        """
         raise NotImplementedError
 
     def get(self, key):
         raise NotImplementedError
 
+    def get_many(self, keys):
+        """Get the values of several keys at once.
+
+        This generic implementation gets the keys one at a time, the
+        wrappers should get them in a single round trip.
+
+        :param keys: keys to get
+        :type keys: list of str
+        :returns: list - values in the order of ``keys``, ``None`` for the
+            missing ones
+        """
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, ttl=None):
+        """Set several keys at once, expiring after ``ttl`` seconds if set.
+
+        This generic implementation sets the keys one at a time, the
+        wrappers should set them in a single round trip.
+
+        :param mapping: values per key
+        :type mapping: dict
+        """
+        for key, value in mapping.items():
+            self.set(key, value, ttl=ttl)
+
+    def incr(self, key):
+        """Atomically increment the integer value of ``key`` (0 if unset).
+
+        .. warning:: This method has to be overwritten
+
+        :returns: int - the incremented value
+        """
+        raise NotImplementedError
+
+    def take_token(self, key, rate, capacity):
+        """Take a token from the bucket stored at ``key``.
+
+        The bucket holds up to ``capacity`` tokens and is refilled at ``rate``
+        tokens per second. A token is always taken: when the bucket is empty
+        the token is borrowed from the future and the caller has to wait for
+        it.
+
+        .. warning:: This method has to be overwritten
+
+        :param key: bucket key
+        :type key: str
+        :param rate: refill rate in tokens per second
+        :type rate: float
+        :param capacity: maximum number of tokens (burst size)
+        :type capacity: int
+        :returns: float - how long to wait in seconds before using the token
+        """
+        raise NotImplementedError
+
 
 def create_cachedb(settings):
     mod = load_backend(settings['ENGINE'])
@@ -9,6 +9,30 @@ _HOST = 'localhost'
 _PORT = '6379'
 _DB_ID = 0
 
+# token bucket as a hash of the available tokens and their last update time,
+# tokens can go negative to reserve them in the order of arrival
+_TAKE_TOKEN_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + (now - ts) * rate) - 1
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
 
 class CacheWrapper(BaseCacheWrapper):
 
@@ -21,8 +45,29 @@ class CacheWrapper(BaseCacheWrapper):
             decode_responses=True
         )
 
-    def set(self, key, value):
-        return self._cnx.set(key, value)
+    def set(self, key, value, ttl=None):
+        return self._cnx.set(key, value, ex=ttl)
 
     def get(self, key):
         return self._cnx.get(key)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self._cnx.mget(keys)
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+        pipe = self._cnx.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+
+    def incr(self, key):
+        return self._cnx.incr(key)
+
+    def take_token(self, key, rate, capacity):
+        if not hasattr(self, '_take_token'):
+            self._take_token = self._cnx.register_script(_TAKE_TOKEN_SCRIPT)
+        return float(self._take_token(keys=[key], args=[rate, capacity]))
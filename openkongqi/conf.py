@@ -46,7 +46,20 @@ global_settings = {
             'DB_ID': 0,
         },
     },
+    'ASYNC': {
+        'CONCURRENCY': 100,
+        'LIMIT_PER_HOST': 4,
+    },
     'DEBUG': False,
+    'EXTRACT_WORKERS': 0,
+    'HTTP': {
+        'POOL_CONNECTIONS': 10,
+        'POOL_MAXSIZE': 10,
+        'POOL_BLOCK': False,
+        'RETRY_TOTAL': 3,
+        'RETRY_BACKOFF_FACTOR': 0.3,
+        'RETRY_STATUS_FORCELIST': [413, 429, 500, 502, 503, 504],
+    },
     'SOURCES': {},
     'SOURCES_DIR': os.path.join(here, 'data/sources'),
     'FEEDS': {},
@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 from datetime import datetime
+import hashlib
 import os
-import shutil
 
 from .exceptions import CacheError
 
 
 FILENAME = "{key}-{ts}.txt"
+CHUNK_SIZE = 64 * 1024
 
 
 class FileCache(object):
@@ -42,7 +43,23 @@ class FileCache(object):
                             FILENAME.format(key=key, ts='latest'))
 
     def set(self, key, fsrc, ts=None):
-        # TODO doc
+        """Write content to the cache, chunk by chunk.
+
+        The content is hashed and counted while it is written so it is never
+        held in memory as a whole.
+
+        :param key: cache key
+        :type key: str
+        :param fsrc: content to cache
+        :type fsrc: file-like object
+        :param ts: (optional) timestamp of the content
+        :type ts: datetime.datetime
+        :returns: (fd, size, digest) - the cached file opened for reading at
+            its beginning, its size in bytes and its SHA-256 hex digest
+
+        If reading the content fails, the partial file is removed and the
+        error is raised.
+        """
         filename = self.get_fp(key, ts)
         if not os.path.exists(os.path.dirname(filename)):
             try:
@@ -50,12 +67,29 @@ class FileCache(object):
             except OSError as e:
                 raise CacheError(
                     'cache creation problem ({})'.format(e.strerror))
-        fdst = open(filename, 'wb')
-        shutil.copyfileobj(fsrc, fdst)
+        fdst = open(filename, 'w+b')
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                chunk = fsrc.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                size += len(chunk)
+                fdst.write(chunk)
+        except Exception:
+            # never leave a partial content in the cache
+            fdst.close()
+            os.remove(filename)
+            raise
+        fdst.flush()
+        fdst.seek(0)
         filelink = self.get_latest_fp(key)
         if os.path.lexists(filelink):
             os.remove(filelink)
         os.symlink(os.path.basename(filename), filelink)
+        return fdst, size, hasher.hexdigest()
 
     def get(self, key, ts=None):
         # TODO doc
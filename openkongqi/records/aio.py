@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous records API.
+
+:class:`AsyncRecordsWrapper` runs the statements of a SQLAlchemy records
+wrapper on an engine of SQLAlchemy's asyncio extension, so database I/O
+doesn't block the event loop. The synchronous wrapper is kept for the rest
+of the API and shares the rows, statements and options. Cache database
+calls run in the default executor of the loop.
+
+The asyncio driver is configured with the ``ASYNC_DRIVER`` option of the
+records database settings, defaults to ``aiosqlite``, ``asyncpg`` or
+``aiomysql`` depending on the database.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import asyncio
+import functools
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from ..utils import load_backend
+from .sqlalch import to_utc
+
+#: default asyncio driver per dialect
+ASYNC_DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+}
+
+
+class AsyncRecordsWrapper(object):
+    """Asynchronous counterpart of a SQLAlchemy records wrapper.
+
+    :param recsdb: synchronous records wrapper
+    :type recsdb: openkongqi.records.sqlalch.SQLAlchemyRecordsWrapper
+    :param settings: records database settings
+    :type settings: dict
+    """
+
+    def __init__(self, recsdb, settings):
+        self._recsdb = recsdb
+        url = recsdb.get_engine().url
+        driver = settings.get('ASYNC_DRIVER',
+                              ASYNC_DRIVERS.get(url.get_backend_name()))
+        url = url.set(drivername="{}+{}".format(url.get_backend_name(),
+                                                driver))
+        options = recsdb.get_engine_options(settings)
+        # the asyncio extension picks its own pool class
+        options.pop('poolclass', None)
+        self._engine = create_async_engine(url, **options)
+        recsdb.configure_engine(self._engine.sync_engine, settings)
+
+    def get_engine(self):
+        return self._engine
+
+    async def dispose(self):
+        """Close the connections of the engine."""
+        await self._engine.dispose()
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    async def get_latest(self, uuid, context=None):
+        """Asynchronous counterpart of ``get_latest``."""
+        return await self._run_in_executor(self._recsdb.get_latest, uuid,
+                                           context=context)
+
+    async def set_latest(self, uuid, record, context=None):
+        """Asynchronous counterpart of ``set_latest``."""
+        await self._run_in_executor(self._recsdb.set_latest, uuid, record,
+                                    context=context)
+
+    async def write_records(self, records, ignore_check_latest=False,
+                            context=None):
+        """Asynchronous counterpart of ``write_records``.
+
+        Rows are inserted and rollups updated in a single transaction.
+        """
+        rows, latest_records = await self._run_in_executor(
+            self._recsdb.prepare_records, records,
+            ignore_check_latest=ignore_check_latest, context=context)
+        async with self._engine.begin() as conn:
+            await conn.run_sync(self._write_rows, rows)
+        await self._run_in_executor(self._recsdb.invalidate_results,
+                                    {row['uuid'] for row in rows})
+        await self._run_in_executor(self._recsdb.set_latest_many,
+                                    latest_records, context=context)
+
+    def _write_rows(self, conn, rows):
+        self._recsdb.insert_rows(self._recsdb.get_table(), rows, conn=conn)
+        self._recsdb.update_rollups(rows, conn=conn)
+
+    async def get_records(self, uuid, start, end, fields=None, context=None):
+        """Asynchronous counterpart of ``get_records``, an asynchronous
+        generator of records streamed from the database.
+        """
+        recsdb = self._recsdb
+        rec_uuid = recsdb._get_rec_uuid(uuid, context=context)
+        stmt = recsdb.get_records_stmt([rec_uuid], to_utc(start), to_utc(end),
+                                       fields)
+        async with self._engine.connect() as conn:
+            result = await conn.stream(stmt)
+            # rows of a record share their first columns (uuid, ts)
+            key = None
+            rows = []
+            async for row in result:
+                if (row[0], row[1]) != key and rows:
+                    for _, record in recsdb.iter_records(rows, fields):
+                        yield record
+                    rows = []
+                key = (row[0], row[1])
+                rows.append(row)
+            for _, record in recsdb.iter_records(rows, fields):
+                yield record
+
+
+def create_async_recsdb(settings, cache):
+    """Create the asynchronous records wrapper of a SQLAlchemy engine.
+
+    :param settings: records database settings
+    :type settings: dict
+    :param cache: cache database wrapper
+    :rtype: AsyncRecordsWrapper
+    """
+    mod = load_backend(settings['ENGINE'])
+    return AsyncRecordsWrapper(mod.RecordsWrapper(settings, cache), settings)
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+import functools
+import hashlib
 import json
 import pytz
 
-from ..utils import load_backend
+from ..utils import get_uuid, load_backend, SEP, WILDCARD
 
 _CACHE_KEY = 'okq:{moduuid}:{uuid}:latest'
+# result cache keys, per contextualized station uuid
+_GENERATION_KEY = 'okq:results:{rec_uuid}:generation'
+_RESULTS_KEY = 'okq:results:{rec_uuid}:{generation}:{digest}'
+# default result cache settings
+_RESULT_CACHE_TTL = 300
+_RESULT_CACHE_MAX_RECORDS = 10000
+# timestamps of the result cache keep the microseconds
+_RESULTS_TS_FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 
 class BaseRecordsWrapper(object):
@@ -24,6 +34,11 @@ class BaseRecordsWrapper(object):
         # NOTE: can't apply key context here
         # because it hasn't been set when this is initialized
         self._cache_key = settings.get('CACHE_KEY', _CACHE_KEY)
+        result_cache = settings.get('RESULT_CACHE') or {}
+        self._result_cache = bool(result_cache)
+        self._result_cache_ttl = result_cache.get('TTL', _RESULT_CACHE_TTL)
+        self._result_cache_max_records = result_cache.get(
+            'MAX_RECORDS', _RESULT_CACHE_MAX_RECORDS)
 
     def create_cnx(self, settings):
         """Create a connection to the database
@@ -39,6 +54,15 @@ class BaseRecordsWrapper(object):
         """
         raise NotImplementedError
 
+    def db_migrate(self):
+        """Upgrade an existing database (tables, indexes) in place.
+
+        .. warning:: This method has be overwritten
+
+        :returns: list of str - names of the upgraded objects
+        """
+        raise NotImplementedError
+
     def is_duplicate(self, record):
         """Check for duplicated records.
 
@@ -58,6 +82,18 @@ class BaseRecordsWrapper(object):
         """
         raise NotImplementedError
 
+    def bulk_load(self, records, context=None):
+        """Load a large amount of records, e.g. to backfill history.
+
+        Records older than the latest ones are loaded as well, duplicated
+        records are skipped. This generic implementation writes the records
+        with :meth:`write_records`, the wrappers may use a faster path.
+
+        :param records: records per station uuid, as for :meth:`write_records`
+        :type records: dict
+        """
+        self.write_records(records, ignore_check_latest=True, context=context)
+
     def get_records(self, start, end, filters=None, context=None):
         """Returns a list of Records.
 
@@ -70,6 +106,113 @@ class BaseRecordsWrapper(object):
         """
         raise NotImplementedError
 
+    def get_records_many(self, uuids, start, end, fields=None, context=None):
+        """Returns the records of several stations.
+
+        This generic implementation reads the stations one at a time, the
+        wrappers should read them with as few queries as possible.
+
+        :param uuids: station uuids, wildcard region uuids (``cn:*``) are
+            expanded to their stations
+        :type uuids: list of str
+        :param start: the start date (lower boundary)
+        :param end: the end date (upper boundary)
+        :param fields: list of fields to select
+        :type fields: list of str
+        :returns: generator - ``(uuid, record)`` pairs ordered by station
+            and timestamp
+        """
+        for uuid in expand_uuids(uuids):
+            for record in self.get_records(uuid, start, end, fields=fields,
+                                           context=context):
+                yield uuid, record
+
+    def get_aggregates(self, uuid, start, end, resolution, fields=None,
+                       context=None):
+        """Returns the aggregated values of the records per bucket of
+        ``resolution``.
+
+        .. warning:: This method has to be overwritten
+
+        :param uuid: station uuid
+        :param start: the start date (lower boundary)
+        :param end: the end date (upper boundary)
+        :param resolution: length of the buckets (``'hour'``, ``'day'``)
+        :type resolution: str
+        :param fields: list of fields to aggregate
+        :type fields: list of str
+        :returns: generator - ``{'ts': bucket, 'fields': {key: {'count',
+            'mean', 'min', 'max'}}}`` ordered by bucket
+        """
+        raise NotImplementedError
+
+    def _get_rec_uuid(self, uuid, context=None):
+        """Return contextualized station uuid.
+
+        If there exists context with module name, the module name will simply
+        be appended in the front for inserting into the database.
+        """
+        if context is not None:
+            moduuid = context.get('moduuid')
+            if moduuid:
+                return get_uuid(moduuid, uuid)
+        return uuid
+
+    def invalidate_results(self, rec_uuids):
+        """Invalidate the cached results of stations which got new records.
+
+        The generation of each station is incremented, the results cached for
+        the previous generation are never read again and expire.
+
+        :param rec_uuids: contextualized station uuids
+        :type rec_uuids: iterable of str
+        """
+        if not self._result_cache:
+            return
+        for rec_uuid in rec_uuids:
+            self._cache.incr(_GENERATION_KEY.format(rec_uuid=rec_uuid))
+
+    def _get_results_key(self, rec_uuid, start, end, fields):
+        generation = self._cache.get(
+            _GENERATION_KEY.format(rec_uuid=rec_uuid)) or 0
+        query = json.dumps([
+            dump_results_ts(start),
+            dump_results_ts(end),
+            sorted(fields) if fields is not None else None,
+        ])
+        return _RESULTS_KEY.format(
+            rec_uuid=rec_uuid, generation=generation,
+            digest=hashlib.sha1(query.encode('utf-8')).hexdigest())
+
+    def _get_cached_records(self, get_records, uuid, start, end, fields=None,
+                            context=None):
+        rec_uuid = self._get_rec_uuid(uuid, context=context)
+        # the generation is read before the query, records written meanwhile
+        # make the stored results stale right away
+        key = self._get_results_key(rec_uuid, start, end, fields)
+        cached = self._cache.get(key)
+        if cached is not None:
+            for record in json.loads(cached):
+                yield {
+                    'ts': load_results_ts(record['ts']),
+                    'fields': record['fields'],
+                }
+            return
+        results = []
+        for record in get_records(self, uuid, start, end, fields=fields,
+                                  context=context):
+            if results is not None:
+                results.append({
+                    'ts': dump_results_ts(record['ts']),
+                    'fields': record['fields'],
+                })
+                if len(results) > self._result_cache_max_records:
+                    results = None
+            yield record
+        if results is not None:
+            self._cache.set(key, json.dumps(results),
+                            ttl=self._result_cache_ttl)
+
     def _get_cache_key(self, uuid, context=None):
         ctx_fmt = {u'uuid': uuid}
         if context is not None:
@@ -82,13 +225,21 @@ class BaseRecordsWrapper(object):
         :param uuid: unique id
         :type uuid: str
         """
-        latest_record = {
-            'ts': self._ts_to_string(record['ts']),
-            'fields': record['fields'],
-        }
-        latest_json = json.dumps(latest_record)
         key = self._get_cache_key(uuid=uuid, context=context)
-        self._cache.set(key, latest_json)
+        self._cache.set(key, self._dump_latest(record))
+
+    def set_latest_many(self, records, context=None):
+        """Set several records as the latest entries in cache database, in a
+        single round trip.
+
+        :param records: ``(uuid, record)`` pairs
+        :type records: iterable of tuple
+        """
+        self._cache.set_many({
+            self._get_cache_key(uuid=uuid, context=context):
+                self._dump_latest(record)
+            for uuid, record in records
+        })
 
     def get_latest(self, uuid, context=None):
         """Get latest record entry from cache database.
@@ -99,6 +250,32 @@ class BaseRecordsWrapper(object):
         latest = self._cache.get(
             self._get_cache_key(uuid=uuid, context=context)
         )
+        return self._load_latest(latest)
+
+    def get_latest_many(self, uuids, context=None):
+        """Get the latest record entries of several stations from cache
+        database, in a single round trip.
+
+        :param uuids: unique ids
+        :type uuids: list of str
+        :returns: dict - latest record (or ``None``) per uuid
+        """
+        uuids = list(uuids)
+        values = self._cache.get_many([
+            self._get_cache_key(uuid=uuid, context=context) for uuid in uuids
+        ])
+        return {
+            uuid: self._load_latest(value)
+            for uuid, value in zip(uuids, values)
+        }
+
+    def _dump_latest(self, record):
+        return json.dumps({
+            'ts': self._ts_to_string(record['ts']),
+            'fields': record['fields'],
+        })
+
+    def _load_latest(self, latest):
         if latest is None:
             return None
         record = json.loads(latest)
@@ -139,6 +316,61 @@ class BaseRecordsWrapper(object):
             .replace(tzinfo=pytz.utc)
 
 
+def cache_results(get_records):
+    """Decorate ``get_records`` to cache its results in the cache database
+    when the ``RESULT_CACHE`` setting is enabled.
+
+    Results are invalidated by :meth:`BaseRecordsWrapper.invalidate_results`
+    which has to be called when records are written.
+    """
+    @functools.wraps(get_records)
+    def wrapper(self, uuid, start, end, fields=None, context=None):
+        if not self._result_cache:
+            return get_records(self, uuid, start, end, fields=fields,
+                               context=context)
+        return self._get_cached_records(get_records, uuid, start, end,
+                                        fields=fields, context=context)
+    return wrapper
+
+
+def dump_results_ts(ts):
+    """Serialize a timestamp of the result cache, naive ones are UTC."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc)
+    return ts.strftime(_RESULTS_TS_FMT)
+
+
+def load_results_ts(ts_string):
+    """Deserialize a timestamp serialized by :func:`dump_results_ts`."""
+    return datetime.strptime(ts_string, _RESULTS_TS_FMT) \
+        .replace(tzinfo=pytz.utc)
+
+
+def expand_uuids(uuids):
+    """Expand the wildcard region uuids into the uuids of their stations.
+
+    :param uuids: station or wildcard region uuids
+    :type uuids: list of str
+    :returns: list of str - station uuids, without duplicates
+    """
+    res = []
+    for uuid in uuids:
+        if uuid.endswith(SEP + WILDCARD):
+            # import here, the station maps are loaded once configured
+            from ..stations import get_station_map
+            res.extend(sorted(
+                get_uuid(uuid, station['uuid'])
+                for station in get_station_map(uuid).values()))
+        else:
+            res.append(uuid)
+    seen = set()
+    return [uuid for uuid in res if not (uuid in seen or seen.add(uuid))]
+
+
 def create_recsdb(settings, cache):
     mod = load_backend(settings['ENGINE'])
-    return mod.RecordsWrapper(settings, cache)
+    recsdb = mod.RecordsWrapper(settings, cache)
+    if settings.get('WRITE_BEHIND'):
+        from .buffer import BufferedRecordsWrapper
+        recsdb = BufferedRecordsWrapper(recsdb, settings['WRITE_BEHIND'])
+    return recsdb
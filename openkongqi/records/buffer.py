@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffering of the records.
+
+Records are queued in a local SQLite file and written to the records
+database in large batches, once ``MAX_RECORDS`` records are queued or on the
+first write ``INTERVAL`` seconds after the last flush. The latest record of
+each station is still set in the cache database right away.
+
+The queue is per host, shared by the worker processes of the host, and its
+records are only written by them. Idle queues are flushed by the
+``openkongqi.tasks.flush_records`` entries of the schedule, see
+:func:`openkongqi.sched.get_flush_schedule`.
+
+The queue is durable: records are only removed from it once written, a
+failed flush is retried by the next one. A chunk is claimed by a write
+transaction on the queue while it is written, concurrent flushes never write
+it twice. Records written twice anyway are skipped by the records database.
+
+Enabled by the ``WRITE_BEHIND`` option of the records database settings.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from datetime import datetime
+import json
+import os
+import sqlite3
+import time
+
+import pytz
+
+# default write-behind settings
+_PATH = 'openkongqi-queue.sqlite3'
+_MAX_RECORDS = 5000
+_INTERVAL = 60
+
+_TS_FMT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class BufferedRecordsWrapper(object):
+    """Records wrapper queueing the records written to another wrapper.
+
+    Any other attribute is the one of the wrapped records wrapper.
+
+    :param recsdb: records wrapper the records are flushed to
+    :type recsdb: openkongqi.records.base.BaseRecordsWrapper
+    :param settings: write-behind settings
+    :type settings: dict
+    """
+
+    def __init__(self, recsdb, settings):
+        self._recsdb = recsdb
+        self._path = settings.get('PATH', _PATH)
+        self._max_records = settings.get('MAX_RECORDS', _MAX_RECORDS)
+        self._interval = settings.get('INTERVAL', _INTERVAL)
+        self._queue = None
+        self._pid = None
+        self._last_flush = time.time()
+
+    def __getattr__(self, name):
+        return getattr(self._recsdb, name)
+
+    def get_queue(self):
+        """Return the connection to the queue, one per process."""
+        if self._queue is None or self._pid != os.getpid():
+            self._queue = sqlite3.connect(self._path, timeout=30)
+            self._pid = os.getpid()
+            self._queue.execute("PRAGMA journal_mode=WAL")
+            with self._queue:
+                self._queue.execute(
+                    "CREATE TABLE IF NOT EXISTS queue ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "context TEXT NOT NULL, "
+                    "uuid TEXT NOT NULL, "
+                    "record TEXT NOT NULL)")
+        return self._queue
+
+    def write_records(self, records, ignore_check_latest=False, context=None):
+        """Queue the records and set the latest ones in the cache database.
+
+        The queue is flushed when it is full or after ``INTERVAL`` seconds.
+        """
+        ctx = json.dumps(context, sort_keys=True)
+        rows = []
+        latest_records = []
+        latest_many = self._recsdb.get_latest_many(records.keys(),
+                                                   context=context)
+        for uuid, uuid_records in records.items():
+            latest = latest_many[uuid]
+            if not ignore_check_latest and latest is not None:
+                uuid_records = [r for r in uuid_records
+                                if r['ts'] > latest['ts']]
+            last_record = latest
+            for record in uuid_records:
+                if last_record is None or record['ts'] > last_record['ts']:
+                    last_record = record
+                rows.append((ctx, uuid, dump_record(record)))
+            if last_record is not latest:
+                latest_records.append((uuid, last_record))
+        if rows:
+            queue = self.get_queue()
+            with queue:
+                queue.executemany(
+                    "INSERT INTO queue (context, uuid, record) "
+                    "VALUES (?, ?, ?)", rows)
+        self._recsdb.set_latest_many(latest_records, context=context)
+        if (self.get_size() >= self._max_records or
+                time.time() - self._last_flush >= self._interval):
+            self.flush()
+
+    def get_size(self):
+        """Return the number of queued records."""
+        return self.get_queue().execute(
+            "SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def flush(self):
+        """Write the queued records to the records database.
+
+        Records are read and written in chunks of ``MAX_RECORDS``, each
+        chunk is removed from the queue once written. A chunk is claimed
+        with an immediate transaction on the queue: a concurrent flush waits
+        for it to be written and removed, and records are only queued once
+        it is. Records queued during the flush are left to the next one.
+
+        :returns: int - number of records written
+        """
+        self._last_flush = time.time()
+        queue = self.get_queue()
+        last_id = queue.execute("SELECT MAX(id) FROM queue").fetchone()[0]
+        count = 0
+        while last_id is not None:
+            # the chunk is removed in the transaction claiming it, or left
+            # in the queue if writing it fails
+            with queue:
+                queue.execute("BEGIN IMMEDIATE")
+                rows = queue.execute(
+                    "SELECT id, context, uuid, record FROM queue "
+                    "WHERE id <= ? ORDER BY id LIMIT ?",
+                    (last_id, self._max_records)).fetchall()
+                if not rows:
+                    break
+                batches = {}
+                for _, ctx, uuid, record in rows:
+                    batches.setdefault(ctx, {}).setdefault(uuid, []).append(
+                        load_record(record))
+                for ctx, records in batches.items():
+                    # latest records are already set
+                    self._recsdb.write_records(records,
+                                               ignore_check_latest=True,
+                                               context=json.loads(ctx))
+                queue.execute("DELETE FROM queue WHERE id <= ?",
+                              (rows[-1][0],))
+            count += len(rows)
+        return count
+
+
+def dump_record(record):
+    """Serialize a record to JSON."""
+    ts = record['ts']
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc)
+    return json.dumps({'ts': ts.strftime(_TS_FMT), 'fields': record['fields']})
+
+
+def load_record(data):
+    """Deserialize a record serialized by :func:`dump_record`."""
+    record = json.loads(data)
+    return {
+        'ts': datetime.strptime(record['ts'], _TS_FMT).replace(
+            tzinfo=pytz.utc),
+        'fields': record['fields'],
+    }
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of the records.
+
+Records are streamed from the records database and converted to Arrow
+record batches of at most ``chunk_size`` rows, one column per field, so the
+memory used doesn't depend on the exported range. Batches are written to a
+Parquet or Arrow IPC dataset partitioned by station and month
+(``uuid=<uuid>/month=<YYYY-MM>/part-0.parquet``), or to a single Arrow IPC
+stream.
+
+Requires :mod:`pyarrow` (``pip install openkongqi[export]``).
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .sqlalch import WIDE_FIELDS, WideRecord
+
+# default number of rows per record batch
+_CHUNK_SIZE = 65536
+
+FORMATS = ('parquet', 'arrow')
+
+
+def get_schema(fields):
+    """Return the Arrow schema of the exported records.
+
+    :param fields: exported fields
+    :type fields: list of str
+    :rtype: pyarrow.Schema
+    """
+    return pa.schema(
+        [('uuid', pa.string()), ('ts', pa.timestamp('us', tz='UTC'))] +
+        [(field, pa.float64()) for field in fields])
+
+
+def iter_batches(recsdb, uuids, start, end, fields=None, context=None,
+                 chunk_size=_CHUNK_SIZE):
+    """Stream records as Arrow record batches.
+
+    The rows of SQLAlchemy records wrappers are read as tuples and copied
+    column by column, without building the records. Other wrappers are
+    read with :meth:`get_records_many`.
+
+    A batch never spans two partitions (station and month).
+
+    :param recsdb: records wrapper
+    :param uuids: station or wildcard region uuids
+    :type uuids: list of str
+    :param start: the start date (lower boundary)
+    :param end: the end date (upper boundary)
+    :param fields: exported fields, defaults to the common pollutants
+    :type fields: list of str
+    :param chunk_size: maximum number of rows per batch
+    :type chunk_size: int
+    :returns: generator - ``(uuid, month, batch)`` tuples
+    """
+    if fields is None:
+        fields = list(WIDE_FIELDS)
+    schema = get_schema(fields)
+    batches = _BatchBuilder(schema, chunk_size)
+    if not hasattr(recsdb, 'get_rows_many'):
+        for uuid, record in recsdb.get_records_many(
+                uuids, start, end, fields=fields, context=context):
+            for batch in batches.add(uuid, record['ts']):
+                yield batch
+            for field in fields:
+                batches.set(field, record['fields'].get(field))
+    elif recsdb.get_table() is WideRecord.__table__:
+        # selected columns, see get_records_stmt()
+        wide = [field for field in fields if field in WIDE_FIELDS]
+        extra = [field for field in fields if field not in WIDE_FIELDS]
+        for rec_uuids, rows in recsdb.get_rows_many(
+                uuids, start, end, fields=fields, context=context):
+            for row in rows:
+                for batch in batches.add(rec_uuids[row[0]], row[1]):
+                    yield batch
+                for field, value in zip(wide, row[2:]):
+                    batches.set(field, value)
+                if extra and row[-1]:
+                    for field in extra:
+                        batches.set(field, row[-1].get(field))
+    else:
+        for rec_uuids, rows in recsdb.get_rows_many(
+                uuids, start, end, fields=fields, context=context):
+            # one row per field, rows of a record are contiguous
+            key = None
+            for rec_uuid, ts, field, value in rows:
+                if (rec_uuid, ts) != key:
+                    key = (rec_uuid, ts)
+                    for batch in batches.add(rec_uuids[rec_uuid], ts):
+                        yield batch
+                batches.set(field, value)
+    for batch in batches.flush():
+        yield batch
+
+
+class _BatchBuilder(object):
+    """Columns of the record batch being built."""
+
+    def __init__(self, schema, chunk_size):
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.partition = None
+        self.columns = None
+
+    def add(self, uuid, ts):
+        """Start a row, yielding the current batch when it is complete.
+
+        :returns: generator - ``(uuid, month, batch)`` tuples
+        """
+        key = (uuid, ts.strftime('%Y-%m'))
+        if key != self.partition or len(self.columns['ts']) >= \
+                self.chunk_size:
+            for batch in self.flush():
+                yield batch
+            self.partition = key
+            self.columns = {name: [] for name in self.schema.names}
+        self.columns['uuid'].append(uuid)
+        self.columns['ts'].append(ts)
+        for name in self.schema.names[2:]:
+            self.columns[name].append(None)
+
+    def set(self, field, value):
+        """Set a field of the current row, unknown fields are ignored."""
+        column = self.columns.get(field)
+        if column is not None and field not in ('uuid', 'ts'):
+            column[-1] = value
+
+    def flush(self):
+        if self.columns is not None:
+            arrays = [pa.array(self.columns[f.name], type=f.type)
+                      for f in self.schema]
+            yield self.partition + (
+                pa.RecordBatch.from_arrays(arrays, schema=self.schema), )
+        self.columns = None
+
+
+def export_dataset(recsdb, path, uuids, start, end, fields=None,
+                   context=None, fmt='parquet', chunk_size=_CHUNK_SIZE):
+    """Export records to a dataset partitioned by station and month.
+
+    A single file is open at a time, the records being read ordered by
+    station and timestamp.
+
+    :param path: root directory of the dataset
+    :type path: str
+    :param fmt: ``'parquet'`` or ``'arrow'`` (IPC file format)
+    :type fmt: str
+    :returns: list of str - paths of the written files
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format ({})".format(fmt))
+    written = []
+    writer = None
+    partition = None
+    try:
+        for uuid, month, batch in iter_batches(
+                recsdb, uuids, start, end, fields=fields, context=context,
+                chunk_size=chunk_size):
+            if (uuid, month) != partition:
+                if writer is not None:
+                    writer.close()
+                partition = (uuid, month)
+                dirname = os.path.join(path, 'uuid={}'.format(uuid),
+                                       'month={}'.format(month))
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                fpath = os.path.join(dirname, 'part-0.{}'.format(fmt))
+                if fmt == 'parquet':
+                    writer = pq.ParquetWriter(fpath, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(fpath, batch.schema)
+                written.append(fpath)
+            if fmt == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return written
+
+
+def export_stream(recsdb, sink, uuids, start, end, fields=None,
+                  context=None, chunk_size=_CHUNK_SIZE):
+    """Export records to a single Arrow IPC stream.
+
+    :param sink: writable binary file or path
+    :returns: int - number of exported rows
+    """
+    if fields is None:
+        fields = list(WIDE_FIELDS)
+    count = 0
+    with pa.ipc.new_stream(sink, get_schema(fields)) as writer:
+        for _, _, batch in iter_batches(
+                recsdb, uuids, start, end, fields=fields, context=context,
+                chunk_size=chunk_size):
+            writer.write_batch(batch)
+            count += batch.num_rows
+    return count
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from .sqlalch import SQLAlchemyRecordsWrapper
+from .sqlalch import SQLAlchemyRecordsWrapper, WideRecord
 
+from sqlalchemy import case, func
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.engine.url import URL
 
 _NAME = 'openkongqi'
@@ -26,3 +28,22 @@ class RecordsWrapper(SQLAlchemyRecordsWrapper):
                   port=settings.get('PORT', _PORT),
                   database=settings.get('NAME', _NAME))
         return dsn
+
+    def get_insert_stmt(self, table):
+        if table is not WideRecord.__table__:
+            return table.insert().prefix_with('IGNORE')
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(
+            self.get_merge_values(table, stmt.inserted))
+
+    def get_upsert_stmt(self, table):
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(
+            {column.name: stmt.inserted[column.name]
+             for column in table.columns if not column.primary_key})
+
+    def merge_json(self, existing, new):
+        return case(
+            (existing.is_(None), new),
+            (new.is_(None), existing),
+            else_=func.json_merge_patch(new, existing))
@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
+import csv
+from datetime import datetime
+import io
+import json
+import logging
+import re
 
-from .sqlalch import SQLAlchemyRecordsWrapper
+from .sqlalch import (
+    Base, SQLAlchemyRecordsWrapper, WideRecord, get_bucket, is_number,
+    to_utc)
+from ..exceptions import ConfigError
 
+from sqlalchemy import JSON, case, cast, column, inspect, select, text
+from sqlalchemy import table as table_clause
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 _NAME = 'openkongqi'
 _USERNAME = 'admin'
@@ -10,9 +24,41 @@ _PASSWORD = 'admin'
 _HOST = 'localhost'
 _PORT = '8080'
 _DRIVER = 'psycopg2'
+# default partitioning settings
+_PARTITION = None
+_PARTITION_PREMAKE = 2
+# default number of rows per COPY when bulk loading
+_COPY_SIZE = 100000
+
+PARTITION_INTERVALS = ('day', 'month', 'year')
+
+logger = logging.getLogger(__name__)
 
 
 class RecordsWrapper(SQLAlchemyRecordsWrapper):
+    """PostgreSQL records wrapper.
+
+    With the ``PARTITION`` setting (``'day'``, ``'month'`` or ``'year'``),
+    the records table is range partitioned on the timestamp. Partitions are
+    created by :meth:`db_init` (the current one and ``PARTITION_PREMAKE``
+    ahead) and on the fly when records are written to a missing one. Old
+    partitions are removed with :meth:`detach_partitions` or
+    :meth:`drop_partitions`.
+    """
+
+    def __init__(self, settings, cache, *args, **kwargs):
+        self._partition = settings.get('PARTITION', _PARTITION)
+        if self._partition is True:
+            self._partition = 'month'
+        if self._partition and self._partition not in PARTITION_INTERVALS:
+            raise ConfigError("Unknown partition interval ({})"
+                              .format(self._partition))
+        self._partition_premake = settings.get('PARTITION_PREMAKE',
+                                               _PARTITION_PREMAKE)
+        # lower bounds of the partitions known to exist
+        self._partitions = set()
+        self._copy_size = settings.get('COPY_SIZE', _COPY_SIZE)
+        super(RecordsWrapper, self).__init__(settings, cache, *args, **kwargs)
 
     def create_dsn(self, settings):
         engine = 'postgresql'
@@ -26,3 +72,332 @@ class RecordsWrapper(SQLAlchemyRecordsWrapper):
                   port=settings.get('PORT', _PORT),
                   database=settings.get('NAME', _NAME))
         return dsn
+
+    def get_insert_stmt(self, table):
+        stmt = insert(table)
+        if table is not WideRecord.__table__:
+            return stmt.on_conflict_do_nothing()
+        return stmt.on_conflict_do_update(
+            index_elements=table.primary_key.columns,
+            set_=self.get_merge_values(table, stmt.excluded))
+
+    def get_upsert_stmt(self, table):
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=table.primary_key.columns,
+            set_={column.name: stmt.excluded[column.name]
+                  for column in table.columns if not column.primary_key})
+
+    def merge_json(self, existing, new):
+        # json has no operators, merge as jsonb
+        return case(
+            (existing.is_(None), new),
+            (new.is_(None), existing),
+            else_=cast(cast(new, JSONB).op('||')(cast(existing, JSONB)),
+                       JSON))
+
+    def db_init(self):
+        super(RecordsWrapper, self).db_init()
+        if self._partition:
+            start = partition_bounds(datetime.utcnow(), self._partition)[0]
+            bounds = [start]
+            for _ in range(self._partition_premake):
+                bounds.append(partition_bounds(bounds[-1], self._partition)[1])
+            self.ensure_partitions(bounds)
+
+    def create_tables(self):
+        if not self._partition:
+            return super(RecordsWrapper, self).create_tables()
+        engine = self.get_engine()
+        table = self.get_table()
+        if not inspect(engine).has_table(table.name):
+            ddl = "{} PARTITION BY RANGE (ts)".format(
+                str(CreateTable(table).compile(dialect=engine.dialect))
+                .rstrip())
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+                for index in table.indexes:
+                    index.create(bind=conn)
+        Base.metadata.create_all(
+            bind=engine,
+            tables=[t for t in self.get_tables() if t is not table])
+
+    def get_index_key(self, index):
+        key = super(RecordsWrapper, self).get_index_key(index)
+        include = index.dialect_options['postgresql']['include'] or []
+        return key, [getattr(column, 'name', column) for column in include]
+
+    def get_reflected_index_key(self, index):
+        key = super(RecordsWrapper, self).get_reflected_index_key(index)
+        return key, index.get('include_columns', [])
+
+    def create_index(self, index):
+        """Create an index without locking the writes of its table.
+
+        ``CREATE INDEX CONCURRENTLY`` can't run in a transaction nor on a
+        partitioned table, indexes of the partitioned records table are
+        created in a transaction.
+        """
+        if not self.is_concurrent(index):
+            return super(RecordsWrapper, self).create_index(index)
+        engine = self.get_engine()
+        ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'\g<0> CONCURRENTLY',
+                     str(CreateIndex(index).compile(dialect=engine.dialect)))
+        with engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text(ddl))
+
+    def drop_index(self, index):
+        if not self.is_concurrent(index):
+            return super(RecordsWrapper, self).drop_index(index)
+        with self.get_engine().connect().execution_options(
+                isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}"
+                              .format(index.name)))
+
+    def is_concurrent(self, index):
+        """Return whether ``index`` can be built concurrently."""
+        return not (self._partition and index.table is self.get_table())
+
+    def insert_rows(self, table, rows, conn=None):
+        if self._partition:
+            self.ensure_partitions(
+                {partition_bounds(row['ts'], self._partition)[0]
+                 for row in rows})
+        super(RecordsWrapper, self).insert_rows(table, rows, conn=conn)
+
+    def bulk_load(self, records, context=None):
+        """Load records with ``COPY``.
+
+        Rows are copied in chunks of ``COPY_SIZE`` into a temporary staging
+        table, then merged into the records table with the statement of
+        :meth:`get_insert_stmt`, all in a single transaction.
+
+        ``COPY`` goes through the psycopg2 cursor, with another driver the
+        records are written by the generic implementation.
+
+        :returns: int - number of inserted (or merged) rows, ``None`` with
+            the generic implementation
+        """
+        if self.get_engine().dialect.driver != 'psycopg2':
+            return super(RecordsWrapper, self).bulk_load(records,
+                                                         context=context)
+        table = self.get_table()
+        columns = [column.name for column in table.columns]
+        # fields written per station and hour, for the rollups
+        hours = {}
+        latest_records = {}
+
+        def iter_rows():
+            for uuid, uuid_records in records.items():
+                rec_uuid = self._get_rec_uuid(uuid, context=context)
+                for record in uuid_records:
+                    ts = to_utc(record['ts'])
+                    last = latest_records.get(uuid)
+                    if last is None or ts > to_utc(last['ts']):
+                        latest_records[uuid] = record
+                    hours.setdefault((rec_uuid, get_bucket(ts, 'hour')),
+                                     set()).update(
+                        key for key, value in record['fields'].items()
+                        if is_number(value))
+                    for row in self.get_rows(rec_uuid, ts, record['fields']):
+                        yield row
+
+        # partitions are created by another connection, before the load
+        # transaction locks the records table
+        if self._partition:
+            self.ensure_partitions({
+                partition_bounds(record['ts'], self._partition)[0]
+                for uuid_records in records.values()
+                for record in uuid_records
+            })
+
+        staging = '{}_staging'.format(table.name)
+        with self.get_engine().begin() as conn:
+            cursor = conn.connection.cursor()
+            cursor.execute(
+                "CREATE TEMPORARY TABLE {staging} "
+                "(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+                    staging=staging, table=table.name))
+            copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                staging, ', '.join(columns))
+            for chunk in iter_copy_chunks(iter_rows(), columns,
+                                          self._copy_size):
+                cursor.copy_expert(copy, chunk)
+            cursor.close()
+            # duplicates are skipped, or merged in the wide schema, a row
+            # can only be merged once per statement
+            source = table_clause(staging, *[column(c) for c in columns])
+            rows = select(*source.columns).distinct(
+                *[source.c[c.name] for c in table.primary_key.columns])
+            inserted = conn.execute(
+                self.get_insert_stmt(table).from_select(columns, rows)) \
+                .rowcount
+            # the rollups only need the touched buckets, hours are the
+            # shortest ones
+            self.update_rollup_fields(hours, conn=conn)
+        self.invalidate_results({rec_uuid for rec_uuid, _ in hours})
+        latest_many = self.get_latest_many(latest_records, context=context)
+        self.set_latest_many([
+            (uuid, record) for uuid, record in latest_records.items()
+            if latest_many[uuid] is None or
+            to_utc(record['ts']) > to_utc(latest_many[uuid]['ts'])
+        ], context=context)
+        return inserted
+
+    def ensure_partitions(self, starts):
+        """Create the partitions starting at ``starts`` if they don't exist.
+
+        Partitions are created in their own transaction, they remain when
+        the insertion of the records fails. A partition is only remembered
+        once it is known to exist.
+
+        :param starts: lower bounds of the partitions
+        :type starts: iterable of datetime.datetime
+        """
+        table = self.get_table()
+        for start in sorted(set(starts) - self._partitions):
+            start, end = partition_bounds(start, self._partition)
+            ddl = text(
+                "CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                "FOR VALUES FROM ('{start}') TO ('{end}')".format(
+                    name=partition_name(table.name, start),
+                    table=table.name,
+                    start=start.isoformat(' '),
+                    end=end.isoformat(' ')))
+            try:
+                with self.get_engine().begin() as conn:
+                    conn.execute(ddl)
+            except (IntegrityError, ProgrammingError) as e:
+                # created concurrently by another worker, any other error
+                # is raised
+                if start not in {p[1] for p in self.get_partitions()}:
+                    raise
+                logger.info("partition created concurrently: {}".format(e))
+            self._partitions.add(start)
+
+    def get_partitions(self):
+        """Return the partitions of the records table.
+
+        :returns: list of tuple - ``(name, start, end)`` ordered by start
+        """
+        table = self.get_table()
+        pattern = re.compile(r'^{}_p(\d{{8}})$'.format(table.name))
+        query = text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table")
+        with self.get_engine().connect() as conn:
+            names = [row[0] for row in
+                     conn.execute(query, {'table': table.name})]
+        partitions = []
+        for name in names:
+            match = pattern.match(name)
+            if match is None:
+                continue
+            start = datetime.strptime(match.group(1), '%Y%m%d')
+            partitions.append(
+                (name,) + partition_bounds(start, self._partition))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    def detach_partitions(self, before):
+        """Detach the partitions holding records older than ``before``.
+
+        Detached partitions are regular tables, out of the records table.
+
+        :param before: partitions ending before this date are detached
+        :type before: datetime.datetime
+        :returns: list of str - names of the detached partitions
+        """
+        return self._remove_partitions(
+            before, "ALTER TABLE {table} DETACH PARTITION {name}")
+
+    def drop_partitions(self, before):
+        """Drop the partitions holding records older than ``before``.
+
+        :param before: partitions ending before this date are dropped
+        :type before: datetime.datetime
+        :returns: list of str - names of the dropped partitions
+        """
+        return self._remove_partitions(before, "DROP TABLE {name}")
+
+    def _remove_partitions(self, before, ddl):
+        before = to_utc(before).replace(tzinfo=None)
+        table = self.get_table()
+        removed = []
+        with self.get_engine().begin() as conn:
+            for name, start, end in self.get_partitions():
+                if end > before:
+                    break
+                conn.execute(text(ddl.format(table=table.name, name=name)))
+                self._partitions.discard(start)
+                removed.append(name)
+        return removed
+
+
+def iter_copy_chunks(rows, columns, size):
+    """Serialize rows to CSV chunks for ``COPY``.
+
+    :param rows: rows as dicts of column values
+    :type rows: iterable of dict
+    :param columns: copied columns
+    :type columns: list of str
+    :param size: maximum number of rows per chunk
+    :type size: int
+    :returns: generator - chunks as text files
+    """
+    chunk = None
+    for row in rows:
+        if chunk is None:
+            chunk = io.StringIO()
+            writer = csv.writer(chunk)
+            count = 0
+        values = []
+        for name in columns:
+            value = row.get(name)
+            if isinstance(value, dict):
+                value = json.dumps(value)
+            elif isinstance(value, datetime):
+                value = to_utc(value).replace(tzinfo=None).isoformat(' ')
+            values.append(value)
+        writer.writerow(values)
+        count += 1
+        if count >= size:
+            chunk.seek(0)
+            yield chunk
+            chunk = None
+    if chunk is not None:
+        chunk.seek(0)
+        yield chunk
+
+
+def partition_bounds(ts, interval):
+    """Return the bounds of the partition holding ``ts``.
+
+    :param ts: UTC timestamp
+    :type ts: datetime.datetime
+    :param interval: ``'day'``, ``'month'`` or ``'year'``
+    :type interval: str
+    :returns: tuple - naive ``(start, end)``, end excluded
+    """
+    if ts.tzinfo is not None:
+        ts = to_utc(ts).replace(tzinfo=None)
+    if interval == 'day':
+        start = datetime(ts.year, ts.month, ts.day)
+        end = datetime.fromordinal(start.toordinal() + 1)
+    elif interval == 'month':
+        start = datetime(ts.year, ts.month, 1)
+        if ts.month == 12:
+            end = datetime(ts.year + 1, 1, 1)
+        else:
+            end = datetime(ts.year, ts.month + 1, 1)
+    else:
+        start = datetime(ts.year, 1, 1)
+        end = datetime(ts.year + 1, 1, 1)
+    return start, end
+
+
+def partition_name(table, start):
+    """Return the name of the partition of ``table`` starting at ``start``."""
+    return "{}_p{}".format(table, start.strftime('%Y%m%d'))
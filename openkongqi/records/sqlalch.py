@@ -1,23 +1,70 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 from copy import copy
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 import pytz
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, String, DateTime, Float
+from sqlalchemy import create_engine, func, inspect, select
+from sqlalchemy import Column, String, DateTime, Float, Index, Integer, JSON
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from .base import BaseRecordsWrapper
-from ..utils import get_uuid
+from .base import BaseRecordsWrapper, cache_results, expand_uuids
+from ..exceptions import ConfigError
 
 Base = declarative_base()
 
+#: entity-attribute-value schema, one row per timestamp, station and field
+SCHEMA_EAV = 'eav'
+#: wide schema, one row per timestamp and station, one column per field
+SCHEMA_WIDE = 'wide'
+
+#: fields having their own column in the wide schema, other fields are
+#: stored in the JSON ``extra`` column
+WIDE_FIELDS = ('pm25', 'pm10', 'co', 'no2', 'o3_1h', 'o3_8h', 'so2')
+
+#: resolutions of the rollups, as the length of their buckets
+ROLLUP_RESOLUTIONS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+# default number of rows per insert statement
+_BATCH_SIZE = 1000
+# default number of rows fetched at once when reading records
+_YIELD_PER = 1000
+# default number of stations per query when reading several stations
+_IN_CHUNK_SIZE = 500
+# connection pool settings and their create_engine() keyword
+_POOL_OPTIONS = (
+    ('POOL_SIZE', 'pool_size'),
+    ('MAX_OVERFLOW', 'max_overflow'),
+    ('POOL_TIMEOUT', 'pool_timeout'),
+    ('POOL_RECYCLE', 'pool_recycle'),
+    ('POOL_PRE_PING', 'pool_pre_ping'),
+)
+
 
 class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
 
     def __init__(self, settings, cache, *args, **kwargs):
-        self._engine = create_engine(self.create_dsn(settings))
+        self._engine = create_engine(self.create_dsn(settings),
+                                     **self.get_engine_options(settings))
+        self.configure_engine(self._engine, settings)
+        self._batch_size = settings.get('BATCH_SIZE', _BATCH_SIZE)
+        self._yield_per = settings.get('YIELD_PER', _YIELD_PER)
+        self._in_chunk_size = settings.get('IN_CHUNK_SIZE', _IN_CHUNK_SIZE)
+        self._schema = settings.get('SCHEMA', SCHEMA_EAV)
+        if self._schema not in (SCHEMA_EAV, SCHEMA_WIDE):
+            raise ConfigError("Unknown records schema ({})"
+                              .format(self._schema))
+        self._rollups = list(settings.get('ROLLUPS', []))
+        for resolution in self._rollups:
+            if resolution not in ROLLUP_RESOLUTIONS:
+                raise ConfigError("Unknown rollup resolution ({})"
+                                  .format(resolution))
         super(SQLAlchemyRecordsWrapper, self).__init__(
             settings, cache, *args, **kwargs
         )
@@ -31,6 +78,91 @@ class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
         """
         raise NotImplementedError
 
+    def get_engine_options(self, settings):
+        """Return the keyword arguments of :func:`sqlalchemy.create_engine`.
+
+        The connection pool options are only passed when set, otherwise the
+        defaults of the dialect apply.
+
+        :param settings: records database settings
+        :type settings: dict
+        :returns: dict
+        """
+        options = {}
+        for name, option in _POOL_OPTIONS:
+            if settings.get(name) is not None:
+                options[option] = settings[name]
+        return options
+
+    def configure_engine(self, engine, settings):
+        """Configure the engine once created, e.g. register event
+        listeners.
+
+        :param engine: the engine of the wrapper
+        :type engine: sqlalchemy.engine.Engine
+        :param settings: records database settings
+        :type settings: dict
+        """
+        pass
+
+    def get_insert_stmt(self, table):
+        """Return an insert statement for ``table`` skipping the rows
+        conflicting with existing ones (duplicated primary keys), using the
+        native conflict handling of the database.
+
+        Rows of the wide schema are merged into the conflicting ones
+        instead, see :meth:`get_merge_values`.
+
+        .. warning:: This method has to be overwritten
+
+        :param table: table to insert into
+        :type table: sqlalchemy.Table
+        :returns: sqlalchemy.sql.expression.Insert instance
+        """
+        raise NotImplementedError
+
+    def get_upsert_stmt(self, table):
+        """Return an insert statement for ``table`` replacing the values of
+        the rows conflicting with existing ones (duplicated primary keys),
+        using the native conflict handling of the database.
+
+        .. warning:: This method has to be overwritten
+
+        :param table: table to insert into
+        :type table: sqlalchemy.Table
+        :returns: sqlalchemy.sql.expression.Insert instance
+        """
+        raise NotImplementedError
+
+    def get_merge_values(self, table, excluded):
+        """Return the values updating a row of the wide schema conflicting
+        with an inserted one.
+
+        A record written twice for the same timestamp and station is merged
+        field by field: existing values are kept, like the duplicated rows of
+        the EAV schema, and the fields missing from the existing row are
+        taken from the new one.
+
+        :param table: the wide records table
+        :type table: sqlalchemy.Table
+        :param excluded: columns of the inserted row
+        :returns: dict - update expressions per column name
+        """
+        values = {
+            fieldname: func.coalesce(table.c[fieldname], excluded[fieldname])
+            for fieldname in WIDE_FIELDS
+        }
+        values['extra'] = self.merge_json(table.c.extra, excluded.extra)
+        return values
+
+    def merge_json(self, existing, new):
+        """Return an expression merging two JSON objects, the keys of
+        ``existing`` taking precedence.
+
+        .. warning:: This method has to be overwritten
+        """
+        raise NotImplementedError
+
     def create_cnx(self, settings):
         db_session = scoped_session(sessionmaker(autocommit=False,
                                                  autoflush=False,
@@ -38,23 +170,79 @@ class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
         return db_session
 
     def db_init(self):
-        Base.metadata.create_all(bind=self.get_engine())
+        self.create_tables()
 
-    def get_engine(self):
-        """Return engine url / data source name (DSN) of database."""
-        return self._engine
+    def create_tables(self):
+        """Create the records table and its indexes if they don't exist."""
+        Base.metadata.create_all(bind=self.get_engine(),
+                                 tables=self.get_tables())
+
+    def db_migrate(self):
+        """Upgrade an existing database to the current models.
 
-    def _get_rec_uuid(self, uuid, context=None):
-        """Return contextualized station uuid.
+        Missing tables are created and the indexes missing from existing
+        tables, or covering other columns than the model, are (re)created.
 
-        If there exists context with module name, the module name will simply
-        be appended in the front for inserting into the database.
+        :returns: list of str - names of the indexes created
         """
-        if context is not None:
-            moduuid = context.get('moduuid')
-            if moduuid:
-                return get_uuid(moduuid, uuid)
-        return uuid
+        engine = self.get_engine()
+        self.create_tables()
+        created = []
+        for table in self.get_tables():
+            existing = {
+                index['name']: self.get_reflected_index_key(index)
+                for index in inspect(engine).get_indexes(table.name)
+            }
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if existing.get(index.name) == self.get_index_key(index):
+                    continue
+                if index.name in existing:
+                    self.drop_index(index)
+                self.create_index(index)
+                created.append(index.name)
+        return created
+
+    def get_index_key(self, index):
+        """Return what an index of the models covers, compared to
+        :meth:`get_reflected_index_key` by :meth:`db_migrate`.
+
+        :param index: index of a model
+        :type index: sqlalchemy.Index
+        """
+        return [column.name for column in index.columns]
+
+    def get_reflected_index_key(self, index):
+        """Return what an index of the database covers.
+
+        :param index: index as reflected by the inspector
+        :type index: dict
+        """
+        return index['column_names']
+
+    def create_index(self, index):
+        """Create an index of the models in the database."""
+        index.create(bind=self.get_engine())
+
+    def drop_index(self, index):
+        """Drop an index of the models from the database."""
+        index.drop(bind=self.get_engine())
+
+    def get_table(self):
+        """Return the records table of the configured schema."""
+        if self._schema == SCHEMA_WIDE:
+            return WideRecord.__table__
+        return Record.__table__
+
+    def get_tables(self):
+        """Return all the tables used by the wrapper."""
+        tables = [self.get_table()]
+        if self._rollups:
+            tables.append(Rollup.__table__)
+        return tables
+
+    def get_engine(self):
+        """Return engine url / data source name (DSN) of database."""
+        return self._engine
 
     def is_duplicate(self, record):
         dup_count = self._cnx.query(Record).filter_by(
@@ -63,10 +251,34 @@ class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
         return dup_count != 0
 
     def write_records(self, records, ignore_check_latest=False, context=None):
+        rows, latest_records = self.prepare_records(
+            records, ignore_check_latest=ignore_check_latest, context=context)
+        # insert the records into SQL database, duplicates are skipped by
+        # the database itself
+        try:
+            self.insert_rows(self.get_table(), rows)
+            self.update_rollups(rows)
+            self._cnx.commit()
+        except Exception:
+            self._cnx.rollback()
+            raise
+        self.invalidate_results({row['uuid'] for row in rows})
+        # set latest cache values
+        self.set_latest_many(latest_records, context=context)
+
+    def prepare_records(self, records, ignore_check_latest=False,
+                        context=None):
+        """Return the rows to insert and the new latest records.
+
+        :returns: tuple - list of rows as dicts of column values and list of
+            ``(uuid, record)`` latest records to set once inserted
+        """
+        rows = []
+        latest_records = []
+        latest_many = self.get_latest_many(records.keys(), context=context)
         for uuid, records in records.items():
             rec_uuid = self._get_rec_uuid(uuid, context=context)
-            rows = []
-            latest = self.get_latest(uuid, context=context)
+            latest = latest_many[uuid]
             # this is a very naive checking of which records to consider
             # when inserting the databse because it simply limits records
             # for those that are later than the latest timestamp
@@ -84,20 +296,247 @@ class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
                 else:
                     if ts > last_record['ts']:
                         last_record = record
-                # insert the records into SQL database
-                for fieldname, value in record['fields'].items():
-                    row = Record(ts=ts,
-                                 uuid=rec_uuid,
-                                 key=fieldname,
-                                 value=value)
-                    if not self.is_duplicate(row):
-                        rows.append(row)
-            self._cnx.add_all(rows)
-            self._cnx.commit()
-            # set latest cache value
+                rows.extend(self.get_rows(rec_uuid, ts, record['fields']))
             if last_record != latest:
-                self.set_latest(uuid, last_record, context=context)
+                latest_records.append((uuid, last_record))
+        if self._schema == SCHEMA_WIDE:
+            # a statement can't merge the same row twice
+            rows = merge_wide_rows(rows)
+        return rows, latest_records
+
+    def get_rows(self, rec_uuid, ts, fields):
+        """Return the rows storing a record in the configured schema.
+
+        :param rec_uuid: contextualized station uuid
+        :type rec_uuid: str
+        :param ts: UTC timestamp of the record
+        :type ts: datetime.datetime
+        :param fields: values of the record
+        :type fields: dict
+        :returns: list of dict - rows as dicts of column values
+        """
+        if self._schema == SCHEMA_WIDE:
+            row = {'ts': ts, 'uuid': rec_uuid, 'extra': None}
+            row.update((fieldname, None) for fieldname in WIDE_FIELDS)
+            extra = {}
+            for fieldname, value in fields.items():
+                if fieldname in WIDE_FIELDS:
+                    row[fieldname] = value
+                else:
+                    extra[fieldname] = value
+            if extra:
+                row['extra'] = extra
+            return [row]
+        return [
+            {
+                'ts': ts,
+                'uuid': rec_uuid,
+                'key': fieldname,
+                'value': value,
+            }
+            for fieldname, value in fields.items()
+        ]
+
+    def insert_rows(self, table, rows, conn=None):
+        """Insert rows in batches of ``BATCH_SIZE``, one statement per batch.
+
+        The transaction is left open.
+
+        :param table: table to insert into
+        :type table: sqlalchemy.Table
+        :param rows: rows as dicts of column values
+        :type rows: list of dict
+        :param conn: connection to use instead of the session
+        :type conn: sqlalchemy.engine.Connection
+        """
+        if conn is None:
+            conn = self._cnx
+        stmt = self.get_insert_stmt(table)
+        for i in range(0, len(rows), self._batch_size):
+            conn.execute(stmt, rows[i:i + self._batch_size])
 
+    def update_rollups(self, rows, conn=None):
+        """Recompute the rollups of the fields written by the inserted rows.
+
+        See :meth:`update_rollup_fields`.
+
+        :param rows: rows inserted into the records table
+        :type rows: list of dict
+        :param conn: connection to use instead of the session
+        :type conn: sqlalchemy.engine.Connection
+        """
+        fields = {}
+        for row in rows:
+            fields.setdefault((row['uuid'], row['ts']), set()).update(
+                key for key, value in self.get_row_fields(row).items()
+                if is_number(value))
+        self.update_rollup_fields(fields, conn=conn)
+
+    def get_row_fields(self, row):
+        """Return the fields stored by a row of the records table.
+
+        :param row: row as a dict of column values
+        :type row: dict
+        :returns: dict
+        """
+        if self._schema == SCHEMA_WIDE:
+            fields = {fieldname: row[fieldname] for fieldname in WIDE_FIELDS
+                      if row[fieldname] is not None}
+            fields.update(row['extra'] or {})
+            return fields
+        return {row['key']: row['value']}
+
+    def update_rollup_fields(self, fields, conn=None):
+        """Recompute the rollup buckets of written fields.
+
+        Buckets are recomputed from the records table, in the transaction of
+        the insertion, so duplicated rows skipped by the database are never
+        counted twice. Only the records of the touched buckets are read,
+        contiguous buckets with a single query, and the written fields of
+        the buckets are upserted with the statement of
+        :meth:`get_upsert_stmt`. Non-numeric values are left out.
+
+        The rollup rows are locked first, see :meth:`lock_rollups`, so
+        concurrent writers of a bucket recompute it one after the other, each
+        reading the records committed by the previous one.
+
+        :param fields: names of the written fields per ``(uuid, ts)``
+        :type fields: dict
+        :param conn: connection to use instead of the session
+        :type conn: sqlalchemy.engine.Connection
+        """
+        if not self._rollups:
+            return
+        if conn is None:
+            conn = self._cnx
+        # fields written per station, resolution and bucket
+        touched = {}
+        for (rec_uuid, ts), keys in fields.items():
+            if not keys:
+                continue
+            for resolution in self._rollups:
+                touched.setdefault((rec_uuid, resolution), {}).setdefault(
+                    get_bucket(ts, resolution), set()).update(keys)
+        rollup = Rollup.__table__
+        stmt = self.get_upsert_stmt(rollup)
+        for (rec_uuid, resolution), bucket_keys in sorted(touched.items()):
+            self.lock_rollups(rec_uuid, resolution, bucket_keys, conn)
+            buckets = {}
+            for start, end in iter_bucket_ranges(
+                    sorted(bucket_keys), ROLLUP_RESOLUTIONS[resolution]):
+                records_stmt = self.get_records_stmt(
+                    [rec_uuid], start, end - timedelta(microseconds=1))
+                for _, record in self.iter_records(
+                        conn.execute(records_stmt)):
+                    bucket = get_bucket(record['ts'], resolution)
+                    for key, value in record['fields'].items():
+                        if (key not in bucket_keys.get(bucket, ()) or
+                                not is_number(value)):
+                            continue
+                        agg = buckets.get((key, bucket))
+                        if agg is None:
+                            buckets[(key, bucket)] = {
+                                'uuid': rec_uuid,
+                                'resolution': resolution,
+                                'bucket': bucket,
+                                'key': key,
+                                'count': 1,
+                                'sum': value,
+                                'min': value,
+                                'max': value,
+                            }
+                        else:
+                            agg['count'] += 1
+                            agg['sum'] += value
+                            agg['min'] = min(agg['min'], value)
+                            agg['max'] = max(agg['max'], value)
+            if buckets:
+                conn.execute(stmt, list(buckets.values()))
+            # the rows created by lock_rollups() for fields without any
+            # numeric value, e.g. merged into a non-numeric existing one
+            for bucket, keys in bucket_keys.items():
+                for key in keys:
+                    if (key, bucket) not in buckets:
+                        conn.execute(rollup.delete().where(
+                            rollup.c.uuid == rec_uuid,
+                            rollup.c.resolution == resolution,
+                            rollup.c.bucket == bucket,
+                            rollup.c.key == key))
+
+    def lock_rollups(self, rec_uuid, resolution, bucket_keys, conn):
+        """Lock the rollup rows of fields until the end of the transaction.
+
+        Missing rows are created empty first (``count`` of 0), a writer
+        creating the same row waits for the transaction of the first one.
+        Rows are then locked with ``SELECT ... FOR UPDATE``, SQLite has no
+        row locks but a single writer at a time.
+
+        :param rec_uuid: contextualized station uuid
+        :type rec_uuid: str
+        :param resolution: resolution of the rollups
+        :type resolution: str
+        :param bucket_keys: names of the fields per bucket
+        :type bucket_keys: dict
+        :param conn: connection of the transaction
+        """
+        rollup = Rollup.__table__
+        conn.execute(self.get_insert_stmt(rollup), [
+            {
+                'uuid': rec_uuid,
+                'resolution': resolution,
+                'bucket': bucket,
+                'key': key,
+                'count': 0,
+                'sum': 0,
+                'min': 0,
+                'max': 0,
+            }
+            for bucket in sorted(bucket_keys)
+            for key in sorted(bucket_keys[bucket])
+        ])
+        conn.execute(
+            select(rollup.c.key)
+            .where(rollup.c.uuid == rec_uuid,
+                   rollup.c.resolution == resolution,
+                   rollup.c.bucket.in_(sorted(bucket_keys)),
+                   rollup.c.key.in_(sorted(set().union(
+                       *bucket_keys.values()))))
+            .order_by(rollup.c.bucket, rollup.c.key)
+            .with_for_update()).fetchall()
+
+    def get_aggregates(self, uuid, start, end, resolution, fields=None,
+                       context=None):
+        rec_uuid = self._get_rec_uuid(uuid, context=context)
+        if resolution not in self._rollups:
+            raise ConfigError("Rollup resolution isn't enabled ({})"
+                              .format(resolution))
+        rollup = Rollup.__table__
+        stmt = select(rollup.c.bucket, rollup.c.key, rollup.c.count,
+                      rollup.c.sum, rollup.c.min, rollup.c.max) \
+            .where(rollup.c.uuid == rec_uuid) \
+            .where(rollup.c.resolution == resolution) \
+            .where(rollup.c.bucket >= get_bucket(to_utc(start), resolution)) \
+            .where(rollup.c.bucket <= to_utc(end).replace(tzinfo=None)) \
+            .order_by(rollup.c.bucket)
+        if fields is not None:
+            stmt = stmt.where(rollup.c.key.in_(fields))
+        for bucket, bucket_rows in groupby(self._cnx.execute(stmt),
+                                           key=itemgetter(0)):
+            yield {
+                'ts': bucket.replace(tzinfo=pytz.utc),
+                'fields': {
+                    key: {
+                        'count': count,
+                        'mean': total / count,
+                        'min': min_value,
+                        'max': max_value,
+                    }
+                    for _, key, count, total, min_value, max_value
+                    in bucket_rows
+                },
+            }
+
+    @cache_results
     def get_records(self, uuid, start, end, fields=None, context=None):
         # sanitize datetime input
         start_dt = to_utc(start)
@@ -105,32 +544,183 @@ class SQLAlchemyRecordsWrapper(BaseRecordsWrapper):
 
         rec_uuid = self._get_rec_uuid(uuid, context=context)
 
-        query = self._cnx.query(Record) \
-            .filter(Record.uuid == rec_uuid) \
-            .filter(Record.ts >= start_dt) \
-            .filter(Record.ts <= end_dt)
+        # a single query ordered by timestamp, rows are streamed in chunks
+        # of `YIELD_PER` and grouped by timestamp on the fly
+        stmt = self.get_records_stmt([rec_uuid], start_dt, end_dt, fields)
+        rows = self.execute_stream(stmt)
+        for _, record in self.iter_records(rows, fields):
+            yield record
 
-        # filter which fields
-        if fields is not None:
-            query = query.filter(Record.key.in_(fields))
+    def get_records_many(self, uuids, start, end, fields=None, context=None):
+        for rec_uuids, rows in self.get_rows_many(uuids, start, end,
+                                                  fields=fields,
+                                                  context=context):
+            for rec_uuid, record in self.iter_records(rows, fields):
+                yield rec_uuids[rec_uuid], record
 
-        distinct_datetimes = [
-            q.ts for q in
-            query.group_by('ts')
-        ]
+    def get_rows_many(self, uuids, start, end, fields=None, context=None):
+        """Stream the rows of the records of several stations, as selected
+        by :meth:`get_records_stmt`, with one query per chunk of
+        ``IN_CHUNK_SIZE`` stations.
 
-        # group by datetime
-        for ts in distinct_datetimes:
-            yield {
+        :param uuids: station or wildcard region uuids
+        :type uuids: list of str
+        :returns: generator - ``(rec_uuids, rows)`` pairs per chunk, the
+            station uuid per contextualized uuid and the streamed rows
+        """
+        start_dt = to_utc(start)
+        end_dt = to_utc(end)
+
+        rec_uuids = {}
+        for uuid in expand_uuids(uuids):
+            rec_uuids[self._get_rec_uuid(uuid, context=context)] = uuid
+        ordered = sorted(rec_uuids)
+
+        for i in range(0, len(ordered), self._in_chunk_size):
+            chunk = ordered[i:i + self._in_chunk_size]
+            stmt = self.get_records_stmt(chunk, start_dt, end_dt, fields)
+            yield rec_uuids, self.execute_stream(stmt)
+
+    def get_records_stmt(self, rec_uuids, start_dt, end_dt, fields=None):
+        """Return the statement selecting the rows of records, ordered by
+        station and timestamp.
+
+        :param rec_uuids: contextualized station uuids
+        :type rec_uuids: list of str
+        :param start_dt: the UTC start date (lower boundary)
+        :param end_dt: the UTC end date (upper boundary)
+        :param fields: list of fields to select
+        :type fields: list of str
+        :returns: sqlalchemy.sql.expression.Select instance
+        """
+        table = self.get_table()
+        if self._schema == SCHEMA_WIDE:
+            if fields is None:
+                columns = [table.c[f] for f in WIDE_FIELDS] + [table.c.extra]
+            else:
+                columns = [table.c[f] for f in fields if f in WIDE_FIELDS]
+                if any(f not in WIDE_FIELDS for f in fields):
+                    columns.append(table.c.extra)
+            stmt = select(table.c.uuid, table.c.ts, *columns)
+        else:
+            stmt = select(table.c.uuid, table.c.ts, table.c.key,
+                          table.c.value)
+            # filter which fields
+            if fields is not None:
+                stmt = stmt.where(table.c.key.in_(fields))
+        if len(rec_uuids) == 1:
+            stmt = stmt.where(table.c.uuid == rec_uuids[0])
+        else:
+            stmt = stmt.where(table.c.uuid.in_(rec_uuids))
+        return stmt \
+            .where(table.c.ts >= start_dt) \
+            .where(table.c.ts <= end_dt) \
+            .order_by(table.c.uuid, table.c.ts)
+
+    def execute_stream(self, stmt):
+        """Execute a select statement, streaming the rows in chunks of
+        ``YIELD_PER``.
+        """
+        if not self._yield_per:
+            return self._cnx.execute(stmt)
+        stmt = stmt.execution_options(stream_results=True)
+        return self._cnx.execute(stmt).yield_per(self._yield_per)
+
+    def iter_records(self, rows, fields=None):
+        """Group the rows selected with :meth:`get_records_stmt` into
+        records.
+
+        .. note:: ``NULL`` values are left out of the records of the wide
+            schema as they can't be told apart from missing fields.
+
+        :param rows: rows ordered by station and timestamp
+        :param fields: list of the selected fields
+        :type fields: list of str
+        :returns: generator - ``(rec_uuid, record)`` pairs
+        """
+        if self._schema == SCHEMA_WIDE:
+            for row in rows:
+                row = row._mapping
+                values = {
+                    f: row[f] for f in WIDE_FIELDS
+                    if f in row and row[f] is not None
+                }
+                for fieldname, value in (row.get('extra') or {}).items():
+                    if fields is None or fieldname in fields:
+                        values[fieldname] = value
+                yield row['uuid'], {
+                    'ts': row['ts'].replace(tzinfo=pytz.utc),
+                    'fields': values,
+                }
+            return
+        for (rec_uuid, ts), ts_rows in groupby(rows, key=itemgetter(0, 1)):
+            yield rec_uuid, {
                 'ts': ts.replace(tzinfo=pytz.utc),
-                'fields': {
-                    rec.key: rec.value
-                    for rec
-                    in query.filter(Record.ts == ts).all()
-                },
+                'fields': {key: value for _, _, key, value in ts_rows},
             }
 
 
+def get_bucket(ts, resolution):
+    """Return the naive UTC start of the rollup bucket holding ``ts``."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc).replace(tzinfo=None)
+    ts = ts.replace(minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        ts = ts.replace(hour=0)
+    return ts
+
+
+def is_number(value):
+    """Return whether a field value can be aggregated."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def iter_bucket_ranges(buckets, length):
+    """Merge contiguous buckets into time ranges.
+
+    :param buckets: sorted bucket starts
+    :type buckets: list of datetime.datetime
+    :param length: length of the buckets
+    :type length: datetime.timedelta
+    :returns: generator - ``(start, end)`` ranges, end excluded
+    """
+    start = end = None
+    for bucket in buckets:
+        if bucket != end:
+            if start is not None:
+                yield start, end
+            start = bucket
+        end = bucket + length
+    if start is not None:
+        yield start, end
+
+
+def merge_wide_rows(rows):
+    """Merge the rows of the wide schema sharing a timestamp and station,
+    like :meth:`SQLAlchemyRecordsWrapper.get_merge_values`: values of the
+    first row are kept and its missing fields are taken from the next ones.
+
+    :param rows: rows as dicts of column values
+    :type rows: list of dict
+    :returns: list of dict - one row per timestamp and station
+    """
+    merged = {}
+    for row in rows:
+        key = (row['ts'], row['uuid'])
+        existing = merged.get(key)
+        if existing is None:
+            merged[key] = row
+            continue
+        for fieldname in WIDE_FIELDS:
+            if existing[fieldname] is None:
+                existing[fieldname] = row[fieldname]
+        if row['extra']:
+            extra = dict(row['extra'])
+            extra.update(existing['extra'] or {})
+            existing['extra'] = extra
+    return list(merged.values())
+
+
 def to_utc(dt):
     """Make input time parameters UTC or force it."""
     if dt.tzinfo is None:
@@ -141,6 +731,11 @@ def to_utc(dt):
 
 class Record(Base):
     __tablename__ = 'records'
+    __table_args__ = (
+        # time range queries of a station, covering on PostgreSQL
+        Index('ix_records_uuid_ts', 'uuid', 'ts',
+              postgresql_include=['key', 'value']),
+    )
 
     ts = Column(DateTime, primary_key=True)
     uuid = Column(String(250), nullable=False, primary_key=True)
@@ -152,3 +747,45 @@ class Record(Base):
             "<Record(ts='{ts}', uuid='{uuid}', key='{key}', value='{value}')>"
             .format(ts=self.ts, uuid=self.uuid, key=self.key, value=self.value)
         )
+
+
+class WideRecord(Base):
+    __tablename__ = 'records_wide'
+    __table_args__ = (
+        # time range queries of a station
+        Index('ix_records_wide_uuid_ts', 'uuid', 'ts'),
+    )
+
+    ts = Column(DateTime, primary_key=True)
+    uuid = Column(String(250), nullable=False, primary_key=True)
+    pm25 = Column(Float(), nullable=True)
+    pm10 = Column(Float(), nullable=True)
+    co = Column(Float(), nullable=True)
+    no2 = Column(Float(), nullable=True)
+    o3_1h = Column(Float(), nullable=True)
+    o3_8h = Column(Float(), nullable=True)
+    so2 = Column(Float(), nullable=True)
+    extra = Column(JSON(none_as_null=True), nullable=True)
+
+    def __repr__(self):
+        return "<WideRecord(ts='{ts}', uuid='{uuid}')>".format(
+            ts=self.ts, uuid=self.uuid)
+
+
+class Rollup(Base):
+    __tablename__ = 'records_rollup'
+
+    uuid = Column(String(250), nullable=False, primary_key=True)
+    resolution = Column(String(16), nullable=False, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    key = Column(String(250), nullable=False, primary_key=True)
+    count = Column(Integer(), nullable=False)
+    sum = Column(Float(), nullable=False)
+    min = Column(Float(), nullable=False)
+    max = Column(Float(), nullable=False)
+
+    def __repr__(self):
+        return ("<Rollup(uuid='{uuid}', resolution='{resolution}', "
+                "bucket='{bucket}', key='{key}')>".format(
+                    uuid=self.uuid, resolution=self.resolution,
+                    bucket=self.bucket, key=self.key))
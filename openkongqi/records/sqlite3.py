@@ -1,14 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
-from .sqlalch import SQLAlchemyRecordsWrapper
+from .sqlalch import SQLAlchemyRecordsWrapper, WideRecord
+from ..exceptions import ConfigError
 
+from sqlalchemy import case, event, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine.url import URL
+from sqlalchemy.pool import QueuePool
 
 _NAME = 'openkongqi'
+_JOURNAL_MODE = 'WAL'
+_SYNCHRONOUS = 'NORMAL'
+_CACHE_SIZE = None
+_MMAP_SIZE = None
+_BUSY_TIMEOUT = 30
+# create_engine() keywords only accepted by the queue pool
+_QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
 
 
 class RecordsWrapper(SQLAlchemyRecordsWrapper):
+    """SQLite records wrapper.
+
+    Each connection is set up with the ``JOURNAL_MODE``, ``SYNCHRONOUS``,
+    ``CACHE_SIZE`` and ``MMAP_SIZE`` pragmas, and waits ``BUSY_TIMEOUT``
+    seconds for the database lock. In WAL mode, reads don't block writes.
+    """
 
     def create_dsn(self, settings):
         engine = 'sqlite'
@@ -19,3 +36,67 @@ class RecordsWrapper(SQLAlchemyRecordsWrapper):
         else:
             dsn = URL(engine, database=db_filename)
         return dsn
+
+    def get_engine_options(self, settings):
+        options = super(RecordsWrapper, self).get_engine_options(settings)
+        options['connect_args'] = {
+            'timeout': settings.get('BUSY_TIMEOUT', _BUSY_TIMEOUT),
+        }
+        # file databases aren't pooled by default, pool them when an option
+        # of the queue pool is set
+        queue_options = [option for option in _QUEUE_POOL_OPTIONS
+                         if option in options]
+        if queue_options:
+            if settings.get('NAME', _NAME) == ':memory:':
+                raise ConfigError(
+                    "In-memory databases can't be pooled ({})"
+                    .format(', '.join(queue_options)))
+            options['poolclass'] = QueuePool
+        return options
+
+    def configure_engine(self, engine, settings):
+        pragmas = get_pragmas(settings)
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute("PRAGMA {}={}".format(name, value))
+            cursor.close()
+
+    def get_insert_stmt(self, table):
+        stmt = insert(table)
+        if table is not WideRecord.__table__:
+            return stmt.on_conflict_do_nothing()
+        return stmt.on_conflict_do_update(
+            index_elements=table.primary_key.columns,
+            set_=self.get_merge_values(table, stmt.excluded))
+
+    def get_upsert_stmt(self, table):
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=table.primary_key.columns,
+            set_={column.name: stmt.excluded[column.name]
+                  for column in table.columns if not column.primary_key})
+
+    def merge_json(self, existing, new):
+        return case(
+            (existing.is_(None), new),
+            (new.is_(None), existing),
+            else_=func.json_patch(new, existing))
+
+
+def get_pragmas(settings):
+    """Return the ``(name, value)`` pragmas set on each connection.
+
+    :param settings: records database settings
+    :type settings: dict
+    :returns: list of tuple
+    """
+    pragmas = [
+        ('journal_mode', settings.get('JOURNAL_MODE', _JOURNAL_MODE)),
+        ('synchronous', settings.get('SYNCHRONOUS', _SYNCHRONOUS)),
+        ('cache_size', settings.get('CACHE_SIZE', _CACHE_SIZE)),
+        ('mmap_size', settings.get('MMAP_SIZE', _MMAP_SIZE)),
+    ]
+    return [(name, value) for name, value in pragmas if value is not None]
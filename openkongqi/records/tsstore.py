@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Embedded time-series records engine.
+
+Each series (station, field) is stored per month in an append-only file of
+``(ts, value)`` pairs, ``ts`` being a UTC epoch in seconds::
+
+    <PATH>/<uuid>/<YYYY-MM>/<field>.bin
+    <PATH>/<uuid>/index.json
+
+Files are read as memory-mapped NumPy arrays sorted by timestamp, a range
+read is a binary search and a zero-copy slice (:meth:`get_series`). The
+index of a station lists the months of each of its fields.
+
+Records are appended as long as they are newer than the last one of the
+series, older records trigger a rewrite of the month. Writes of a station
+are serialized with a file lock, and writes of a series file with its own
+lock file.
+
+Requires :mod:`numpy`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import calendar
+from datetime import datetime
+import fcntl
+from itertools import groupby
+import json
+import os
+
+import numpy as np
+import pytz
+
+from .base import BaseRecordsWrapper, cache_results
+from ..exceptions import ConfigError
+
+_PATH = 'openkongqi.tsstore'
+
+#: record dtype of the series files
+DTYPE = np.dtype([('ts', '<i8'), ('value', '<f8')])
+
+#: length of the aggregation buckets in seconds
+RESOLUTIONS = {
+    'hour': 3600,
+    'day': 86400,
+}
+
+
+class RecordsWrapper(BaseRecordsWrapper):
+
+    def create_cnx(self, settings):
+        # the "connection" is the root directory of the store
+        return settings.get('PATH', _PATH)
+
+    def db_init(self):
+        if not os.path.exists(self._cnx):
+            os.makedirs(self._cnx)
+
+    def db_migrate(self):
+        self.db_init()
+        return []
+
+    def get_path(self, rec_uuid, *args):
+        """Return the path of a file of a station."""
+        return os.path.join(self._cnx, rec_uuid, *args)
+
+    def get_index(self, rec_uuid):
+        """Return the index of a station.
+
+        :returns: dict - sorted months per field
+        """
+        try:
+            with open(self.get_path(rec_uuid, 'index.json')) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+    def set_index(self, rec_uuid, index):
+        fpath = self.get_path(rec_uuid, 'index.json')
+        with open(fpath + '.tmp', 'w') as f:
+            json.dump(index, f, sort_keys=True)
+        os.replace(fpath + '.tmp', fpath)
+
+    def is_duplicate(self, record):
+        ts = to_epoch(record.ts)
+        series = self.get_series(record.uuid, record.key,
+                                 record.ts, record.ts)
+        return any(len(arr) and arr['ts'][0] == ts for arr in series)
+
+    def write_records(self, records, ignore_check_latest=False, context=None):
+        latest_records = []
+        latest_many = self.get_latest_many(records.keys(), context=context)
+        for uuid, uuid_records in records.items():
+            rec_uuid = self._get_rec_uuid(uuid, context=context)
+            latest = latest_many[uuid]
+            if not ignore_check_latest and latest is not None:
+                uuid_records = [r for r in uuid_records
+                                if r['ts'] > latest['ts']]
+            last_record = latest
+            # values per series and month
+            series = {}
+            for record in uuid_records:
+                ts = record['ts'].astimezone(pytz.utc)
+                if last_record is None or ts > last_record['ts']:
+                    last_record = record
+                month = ts.strftime('%Y-%m')
+                for fieldname, value in record['fields'].items():
+                    if value is None:
+                        continue
+                    series.setdefault((fieldname, month), []).append(
+                        (to_epoch(ts), value))
+            if series:
+                self.write_series(rec_uuid, series)
+                self.invalidate_results([rec_uuid])
+            if last_record is not latest:
+                latest_records.append((uuid, last_record))
+        # set latest cache values once the records are written
+        self.set_latest_many(latest_records, context=context)
+
+    def write_series(self, rec_uuid, series):
+        """Write values to the series of a station.
+
+        :param rec_uuid: contextualized station uuid
+        :type rec_uuid: str
+        :param series: ``(ts, value)`` pairs per ``(field, month)``
+        :type series: dict
+        """
+        dirname = self.get_path(rec_uuid)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.get_path(rec_uuid, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.get_index(rec_uuid)
+            for (fieldname, month), values in sorted(series.items()):
+                month_dir = self.get_path(rec_uuid, month)
+                if not os.path.exists(month_dir):
+                    os.makedirs(month_dir)
+                append_series(os.path.join(month_dir, fieldname + '.bin'),
+                              np.array(values, dtype=DTYPE))
+                months = index.setdefault(fieldname, [])
+                if month not in months:
+                    months.append(month)
+                    months.sort()
+            self.set_index(rec_uuid, index)
+
+    def get_series(self, uuid, field, start, end, context=None):
+        """Return the values of a series between two dates.
+
+        :param uuid: station uuid
+        :param field: field name
+        :type field: str
+        :param start: the start date (lower boundary)
+        :param end: the end date (upper boundary)
+        :returns: list of numpy.ndarray - zero-copy slices of :data:`DTYPE`,
+            one per month
+        """
+        rec_uuid = self._get_rec_uuid(uuid, context=context)
+        return [
+            arr for _, arr in self._iter_series(
+                rec_uuid, field, self.get_index(rec_uuid).get(field, []),
+                to_epoch(start), to_epoch(end))
+        ]
+
+    def _iter_series(self, rec_uuid, field, months, start, end):
+        first = epoch_month(start)
+        last = epoch_month(end)
+        for month in months:
+            if month < first or month > last:
+                continue
+            arr = load_series(self.get_path(rec_uuid, month, field + '.bin'))
+            if arr is None:
+                continue
+            i = np.searchsorted(arr['ts'], start, side='left')
+            j = np.searchsorted(arr['ts'], end, side='right')
+            if j > i:
+                yield month, arr[i:j]
+
+    def _iter_months(self, uuid, start, end, fields=None, context=None):
+        """Return the slices of the fields per month, ordered by month."""
+        rec_uuid = self._get_rec_uuid(uuid, context=context)
+        index = self.get_index(rec_uuid)
+        if fields is None:
+            fields = sorted(index)
+        slices = []
+        for field in fields:
+            for month, arr in self._iter_series(
+                    rec_uuid, field, index.get(field, []),
+                    to_epoch(start), to_epoch(end)):
+                slices.append((month, field, arr))
+        slices.sort(key=lambda s: s[0])
+        for month, month_slices in groupby(slices, key=lambda s: s[0]):
+            yield month, [(field, arr) for _, field, arr in month_slices]
+
+    @cache_results
+    def get_records(self, uuid, start, end, fields=None, context=None):
+        for _, month_slices in self._iter_months(uuid, start, end,
+                                                 fields=fields,
+                                                 context=context):
+            records = {}
+            for field, arr in month_slices:
+                for ts, value in zip(arr['ts'].tolist(),
+                                     arr['value'].tolist()):
+                    records.setdefault(ts, {})[field] = value
+            for ts in sorted(records):
+                yield {
+                    'ts': from_epoch(ts),
+                    'fields': records[ts],
+                }
+
+    def get_aggregates(self, uuid, start, end, resolution, fields=None,
+                       context=None):
+        if resolution not in RESOLUTIONS:
+            raise ConfigError("Unknown resolution ({})".format(resolution))
+        length = RESOLUTIONS[resolution]
+        # buckets never span two months
+        start = from_epoch(to_epoch(start) // length * length)
+        for _, month_slices in self._iter_months(uuid, start, end,
+                                                 fields=fields,
+                                                 context=context):
+            buckets = {}
+            for field, arr in month_slices:
+                values = arr['value']
+                bucket_ts = arr['ts'] // length * length
+                # series are sorted, buckets are contiguous
+                idx = np.flatnonzero(np.diff(bucket_ts)) + 1
+                idx = np.concatenate(([0], idx))
+                counts = np.diff(np.append(idx, len(values)))
+                sums = np.add.reduceat(values, idx)
+                mins = np.minimum.reduceat(values, idx)
+                maxs = np.maximum.reduceat(values, idx)
+                for i, bucket in enumerate(bucket_ts[idx].tolist()):
+                    buckets.setdefault(bucket, {})[field] = {
+                        'count': int(counts[i]),
+                        'mean': float(sums[i] / counts[i]),
+                        'min': float(mins[i]),
+                        'max': float(maxs[i]),
+                    }
+            for bucket in sorted(buckets):
+                yield {
+                    'ts': from_epoch(bucket),
+                    'fields': buckets[bucket],
+                }
+
+
+def append_series(fpath, values):
+    """Append values to a series file, keeping it sorted by timestamp.
+
+    Values already in the file (same timestamp) are skipped. Values older
+    than the last one of the file trigger a rewrite of the file, to a
+    temporary file renamed over it.
+
+    Writers of a file are serialized with the lock file ``<fpath>.lock``.
+    A partial record left by an interrupted append is truncated first.
+
+    :param fpath: path of the series file
+    :type fpath: str
+    :param values: values to write
+    :type values: numpy.ndarray of :data:`DTYPE`
+    """
+    values = np.sort(values, order='ts', kind='stable')
+    # keep the first value of a timestamp
+    values = values[np.unique(values['ts'], return_index=True)[1]]
+    with open(fpath + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(fpath, 'ab') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % DTYPE.itemsize:
+                f.truncate(size - size % DTYPE.itemsize)
+            existing = load_series(fpath)
+            if existing is None or values['ts'][0] > existing['ts'][-1]:
+                f.write(values.tobytes())
+                return
+        merged = np.concatenate((existing, values))
+        # existing values come first, they are kept over the new ones
+        merged = merged[np.unique(merged['ts'], return_index=True)[1]]
+        with open(fpath + '.tmp', 'wb') as f:
+            f.write(merged.tobytes())
+        del existing
+        os.replace(fpath + '.tmp', fpath)
+
+
+def load_series(fpath):
+    """Memory-map a series file.
+
+    A partial record at the end of the file (interrupted append) is left
+    out.
+
+    :returns: numpy.memmap of :data:`DTYPE` or ``None`` if the file is
+        missing or empty
+    """
+    try:
+        count = os.path.getsize(fpath) // DTYPE.itemsize
+    except OSError:
+        return None
+    if not count:
+        return None
+    return np.memmap(fpath, dtype=DTYPE, mode='r', shape=(count, ))
+
+
+def to_epoch(dt):
+    """Convert a datetime (naive ones are UTC) to a UTC epoch."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc)
+    return calendar.timegm(dt.timetuple())
+
+
+def from_epoch(ts):
+    """Convert a UTC epoch to an aware datetime."""
+    return datetime.utcfromtimestamp(ts).replace(tzinfo=pytz.utc)
+
+
+def epoch_month(ts):
+    """Return the ``YYYY-MM`` month of a UTC epoch."""
+    return datetime.utcfromtimestamp(ts).strftime('%Y-%m')
@@ -6,7 +6,9 @@ def source_router(name, args, kwargs, options, task=None):
     """
     A dynamic router used to set a specific queue to scrape a source if the
     source definition has a key named 'queue'. If no queue is specified, return
-    `None` which will set the queue to `task_default_queue`.
+    `None` which will set the queue to `task_default_queue`. Batches, scraped
+    synchronously or asynchronously, are routed with the queue of their first
+    source.
 
     .. code:: json
 
@@ -21,8 +23,12 @@ def source_router(name, args, kwargs, options, task=None):
         }
         
     """
-    if name == 'openkongqi.tasks.scrape':
-        info = get_source(args[0])
+    if name in ('openkongqi.tasks.scrape', 'openkongqi.tasks.scrape_batch',
+                'openkongqi.tasks.scrape_async'):
+        # sources of a batch share the same queue
+        src_name = args[0] if name == 'openkongqi.tasks.scrape' \
+            else args[0][0]
+        info = get_source(src_name)
         if 'queue' in info:
             return {
                 'queue': info['queue'],
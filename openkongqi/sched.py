@@ -1,18 +1,147 @@
 # -*- coding: utf-8 -*-
 
 from datetime import timedelta
+from urllib.parse import urlparse
 
+from .conf import settings
+from .records.buffer import _INTERVAL as _FLUSH_INTERVAL
 from .source import get_sources
 
+#: group the sources sharing the same queue
+GROUP_BY_QUEUE = 'queue'
+#: group the sources sharing the same queue and target host
+GROUP_BY_HOST = 'host'
 
-def get_schedule(_sched):
+TASK_SCRAPE_BATCH = 'openkongqi.tasks.scrape_batch'
+TASK_SCRAPE_ASYNC = 'openkongqi.tasks.scrape_async'
+TASK_FLUSH_RECORDS = 'openkongqi.tasks.flush_records'
+#: prefix of the entry names per batch task
+BATCH_PREFIXES = {
+    TASK_SCRAPE_BATCH: 'batch',
+    TASK_SCRAPE_ASYNC: 'async',
+}
+
+
+def get_schedule(_sched, group_by=None, batch_size=None, asynchronous=False):
     """Get celery schedule.
+
+    By default every source gets its own ``openkongqi.tasks.scrape`` entry.
+    With ``group_by``, sources are grouped in ``openkongqi.tasks.scrape_batch``
+    entries so that a single message scrapes many sources. Sources of a group
+    always share the same queue.
+
+    With ``asynchronous``, groups are ``openkongqi.tasks.scrape_async``
+    entries scraping their sources concurrently (requires the ``async``
+    extra), sources are then grouped by queue unless ``group_by`` is given.
+
+    The entries of :func:`get_flush_schedule` are added as well.
+
+    :param _sched: schedule of the entries
+    :param group_by: ``None``, ``'queue'`` or ``'host'``
+    :type group_by: str
+    :param batch_size: (optional) maximum number of sources per entry
+    :type batch_size: int
+    :param asynchronous: scrape the groups with the asynchronous engine
+    :type asynchronous: bool
     """
-    dyn_schedule = dict()
-    for source in get_sources():
-        dyn_schedule[source['name']] = {
-            'task': 'openkongqi.tasks.scrape',
-            'schedule': _sched,
-            'args': (source['name'], )
+    if asynchronous:
+        dyn_schedule = get_batch_schedule(_sched, group_by or GROUP_BY_QUEUE,
+                                          batch_size, task=TASK_SCRAPE_ASYNC)
+    elif group_by is not None:
+        dyn_schedule = get_batch_schedule(_sched, group_by, batch_size)
+    else:
+        dyn_schedule = dict()
+        for source in get_sources():
+            dyn_schedule[source['name']] = {
+                'task': 'openkongqi.tasks.scrape',
+                'schedule': _sched,
+                'args': (source['name'], )
+            }
+    dyn_schedule.update(get_flush_schedule())
+    return dyn_schedule
+
+
+def get_flush_schedule():
+    """Get celery schedule flushing the write-behind queues.
+
+    Empty unless the ``WRITE_BEHIND`` option of the records database is
+    set. Entries run every ``INTERVAL`` seconds so that idle queues are
+    flushed as well.
+
+    The queue is a local file, a flush only writes the records queued on the
+    host of the worker running it. With the ``QUEUES`` option, one entry is
+    routed to each of the listed celery queues, each consumed by the
+    workers of one host. Otherwise a single ``flush_records`` entry goes to
+    the default queue, which fits a single host.
+
+    :returns: dict
+    """
+    write_behind = settings.get('DATABASES', {}).get('records', {}) \
+        .get('WRITE_BEHIND')
+    if not write_behind:
+        return {}
+    interval = timedelta(seconds=write_behind.get('INTERVAL',
+                                                  _FLUSH_INTERVAL))
+    queues = write_behind.get('QUEUES')
+    if not queues:
+        return {
+            'flush_records': {
+                'task': TASK_FLUSH_RECORDS,
+                'schedule': interval,
+            }
+        }
+    return {
+        'flush_records:{}'.format(queue): {
+            'task': TASK_FLUSH_RECORDS,
+            'schedule': interval,
+            'options': {'queue': queue, 'routing_key': queue},
         }
+        for queue in queues
+    }
+
+
+def get_batch_schedule(_sched, group_by=GROUP_BY_QUEUE, batch_size=None,
+                       task=TASK_SCRAPE_BATCH):
+    """Get celery schedule with sources grouped in batches.
+
+    See :func:`get_schedule`.
+
+    :param task: task scraping a batch, ``openkongqi.tasks.scrape_batch`` or
+        ``openkongqi.tasks.scrape_async``
+    :type task: str
+    """
+    groups = dict()
+    for source in get_sources():
+        groups.setdefault(get_group_key(source, group_by), []) \
+            .append(source['name'])
+
+    dyn_schedule = dict()
+    for key, names in groups.items():
+        names = sorted(names)
+        size = batch_size or len(names)
+        for i in range(0, len(names), size):
+            entry_name = '{}:{}:{}'.format(BATCH_PREFIXES[task],
+                                           ':'.join(key), i // size)
+            dyn_schedule[entry_name] = {
+                'task': task,
+                'schedule': _sched,
+                'args': (names[i:i + size], )
+            }
     return dyn_schedule
+
+
+def get_group_key(source, group_by):
+    """Return the batch group of a source.
+
+    :param source: source information
+    :type source: dict
+    :param group_by: ``'queue'`` or ``'host'``
+    :type group_by: str
+    :returns: tuple
+    """
+    key = (source.get('queue', ''), )
+    if group_by == GROUP_BY_HOST:
+        key += (urlparse(source['target']).netloc, )
+    elif group_by != GROUP_BY_QUEUE:
+        raise ValueError("Unknown batch group ({})".format(group_by))
+    return key
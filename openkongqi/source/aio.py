@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous scraping engine.
+
+Fetches many sources concurrently from a single worker process with
+:mod:`aiohttp`. Sources inheriting from :class:`AsyncHTTPSource` are fetched
+natively on the event loop, any other source is scraped in a thread of a
+bounded executor. Once fetched, the content goes through the usual
+:meth:`openkongqi.source.base.BaseSource.process` stages (status, cache,
+extraction and records), which run in the executor so they never block the
+event loop. The response body is streamed from the event loop into the file
+cache, see :class:`StreamedBody`.
+
+Concurrency is configured with the ``ASYNC`` setting, the engine is run by
+the ``openkongqi.tasks.scrape_async`` task, scheduled with
+``get_schedule(..., asynchronous=True)``.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import io
+import time
+from urllib.parse import urlparse
+
+from urllib3.exceptions import MaxRetryError
+from urllib3.response import HTTPResponse
+
+try:
+    import aiohttp
+except ImportError:     # pragma: no cover
+    # sources can inherit from AsyncHTTPSource without the async extra, they
+    # are then only scraped synchronously
+    aiohttp = None
+from celery.utils.log import get_task_logger
+
+from ..conf import settings
+from ..filecache import CHUNK_SIZE
+from ..utils import get_source
+from .base import HTTPSource
+from .pool import get_extract_pool
+from .session import get_retry
+
+# default async settings
+_CONCURRENCY = 100
+_LIMIT_PER_HOST = 4
+
+logger = get_task_logger(__name__)
+
+
+class AsyncHTTPSource(HTTPSource):
+    """HTTP source which can be fetched on an event loop.
+
+    The request is built with the same hooks as :class:`HTTPSource`
+    (:meth:`get_req`, :meth:`get_url`, :meth:`get_headers`...) and the
+    synchronous :meth:`scrape` is still available.
+    """
+    #: errors raised while reading a streamed response body
+    read_errors = HTTPSource.read_errors + (asyncio.TimeoutError, ) + (
+        () if aiohttp is None else (aiohttp.ClientError, ))
+
+    async def scrape_async(self, session, force=False, executor=None):
+        """Asynchronous counterpart of :meth:`scrape`.
+
+        :param session: client session shared by the driver
+        :type session: aiohttp.ClientSession
+        :param force: scrape even if the circuit breaker is open
+        :type force: bool
+        :param executor: (optional) process pool running the extraction
+        :type executor: concurrent.futures.Executor
+        """
+        loop = asyncio.get_running_loop()
+        go_on = await loop.run_in_executor(None, self.prepare_scrape, force)
+        if not go_on:
+            return
+        start = time.time()
+        src_content = await self.fetch_async(session)
+        self._latency = time.time() - start
+        future = await loop.run_in_executor(
+            None, functools.partial(self.process, src_content,
+                                    executor=executor))
+        await _finish(self, future)
+
+    async def fetch_async(self, session):
+        """Asynchronous counterpart of :meth:`fetch`.
+
+        :param session: client session shared by the driver
+        :type session: aiohttp.ClientSession
+        :returns: content - a file-like object
+        """
+        req = self.get_req()
+        res = await self.send_async(session, req)
+
+        if res is None:
+            self._info = None
+            self._statuscode = None
+            return None
+
+        self._info = res.headers
+        self._statuscode = res.status
+
+        if self._statuscode == 304:
+            self.log_info("Fetched content is not modified; skipping ...")
+            res.release()
+            return None
+
+        if (self._statuscode == 200 and
+                res.headers.get('Content-Length') == '0'):
+            self.log_warning("Fetched content is empty; skipping cache ...")
+            res.release()
+            return None
+
+        return await self.post_fetch_async(res)
+
+    async def send_async(self, session, req, timeout=None):
+        """Send a :class:`Request <requests.Request>` with an aiohttp session.
+
+        Retries follow the ``HTTP`` setting with the retry strategy of the
+        sessions of :meth:`send`, backoff and ``Retry-After`` included. Any
+        type of error (status code not 2xx or exceptions) will be handled
+        here and the coroutine then returns ``None``. The body of the
+        returned response is left to read.
+
+        :param session: client session shared by the driver
+        :type session: aiohttp.ClientSession
+        :param req: :class:`Request <requests.Request>` instance
+        :type req: requests.Request
+        :param timeout: (optional) How long to wait for the server to send data
+            before giving up
+        :type timeout: float
+        :rtype: aiohttp.ClientResponse
+        """
+        if req.url is None:
+            self.log_warning("no URL provided, abort fetch")
+            return None
+
+        if timeout is None:
+            timeout = self.http_timeout
+
+        delay = await asyncio.get_running_loop().run_in_executor(
+            None, self.get_throttle_delay, req.url)
+        if delay > 0:
+            self.log_info("rate limited, waiting {:.2f}s".format(delay))
+            await asyncio.sleep(delay)
+
+        prepped = req.prepare()
+        retry = get_retry()
+        while True:
+            res = None
+            error = None
+            try:
+                # the connection goes back to the pool once the body is read
+                # or the response released
+                res = await session.request(
+                    prepped.method,
+                    prepped.url,
+                    headers=dict(prepped.headers),
+                    data=prepped.body,
+                    ssl=None if self.ssl_verify else False,
+                    timeout=aiohttp.ClientTimeout(total=timeout))
+            except asyncio.TimeoutError as e:
+                self.log_error("fetch error: timeout ({})".format(req.url))
+                error = e
+            except aiohttp.ClientError as e:
+                self.log_error("fetch error: {} ({})".format(e, req.url))
+                error = e
+            else:
+                if not retry.is_retry(prepped.method, res.status,
+                                      'Retry-After' in res.headers):
+                    break
+                self.log_warning("fetch retry: status {} ({})".format(
+                    res.status, req.url))
+                res.release()
+            # the retries are counted and delayed by urllib3, from the
+            # status and headers of the response
+            response = None
+            if res is not None:
+                response = HTTPResponse(headers=list(res.headers.items()),
+                                        status=res.status,
+                                        request_method=prepped.method,
+                                        preload_content=False)
+            try:
+                retry = retry.increment(prepped.method, prepped.url,
+                                        response=response, error=error)
+            except MaxRetryError:
+                self.log_error("fetch failed after retries ({})"
+                               .format(req.url))
+                return None
+            await asyncio.sleep(get_retry_delay(retry, response))
+
+        if res.status == 304:
+            self.log_info("fetch success: {}".format(res.status))
+            return res
+
+        if res.status != 200:
+            self.log_error("fetch error: status {} ({})".format(
+                res.status, req.url))
+            res.release()
+            return None
+
+        self.log_info("fetch success: {}".format(res.status))
+        return res
+
+    async def post_fetch_async(self, response):
+        if self.stream:
+            # the body is read by the file cache, in a thread of the executor
+            return StreamedBody(response, asyncio.get_running_loop())
+        return io.BytesIO(await response.read())
+
+
+class StreamedBody(object):
+    """Blocking file-like view of the body of an aiohttp response.
+
+    The body is read chunk by chunk from the event loop
+    (``response.content.iter_chunked()``), it is meant to be read from
+    another thread, e.g. by :meth:`openkongqi.filecache.FileCache.set` in a
+    thread of the executor, while the loop runs.
+
+    :param response: response whose body is left to read
+    :type response: aiohttp.ClientResponse
+    :param loop: event loop of the response
+    :type loop: asyncio.AbstractEventLoop
+    """
+
+    def __init__(self, response, loop):
+        self._response = response
+        self._loop = loop
+        self._chunks = response.content.iter_chunked(CHUNK_SIZE)
+
+    def read(self, size=-1):
+        """Return the next chunk of the body, an empty one at its end.
+
+        Chunks are at most ``CHUNK_SIZE`` bytes, whatever ``size``.
+        """
+        return asyncio.run_coroutine_threadsafe(self._read_chunk(),
+                                                self._loop).result()
+
+    async def _read_chunk(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._response.release)
+
+
+def get_retry_delay(retry, response=None):
+    """Return the delay before the next retry, as
+    :meth:`urllib3.util.retry.Retry.sleep` would sleep it: the
+    ``Retry-After`` header of the response if any, otherwise the backoff.
+
+    :param retry: retry strategy, once incremented
+    :type retry: urllib3.util.retry.Retry
+    :param response: (optional) the response retried
+    :type response: urllib3.response.HTTPResponse
+    :returns: float - delay in seconds
+    """
+    if retry.respect_retry_after_header and response is not None:
+        retry_after = retry.get_retry_after(response)
+        if retry_after:
+            return retry_after
+    return retry.get_backoff_time()
+
+
+async def scrape_many(names, concurrency=None, limit_per_host=None):
+    """Scrape sources concurrently.
+
+    Errors are logged and isolated, one failing source doesn't stop the
+    others. When ``EXTRACT_WORKERS`` is set, extractions run in a process
+    pool.
+
+    :param names: source names as used in the configuration
+    :type names: list of str
+    :param concurrency: maximum number of sources scraped at the same time
+    :type concurrency: int
+    :param limit_per_host: maximum number of sources scraped at the same time
+        on a given host
+    :type limit_per_host: int
+    :returns: dict - success of the scrape per source name
+    """
+    if aiohttp is None:
+        raise ImportError("aiohttp is required by the asynchronous engine "
+                          "(pip install openkongqi[async])")
+    async_settings = settings.get('ASYNC', {})
+    if concurrency is None:
+        concurrency = async_settings.get('CONCURRENCY', _CONCURRENCY)
+    if limit_per_host is None:
+        limit_per_host = async_settings.get('LIMIT_PER_HOST', _LIMIT_PER_HOST)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    host_semaphores = {}
+    pool = get_extract_pool()
+    connector = aiohttp.TCPConnector(limit=concurrency,
+                                     limit_per_host=limit_per_host)
+    # the session is shared by all the sources, cookies are not kept
+    async with aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar()) as session:
+        results = await asyncio.gather(*[
+            _scrape_one(name, session, semaphore, host_semaphores,
+                        limit_per_host, pool)
+            for name in names
+        ])
+    return dict(zip(names, results))
+
+
+async def _scrape_one(name, session, semaphore, host_semaphores,
+                      limit_per_host, pool):
+    target = settings['SOURCES'].get(name, {}).get('target') or ''
+    host = urlparse(target).netloc
+    if host not in host_semaphores:
+        host_semaphores[host] = asyncio.Semaphore(limit_per_host)
+    # wait for the host slot first to not hold a global slot meanwhile
+    async with host_semaphores[host], semaphore:
+        try:
+            src = get_source(name)
+            if isinstance(src, AsyncHTTPSource):
+                await src.scrape_async(session, executor=pool)
+            else:
+                loop = asyncio.get_running_loop()
+                future = await loop.run_in_executor(
+                    None, functools.partial(src.scrape, executor=pool))
+                await _finish(src, future)
+        except Exception:
+            logger.exception("{} - scrape failed".format(name))
+            return False
+    return True
+
+
+async def _finish(src, future):
+    """Wait for an extraction submitted to the process pool, then save its
+    data.
+    """
+    if future is None:
+        return
+    data = await asyncio.wrap_future(future)
+    await asyncio.get_running_loop().run_in_executor(
+        None, src.save_content, data)
+
+
+def run(names, concurrency=None, limit_per_host=None):
+    """Run :func:`scrape_many` on a new event loop.
+
+    The blocking stages run in a thread pool sized after the concurrency.
+    """
+    if concurrency is None:
+        concurrency = settings.get('ASYNC', {}).get('CONCURRENCY',
+                                                    _CONCURRENCY)
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    try:
+        return loop.run_until_complete(
+            scrape_many(names, concurrency=concurrency,
+                        limit_per_host=limit_per_host))
+    finally:
+        loop.close()
+        executor.shutdown()
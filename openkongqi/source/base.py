@@ -1,27 +1,33 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
 import logging
-import os
 import re
-from urllib3.util.retry import Retry
-from urllib3.exceptions import MaxRetryError
+import time
+from urllib.parse import urlparse
 
 from celery.utils.log import get_task_logger
 import requests
+import urllib3
 
 from ..apikeys import get_api_key
-from ..conf import settings, statusdb, recsdb, file_cache
+from ..conf import settings, statusdb, cachedb, recsdb, file_cache
 from ..exceptions import SourceError
 from ..stations import get_station_map
-from ..utils import get_rnd_item, get_uuid
+from ..utils import get_rnd_item, get_uuid, parse_rate
+from .pool import extract_cached
+from .session import get_session
 
 import pytz
 
 
 logger = get_task_logger(__name__)
 
+_RATELIMIT_KEY = 'okq:ratelimit:{host}'
+_RATELIMIT_BURST = 1
+_STATUS_TS_FMT = '%Y%m%d%H%M%S'
+
 
 class BaseSource(object):
     """Base source class to scrape online resources. This class is to be used
@@ -33,7 +39,24 @@ class BaseSource(object):
     """
 
     key_context = None
+    #: parser backend used by :meth:`extract`, can be overridden with the
+    #: ``parser`` key of the source definition
+    parser = None
+    #: consecutive fetch failures opening the circuit
+    circuit_threshold = 5
+    #: seconds before probing an open circuit, doubled on each failed probe
+    circuit_backoff = 60
+    #: maximum seconds before probing an open circuit
+    circuit_max_backoff = 60 * 60
     _now = None
+    _last_status = None
+    _latency = None
+    #: errors raised while reading the fetched content, the fetch is then
+    #: considered failed
+    read_errors = ()
+    _digest = None
+    _written = False
+    _failed = False
 
     def __init__(self, name):
         """
@@ -50,13 +73,16 @@ class BaseSource(object):
         self._tz = pytz.timezone(settings['SOURCES'][name]['tz'])
         self._status = statusdb
         self._cache = file_cache
+        self._cachedb = cachedb
         self._records = recsdb
 
-    def scrape(self):
+    def scrape(self, force=False, executor=None):
         """Main entry point for :class:`openkongqi.source.BaseSource` instances.
 
         Orchestrates the resource scraping, following actions are performed:
 
+        * :meth:`openkongqi.source.BaseSource.prepare_scrape`: load the status
+          saved by the previous scrape and check the circuit breaker
         * :meth:`openkongqi.source.BaseSource.fetch`: fetch online resource
         * :meth:`openkongqi.source.BaseSource.save_status`: save fetching
           status
@@ -65,14 +91,121 @@ class BaseSource(object):
         * :meth:`openkongqi.source.BaseSource.extract`: extract the data
           from the resource
         * :meth:`openkongqi.source.BaseSource.save_data`: save extracted data
+
+        When :meth:`openkongqi.source.BaseSource.fetch` returns ``None`` (fetch
+        error, empty or unchanged resource), only the status is saved.
+
+        With an ``executor``, the extraction is submitted to it with the path
+        of the cached content and the scrape returns without waiting, see
+        :meth:`openkongqi.source.BaseSource.process`.
+
+        :param force: scrape even if the circuit breaker is open
+        :type force: bool
+        :param executor: (optional) process pool running the extraction
+        :type executor: concurrent.futures.Executor
+        :returns: ``None`` or a future of the extracted data
         """
-        self._now = datetime.now(pytz.utc)
+        if not self.prepare_scrape(force=force):
+            return None
+        start = time.time()
         src_content = self.fetch()
-        self.save_status()
-        if src_content is not None:
+        self._latency = time.time() - start
+        return self.process(src_content, executor=executor)
+
+    def prepare_scrape(self, force=False):
+        """Load the previous status and check the circuit breaker.
+
+        After :attr:`circuit_threshold` consecutive fetch failures the circuit
+        opens and scrapes are skipped until the backoff delay is over. The
+        next scrape is then a probe (half-open circuit): a success closes the
+        circuit, a failure opens it again for twice as long.
+
+        :param force: scrape even if the circuit is open
+        :type force: bool
+        :returns: bool - whether the scrape should go on
+        """
+        self._now = datetime.now(pytz.utc)
+        self._digest = None
+        self._written = False
+        self._failed = False
+        self._last_status = self.load_status()
+        if self._last_status is None or force:
+            return True
+        if self._last_status.get('circuit') == 'open':
+            retry_at = pytz.utc.localize(datetime.strptime(
+                self._last_status['retry-at'], _STATUS_TS_FMT))
+            if self._now < retry_at:
+                self.log_debug("circuit open until {}; skipping ..."
+                               .format(retry_at))
+                return False
+            self.log_info("circuit half-open; probing ...")
+        return True
+
+    def process(self, src_content, executor=None):
+        """Run the stages following the fetch: cache the content if there is
+        any, save the status then extract and save the content.
+
+        Extraction and saving are skipped when the content is byte-identical
+        to the content of the previous scrape. The digest of the content is
+        only saved in the status once its data is saved, see
+        :meth:`openkongqi.source.BaseSource.save_content`.
+
+        With an ``executor``, the path of the cached content is submitted to
+        it for extraction and the future of the extracted data is returned
+        right away; the caller goes on and later passes the future to
+        :meth:`openkongqi.source.BaseSource.finish`.
+
+        :param src_content: fetched content or ``None``
+        :type src_content: file-like object
+        :param executor: (optional) process pool running the extraction
+        :type executor: concurrent.futures.Executor
+        :returns: ``None`` or a future of the extracted data
+        """
+        if src_content is None:
+            self.save_status()
+            return None
+        try:
             content = self.cache(src_content)
+        except self.read_errors as e:
+            self.log_error("fetch error: reading content failed ({})"
+                           .format(e))
+            self._failed = True
+            self.save_status()
+            return None
+        with content:
+            if self.is_unchanged():
+                # the data of this content is already saved
+                self._written = True
+                self.save_status()
+                self.log_info("Fetched content is unchanged; skipping ...")
+                return None
+            self.save_status()
+            if executor is not None:
+                return executor.submit(extract_cached, self.name,
+                                       content.name)
             data = self.extract(content)
-            self.save_data(data)
+        self.save_content(data)
+        return None
+
+    def finish(self, future):
+        """Save the data of an extraction submitted by
+        :meth:`openkongqi.source.BaseSource.process`.
+
+        :param future: future of the extracted data
+        :type future: concurrent.futures.Future
+        """
+        self.save_content(future.result())
+
+    def save_content(self, data):
+        """Save the extracted data, then the status with the digest of the
+        content it was extracted from.
+
+        If saving the data fails, the previous digest is kept and the next
+        scrape of the same content extracts and saves it again.
+        """
+        self.save_data(data)
+        self._written = True
+        self.save_status()
 
     def fetch(self):
         """Fetch the resource
@@ -108,6 +241,73 @@ class BaseSource(object):
         """
         return dict()
 
+    def has_failed(self):
+        """Return whether the last fetch failed, used by the circuit
+        breaker.
+        """
+        return self._failed
+
+    def is_unchanged(self):
+        """Return whether the cached content has the same digest as the
+        content of the previous scrape.
+        """
+        return (self._digest is not None and
+                self._last_status is not None and
+                self._last_status.get('digest') == self._digest)
+
+    def get_content_data(self):
+        """Get the digest of the cached content.
+
+        The digest of the previous scrape is kept when nothing was cached
+        (fetch error, empty or not modified resource) or until the data of
+        the cached content is saved.
+
+        :returns: data - a dict with data to serialize in the status entry
+        """
+        data = {}
+        if self._digest is not None:
+            data['unchanged'] = self.is_unchanged()
+        if self._digest is not None and self._written:
+            data['digest'] = self._digest
+        elif self._last_status is not None and \
+                self._last_status.get('digest'):
+            data['digest'] = self._last_status['digest']
+        return data
+
+    def get_circuit_data(self):
+        """Get the circuit breaker state following the last fetch.
+
+        :returns: data - a dict with data to serialize in the status entry
+        """
+        failures = 0
+        if self.has_failed():
+            failures = 1
+            if self._last_status is not None:
+                failures += self._last_status.get('failures', 0)
+        data = {
+            'failures': failures,
+            'circuit': 'closed',
+        }
+        if self._latency is not None:
+            data['latency'] = round(self._latency, 3)
+        if failures >= self.circuit_threshold:
+            exponent = failures - self.circuit_threshold
+            backoff = min(self.circuit_backoff * 2 ** exponent,
+                          self.circuit_max_backoff)
+            data['circuit'] = 'open'
+            data['retry-at'] = (self._now + timedelta(seconds=backoff)) \
+                .strftime(_STATUS_TS_FMT)
+            self.log_warning("circuit open after {} failures, retry in {}s"
+                             .format(failures, backoff))
+        return data
+
+    def load_status(self):
+        """Load the status saved by the previous scrape.
+
+        :returns: data - the status entry or ``None``
+        """
+        return self._status.get_status(self.name)
+
     def save_status(self):
         """Save status data to keep track of fetching history.
 
@@ -116,9 +316,11 @@ class BaseSource(object):
         """
         data = self.get_status_data()
         if data is None:
-            data = {'ts': self._now.strftime('%Y%m%d%H%M%S')}
+            data = {'ts': self._now.strftime(_STATUS_TS_FMT)}
         else:
-            data.setdefault('ts', self._now.strftime('%Y%m%d%H%M%S'))
+            data.setdefault('ts', self._now.strftime(_STATUS_TS_FMT))
+        data.update(self.get_circuit_data())
+        data.update(self.get_content_data())
         self._status.set_status(self.name, data)
 
     def cache(self, content):
@@ -126,13 +328,16 @@ class BaseSource(object):
 
         :param content: content to cache
         :type content: file-like object
+        :returns: content - the cached file opened for reading
         """
-        self._cache.set(self.name, content, self._now)
-        fp = self._cache.get_fp(self.name, self._now)
+        try:
+            fd, size, self._digest = self._cache.set(self.name, content,
+                                                     self._now)
+        finally:
+            content.close()
         # display how much is cached into server
-        self.log_info("Cached {} kilobytes to server."
-                    .format(os.path.getsize(fp)))
-        return open(fp, 'rb')
+        self.log_info("Cached {} bytes to server.".format(size))
+        return fd
 
     def pythonify(self, text, is_num=False):
         if text is None:
@@ -158,10 +363,25 @@ class BaseSource(object):
             else:
                 return text
 
+    def get_parser(self):
+        """Return the name of the parser backend of this source."""
+        return settings['SOURCES'][self.name].get('parser', self.parser)
+
     def extract(self, content):
         """Extract data from the content
+
+        Dispatched to the ``extract_<parser>`` method matching
+        :meth:`get_parser`, sources with a single parser can overwrite this
+        method directly.
         """
-        raise NotImplementedError
+        parser = self.get_parser()
+        if parser is None:
+            raise NotImplementedError
+        try:
+            method = getattr(self, 'extract_{}'.format(parser))
+        except AttributeError:
+            raise SourceError("Unknown parser ({})".format(parser))
+        return method(content)
 
     def save_data(self, data, ignore_check_latest=False):
         self._records.write_records(data,
@@ -205,7 +425,17 @@ class HTTPSource(BaseSource):
     http_timeout = 10
     #: SSL Verification
     ssl_verify = True
-
+    #: Send conditional requests based on the previous status
+    conditional_get = True
+    #: Stream the response body into the cache instead of loading it in memory
+    stream = True
+    #: errors raised while reading a streamed response body
+    read_errors = (
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ContentDecodingError,
+        requests.exceptions.ConnectionError,
+        urllib3.exceptions.HTTPError,
+    )
 
     def __init__(self, name):
         super(HTTPSource, self).__init__(name)
@@ -222,6 +452,11 @@ class HTTPSource(BaseSource):
         self._info = res.headers
         self._statuscode = res.status_code
 
+        if self._statuscode == requests.codes.not_modified:
+            self.log_info("Fetched content is not modified; skipping ...")
+            res.close()
+            return None
+
         try:
             # don't use `resp.headers.get('content-length`)
             # because if it doesn't exist in headers it will return None
@@ -232,6 +467,7 @@ class HTTPSource(BaseSource):
         else:
             if (self._statuscode == 200 and content_length == '0'):
                 self.log_warning("Fetched content is empty; skipping cache ...")
+                res.close()
                 return None
 
         return self.post_fetch(res)
@@ -255,23 +491,17 @@ class HTTPSource(BaseSource):
         if timeout is None:
             timeout = self.http_timeout
 
-        retry_count = 3
-        retry_strategy = Retry(
-            total=retry_count,
-            status_forcelist=[413, 429, 500, 502, 503, 504],
-        )
-        adapter = requests.adapters.HTTPAdapter(max_retries=retry_strategy)
-        s = requests.Session()
-        s.mount("https://", adapter)
-        s.mount("http://", adapter)
+        self.throttle(req.url)
 
-        s = requests.Session()
+        # pooled session, connections are kept alive between scrapes
+        s = get_session(req.url)
         prepped = s.prepare_request(req)
 
         try:
-            res = s.send(prepped, timeout=timeout, verify=self.ssl_verify)
-        except MaxRetryError:
-            self.log_error("fetch failed after {} retries".format(retry_count))
+            res = s.send(prepped, timeout=timeout, verify=self.ssl_verify,
+                         stream=self.stream)
+        except requests.exceptions.RetryError:
+            self.log_error("fetch failed after retries ({})".format(req.url))
             return None
         except requests.Timeout as e:
             self.log_error("fetch error: timeout ({})".format(e.request.url))
@@ -280,6 +510,10 @@ class HTTPSource(BaseSource):
             self.log_error("fetch error: {}".format(e.request.url))
             return None
 
+        if res.status_code == requests.codes.not_modified:
+            self.log_info("fetch success: {}".format(res.status_code))
+            return res
+
         if res.status_code != requests.codes.ok:
             self.log_error("fetch error: status {} ({})".format(
                     res.status_code,
@@ -289,14 +523,59 @@ class HTTPSource(BaseSource):
             self.log_debug(res.text)
             return
 
-        s.close()
-
         self.log_info("fetch success: {}".format(res.status_code))
-        self.log_debug(res.text)
+        if not self.stream:
+            self.log_debug(res.text)
 
         return res
 
+    def get_throttle_delay(self, url):
+        """Reserve a request on the host of ``url`` with the rate limiter
+        shared by all the workers.
+
+        The limit is set with the ``ratelimit`` key of the source definition,
+        either a rate string or a dict with a ``rate`` and a ``burst`` size:
+
+        .. code:: json
+
+            {
+              "shanghai": {
+                "target": "http://pm25.in/shanghai",
+                "ratelimit": {"rate": "10/m", "burst": 2}
+              }
+            }
+
+        The bucket is keyed by host, sources sharing a host should have the
+        same limit.
+
+        :param url: target URL
+        :type url: str
+        :returns: float - how long to wait in seconds before sending
+        """
+        ratelimit = settings['SOURCES'][self.name].get('ratelimit')
+        if ratelimit is None:
+            return 0
+        if not isinstance(ratelimit, dict):
+            ratelimit = {'rate': ratelimit}
+        key = _RATELIMIT_KEY.format(host=urlparse(url).netloc)
+        return self._cachedb.take_token(
+            key,
+            parse_rate(ratelimit['rate']),
+            ratelimit.get('burst', _RATELIMIT_BURST))
+
+    def throttle(self, url):
+        """Wait until the rate limit of the target host allows a request."""
+        delay = self.get_throttle_delay(url)
+        if delay > 0:
+            self.log_info("rate limited, waiting {:.2f}s".format(delay))
+            time.sleep(delay)
+
     def post_fetch(self, response):
+        if self.stream:
+            # read the body from the socket as it is written in the cache,
+            # decoding any content encoding on the way
+            response.raw.decode_content = True
+            return response.raw
         # The Bytes stream is required for the caching operations
         # response.content is a bytes string
         return io.BytesIO(response.content)
@@ -312,6 +591,8 @@ class HTTPSource(BaseSource):
             params=self.get_params(**kwargs),
             headers=self.get_headers(**kwargs),
         )
+        if self.conditional_get:
+            req.headers.update(self.get_conditional_headers())
         return req
 
     def get_url(self, **kwargs):
@@ -335,10 +616,39 @@ class HTTPSource(BaseSource):
         }
         return headers
 
+    def has_failed(self):
+        return self._failed or self._statuscode is None
+
+    def get_conditional_headers(self):
+        """Return the validators of the previous scrape as conditional
+        request headers.
+        """
+        headers = {}
+        if self._last_status is None:
+            return headers
+        if self._last_status.get('last-modified'):
+            headers['If-Modified-Since'] = self._last_status['last-modified']
+        if self._last_status.get('etag'):
+            headers['If-None-Match'] = self._last_status['etag']
+        return headers
+
     def get_status_data(self):
         data = {
             'code': self._statuscode
         }
-        if self._info is not None and 'Last-Modified' in self._info:
-            data['last-modified'] = self._info['Last-Modified']
+        # validators of a content are only kept once its data is saved,
+        # otherwise a failed write would turn the next fetch into a 304
+        pending = self._failed or (self._digest is not None and
+                                   not self._written)
+        if self._info is not None and not pending:
+            if 'Last-Modified' in self._info:
+                data['last-modified'] = self._info['Last-Modified']
+            if 'ETag' in self._info:
+                data['etag'] = self._info['ETag']
+        # a 304 response may omit the validators, keep the previous ones
+        if ((self._statuscode == requests.codes.not_modified or pending) and
+                self._last_status is not None):
+            for key in ('last-modified', 'etag'):
+                if key not in data and self._last_status.get(key):
+                    data[key] = self._last_status[key]
         return data
@@ -7,15 +7,22 @@ import re
 
 from celery.utils.log import get_task_logger
 
-from .base import HTTPSource
+from .aio import AsyncHTTPSource
 
 import bs4
+from bs4.dammit import EncodingDetector
+import lxml.html
 
 
 logger = get_task_logger(__name__)
 
+# rows of the data table, skipping the header
+_ROWS_XPATH = "(//*[@id='detail-data']//tr)[position() > 1]"
+_TIME_XPATH = ("//*[contains(concat(' ', normalize-space(@class), ' '),"
+               " ' live_data_time ')]/p")
 
-class Source(HTTPSource):
+
+class Source(AsyncHTTPSource):
     """Source class for pm25.in providing China environment data
 
     Extract data from http://pm25.in/, data table rows are as follow:
@@ -31,6 +38,9 @@ class Source(HTTPSource):
     * 8 - O3 (1h average)
     * 9 - O3 (8h average)
     * 10 - SO2
+
+    Two parser backends are available, ``lxml`` (default) and the slower
+    ``html5lib``, both give the same output.
     """
 
     key_context = {
@@ -38,35 +48,71 @@ class Source(HTTPSource):
     }
     #: regexp matching null characters
     null_re = re.compile(r'_')
+    parser = 'lxml'
 
-    def extract(self, content):
+    def extract_html5lib(self, content):
         # Avoid warnings of bs4>=4.4 by explicitly stating parser
         soup = bs4.BeautifulSoup(content, "html5lib")
         time = soup.find(class_="live_data_time").p.text
-        ts = datetime.strptime(time.split(u'\uff1a')[1],
-                               '%Y-%m-%d %H:%M:%S').replace(tzinfo=self._tz)
+        ts = self.parse_time(time)
         data = {}
         for row in soup.find(id='detail-data').find_all('tr')[1:]:
-            cells = row.find_all('td')
-            try:
-                station = self.get_station_uuid(cells[0].string)
-                data[station] = []
-            except KeyError as e:
-                logger.warning("Station not found ({}); skipping ..."
-                               .format(e.message))
-            else:
-                data[station].append(
-                    {
-                        'ts': ts,
-                        'fields': {
-                            'pm25': self.pythonify(cells[4].string, is_num=True),
-                            'pm10': self.pythonify(cells[5].string, is_num=True),
-                            'co': self.pythonify(cells[6].string, is_num=True),
-                            'no2': self.pythonify(cells[7].string, is_num=True),
-                            'o3_1h': self.pythonify(cells[8].string, is_num=True),
-                            'o3_8h': self.pythonify(cells[9].string, is_num=True),
-                            'so2': self.pythonify(cells[10].string, is_num=True),
-                        },
-                    }
-                )
+            cells = [cell.string for cell in row.find_all('td')]
+            self.add_row(data, ts, cells)
+        return data
+
+    def extract_lxml(self, content):
+        if hasattr(content, 'read'):
+            content = content.read()
+        parser = None
+        if isinstance(content, bytes):
+            # libxml2 ignores html5 `<meta charset>` declarations
+            encoding = EncodingDetector.find_declared_encoding(
+                content, is_html=True)
+            parser = lxml.html.HTMLParser(encoding=encoding or 'utf-8')
+        doc = lxml.html.document_fromstring(content, parser=parser)
+        time = doc.xpath(_TIME_XPATH)[0].text_content()
+        ts = self.parse_time(time)
+        data = {}
+        for row in doc.xpath(_ROWS_XPATH):
+            cells = [_string(cell) for cell in row.iter('td')]
+            self.add_row(data, ts, cells)
         return data
+
+    def parse_time(self, time):
+        return datetime.strptime(time.split(u'\uff1a')[1],
+                                 '%Y-%m-%d %H:%M:%S').replace(tzinfo=self._tz)
+
+    def add_row(self, data, ts, cells):
+        try:
+            station = self.get_station_uuid(cells[0])
+            data[station] = []
+        except KeyError as e:
+            logger.warning("Station not found ({}); skipping ...".format(e))
+        else:
+            data[station].append(
+                {
+                    'ts': ts,
+                    'fields': {
+                        'pm25': self.pythonify(cells[4], is_num=True),
+                        'pm10': self.pythonify(cells[5], is_num=True),
+                        'co': self.pythonify(cells[6], is_num=True),
+                        'no2': self.pythonify(cells[7], is_num=True),
+                        'o3_1h': self.pythonify(cells[8], is_num=True),
+                        'o3_8h': self.pythonify(cells[9], is_num=True),
+                        'so2': self.pythonify(cells[10], is_num=True),
+                    },
+                }
+            )
+
+
+def _string(element):
+    """Return the only string of an element, like ``bs4.Tag.string``.
+
+    ``None`` is returned if the element has no text or more than one child.
+    """
+    if len(element) == 0:
+        return element.text
+    if len(element) == 1 and not element.text and not element[0].tail:
+        return _string(element[0])
+    return None
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool running the CPU-bound extraction of the sources.
+
+The pool is bounded by the ``EXTRACT_WORKERS`` setting and created lazily
+once per worker process. Its processes are started by a fork server rather
+than forked from the worker, which may run threads (asynchronous engine,
+``threads`` pool) holding locks a forked child would inherit. The settings
+of the worker are passed to each pool process when it starts.
+
+.. note:: celery's prefork workers can't have children, use the pool with
+    the ``solo`` or ``threads`` worker pools, or with the asynchronous
+    engine.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+
+from ..conf import settings
+
+_pools = {}
+
+
+def get_extract_pool():
+    """Return the extraction pool of the current process.
+
+    :returns: concurrent.futures.ProcessPoolExecutor or ``None`` if
+        extraction runs inline (``EXTRACT_WORKERS`` is 0)
+    """
+    workers = settings.get('EXTRACT_WORKERS', 0)
+    if not workers:
+        return None
+    pid = os.getpid()
+    if pid not in _pools:
+        _pools[pid] = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(get_start_method()),
+            initializer=init_extract_process,
+            initargs=(dict(settings), ))
+    return _pools[pid]
+
+
+def get_start_method():
+    """Return the start method of the pool processes, ``forkserver`` where
+    available, ``spawn`` otherwise. Neither forks the calling process.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+
+def init_extract_process(worker_settings):
+    """Configure a pool process with the settings of its worker.
+
+    Only the settings are needed by the extraction, the databases are left
+    unconfigured.
+
+    :param worker_settings: settings of the worker
+    :type worker_settings: dict
+    """
+    settings.update(worker_settings)
+
+
+def shutdown_extract_pool():
+    """Shut the extraction pool of the current process down."""
+    pool = _pools.pop(os.getpid(), None)
+    if pool is not None:
+        pool.shutdown()
+
+
+def extract_cached(name, fpath):
+    """Extract the data of a cached resource, run in the pool processes.
+
+    :param name: source name as used in the configuration
+    :type name: str
+    :param fpath: path of the cached content
+    :type fpath: str
+    :returns: data - the extracted data
+    """
+    from ..utils import get_source
+    src = get_source(name)
+    with open(fpath, 'rb') as content:
+        return src.extract(content)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Pooled HTTP sessions shared by the HTTP sources.
+
+One :class:`requests.Session` is kept per worker process and per target host
+so that connections (and TLS handshakes) are reused between scrapes. The
+connection pool and the retry policy are configured with the ``HTTP``
+setting.
+
+Sessions are shared by the sources of a host, they reject cookies so that
+no source sends the cookies set on another one.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from http.cookiejar import DefaultCookiePolicy
+import os
+from urllib.parse import urlparse
+
+import requests
+from urllib3.util.retry import Retry
+
+from ..conf import settings
+
+# default HTTP settings
+_POOL_CONNECTIONS = 10
+_POOL_MAXSIZE = 10
+_POOL_BLOCK = False
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF_FACTOR = 0.3
+_RETRY_STATUS_FORCELIST = [413, 429, 500, 502, 503, 504]
+
+_sessions = {}
+
+
+def get_retry(http_settings=None):
+    """Return the retry strategy used by the pooled sessions.
+
+    :param http_settings: HTTP settings, defaults to ``settings['HTTP']``
+    :type http_settings: dict
+    :rtype: urllib3.util.retry.Retry
+    """
+    if http_settings is None:
+        http_settings = settings.get('HTTP', {})
+    return Retry(
+        total=http_settings.get('RETRY_TOTAL', _RETRY_TOTAL),
+        backoff_factor=http_settings.get('RETRY_BACKOFF_FACTOR',
+                                         _RETRY_BACKOFF_FACTOR),
+        status_forcelist=http_settings.get('RETRY_STATUS_FORCELIST',
+                                           _RETRY_STATUS_FORCELIST),
+    )
+
+
+def create_session(http_settings=None):
+    """Create a session with a pooled adapter mounted for http and https.
+
+    :param http_settings: HTTP settings, defaults to ``settings['HTTP']``
+    :type http_settings: dict
+    :rtype: requests.Session
+    """
+    if http_settings is None:
+        http_settings = settings.get('HTTP', {})
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=http_settings.get('POOL_CONNECTIONS',
+                                           _POOL_CONNECTIONS),
+        pool_maxsize=http_settings.get('POOL_MAXSIZE', _POOL_MAXSIZE),
+        pool_block=http_settings.get('POOL_BLOCK', _POOL_BLOCK),
+        max_retries=get_retry(http_settings),
+    )
+    s = requests.Session()
+    # no domain is allowed, cookies are neither stored nor sent
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_session(url):
+    """Return the pooled session for the host of ``url``.
+
+    Sessions are keyed by process id as well, a forked worker never reuses
+    the sockets opened by its parent.
+
+    :param url: target URL
+    :type url: str
+    :rtype: requests.Session
+    """
+    parsed = urlparse(url)
+    key = (os.getpid(), parsed.scheme, parsed.netloc)
+    try:
+        return _sessions[key]
+    except KeyError:
+        s = _sessions[key] = create_session()
+        return s
+
+
+def close_sessions():
+    """Close and forget all the sessions of the current process."""
+    pid = os.getpid()
+    for key in list(_sessions):
+        if key[0] == pid:
+            _sessions.pop(key).close()
@@ -39,5 +39,9 @@ class StatusWrapper(BaseStatusWrapper):
 
         :param name: the name as found in `settings.SOURCES`
         :type name: str
+        :returns: the status data or ``None`` if there is no status yet
         """
-        return json.loads(self._cnx.get(_STATUS_KEY.format(name=name)))
+        data = self._cnx.get(_STATUS_KEY.format(name=name))
+        if data is None:
+            return None
+        return json.loads(data)
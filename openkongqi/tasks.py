@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
 
+import pytz
+
+from . import conf
+from .source.pool import get_extract_pool
 from .utils import get_source
 
 from celery import Celery
@@ -15,3 +20,62 @@ logger = get_task_logger(__name__)
 def scrape(name):
     src = get_source(name)
     src.scrape()
+
+
+@app.task
+def scrape_batch(names):
+    """Scrape several sources in a single task.
+
+    Errors are isolated, a failing source is logged and recorded in its
+    status entry then the batch goes on with the next source.
+
+    When ``EXTRACT_WORKERS`` is set, extractions run in a process pool while
+    the next sources are fetched, their data is saved at the end.
+    """
+    pool = get_extract_pool()
+    pending = []
+    for name in names:
+        try:
+            src = get_source(name)
+            future = src.scrape(executor=pool)
+        except Exception as e:
+            logger.exception("{} - scrape failed".format(name))
+            save_error_status(name, e)
+        else:
+            if future is not None:
+                pending.append((src, future))
+    for src, future in pending:
+        try:
+            src.finish(future)
+        except Exception as e:
+            logger.exception("{} - scrape failed".format(src.name))
+            save_error_status(src.name, e)
+
+
+def save_error_status(name, error):
+    """Record an error in the status entry of a source."""
+    try:
+        data = conf.statusdb.get_status(name) or {}
+    except Exception:
+        logger.exception("{} - status unavailable".format(name))
+        return
+    data['error'] = "{}: {}".format(type(error).__name__, error)
+    data['ts'] = datetime.now(pytz.utc).strftime('%Y%m%d%H%M%S')
+    conf.statusdb.set_status(name, data)
+
+
+@app.task
+def flush_records():
+    """Flush the records queued by the write-behind buffer, to be run
+    periodically so idle queues are flushed as well.
+    """
+    flush = getattr(conf.recsdb, 'flush', None)
+    if flush is not None:
+        flush()
+
+
+@app.task
+def scrape_async(names):
+    # aiohttp is an optional dependency, import only when needed
+    from .source.aio import run
+    run(names)
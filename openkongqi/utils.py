@@ -10,6 +10,8 @@ from .exceptions import ConfigError, SourceError
 SEP = ':'
 WILDCARD = '*'
 
+_RATE_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60}
+
 
 def get_rnd_item(fpath):
     """Get random item from list read from JSON data.
@@ -36,6 +38,31 @@ def get_uuid(*args):
     return SEP.join([frag.replace(SEP + WILDCARD, "") for frag in args])
 
 
+def parse_rate(rate):
+    """Convert a rate string to a number of operations per second.
+
+    The format is the same as celery's: ``"10/m"`` is 10 per minute, the
+    unit can be ``s``, ``m`` or ``h`` and defaults to seconds.
+
+    :param rate: a rate string or number
+    :type rate: str|int|float
+    :returns: float - operations per second
+    :raises ConfigError: if the rate is invalid or not positive
+    """
+    if isinstance(rate, (int, float)):
+        ops_per_sec = float(rate)
+    else:
+        ops, _, unit = rate.partition('/')
+        try:
+            ops_per_sec = float(ops) / _RATE_UNITS[unit.strip() or 's']
+        except (KeyError, ValueError):
+            raise ConfigError("Invalid rate ({})".format(rate))
+    # the token bucket divides by the rate
+    if not ops_per_sec > 0:
+        raise ConfigError("Invalid rate ({})".format(rate))
+    return ops_per_sec
+
+
 def passthrough_loader(base_uuid, data):
     return {base_uuid: data}
 
@@ -18,6 +18,7 @@ requirements = [
     "celery==4.4.7",
     "hiredis==2.0.0",
     "html5lib==1.1",
+    "lxml>=4.6.3",
     "pytz>=2020.5",
     "redis==3.5.3",
     "requests>=2.28.1",
@@ -36,6 +37,11 @@ setup(
     description="Outdoor air quality data",
     long_description=long_description,
     install_requires=requirements,
+    extras_require={
+        'async': ["aiohttp>=3.7.4"],
+        'export': ["pyarrow>=3.0.0"],
+        'tsstore': ["numpy>=1.17"],
+    },
     classifiers=[
         'Development Status :: 1 - Planning',
         'Environment :: Console',
@@ -62,6 +68,9 @@ setup(
         'console_scripts': [
             "okq-server=openkongqi.bin:okq_server",
             "okq-init=openkongqi.bin:okq_init",
+            "okq-migrate=openkongqi.bin:okq_migrate",
+            "okq-export=openkongqi.bin:okq_export",
+            "okq-load=openkongqi.bin:okq_load",
             "okq-source-test=utils.source_test:main",
         ]
     },
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from contextlib import contextmanager
+import io
+import shutil
+import tempfile
+import unittest
+from importlib import import_module
+from unittest import mock
+
+from openkongqi.conf import config_from_object
+from openkongqi.filecache import FileCache
+
+try:
+    import aiohttp
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+except ImportError:     # pragma: no cover
+    aiohttp = None
+
+
+class emptyConf(object):
+    settings = {}
+
+
+@unittest.skipIf(aiohttp is None, "aiohttp is not installed")
+class TestAsyncFetch(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        from openkongqi.source.aio import AsyncHTTPSource
+        pm25in = import_module('openkongqi.source.pm25in')
+        self.assertTrue(issubclass(pm25in.Source, AsyncHTTPSource))
+
+        self.src = pm25in.Source('pm25.in:shanghai')
+        self.requests = []
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _fetch(self, handler, read=None):
+        async def go():
+            app = web.Application()
+            app.router.add_get('/', handler)
+            server = TestServer(app)
+            await server.start_server()
+            try:
+                self.src.target = str(server.make_url('/'))
+                async with aiohttp.ClientSession() as session:
+                    content = await self.src.fetch_async(session)
+                    if read is None or content is None:
+                        return content
+                    # the streamed body is read from another thread
+                    return await asyncio.get_running_loop().run_in_executor(
+                        None, read, content)
+            finally:
+                await server.close()
+        return self.loop.run_until_complete(go())
+
+    def test_resp(self):
+        """Return the body as a file-like object"""
+        async def handler(request):
+            self.requests.append(request)
+            return web.Response(body=b"This is NOT an empty response",
+                                headers={'ETag': '"abc"'})
+
+        body = self._fetch(handler, read=lambda content: content.read())
+        self.assertEqual(body, b"This is NOT an empty response")
+        self.assertEqual(self.src.get_status_data(),
+                         {'code': 200, 'etag': '"abc"'})
+
+    def test_resp_streamed(self):
+        """The body is streamed into the file cache, chunk by chunk"""
+        body = b"0123456789" * 20000
+
+        async def handler(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for i in range(0, len(body), 50000):
+                await response.write(body[i:i + 50000])
+            return response
+
+        def cache(content):
+            self.assertNotIsInstance(content, io.BytesIO)
+            fd, size, _ = cache_.set('key', content)
+            with fd:
+                return size, fd.read()
+
+        cachepath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachepath)
+        cache_ = FileCache(cachepath)
+        self.assertEqual(self._fetch(handler, read=cache),
+                         (len(body), body))
+
+    @contextmanager
+    def _sleep(self, delays):
+        from openkongqi.source import aio
+        sleep = asyncio.sleep
+        get_retry_delay = aio.get_retry_delay
+
+        def record_delay(*args, **kwargs):
+            delays.append(get_retry_delay(*args, **kwargs))
+            return 0
+
+        # the delays are recorded, not slept
+        with mock.patch.object(aio, 'get_retry_delay', record_delay), \
+                mock.patch.object(aio.asyncio, 'sleep',
+                                  lambda delay: sleep(0)):
+            yield
+
+    def test_retry_after(self):
+        """Retries wait for the delay of the Retry-After header"""
+        async def handler(request):
+            self.requests.append(request)
+            if len(self.requests) == 1:
+                return web.Response(status=503, headers={'Retry-After': '7'})
+            return web.Response(body=b"retried")
+
+        delays = []
+        with self._sleep(delays):
+            body = self._fetch(handler, read=lambda content: content.read())
+        self.assertEqual(body, b"retried")
+        self.assertEqual(delays, [7])
+
+    def test_retry_backoff(self):
+        """Retries follow the backoff of the retry strategy, then give up"""
+        async def handler(request):
+            self.requests.append(request)
+            return web.Response(status=503)
+
+        delays = []
+        with self._sleep(delays):
+            self.assertIsNone(self._fetch(handler))
+        # 1 request and 3 retries, the first retry is immediate
+        self.assertEqual(len(self.requests), 4)
+        self.assertEqual(delays, [0, 0.6, 1.2])
+
+    def test_empty_resp(self):
+        """Empty response returns content-length of 0"""
+        async def handler(request):
+            return web.Response(body=b"")
+
+        self.assertIsNone(self._fetch(handler))
+
+    def test_not_modified_resp(self):
+        """Send validators from the last status and skip a 304 response"""
+        async def handler(request):
+            self.requests.append(request)
+            return web.Response(status=304)
+
+        self.src._last_status = {'code': 200, 'etag': '"abc"'}
+        self.assertIsNone(self._fetch(handler))
+        self.assertEqual(self.requests[0].headers['If-None-Match'], '"abc"')
+        self.assertEqual(self.src.get_status_data()['etag'], '"abc"')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytz
+
+from openkongqi.records.base import create_recsdb
+
+from .test_records import DictCache, get_records
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:         # pragma: no cover
+    pa = None
+else:
+    from openkongqi.records import export
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestExport(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+    uuids = ['cn:shanghai:hongkou', 'cn:shanghai:jingan']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+        }, DictCache({}))
+        self.recsdb.db_init()
+        # two months of records
+        self.start = datetime(2016, 7, 31, 20, tzinfo=pytz.utc)
+        for uuid in self.uuids:
+            self.recsdb.write_records(get_records(uuid, self.start, 10),
+                                      context=self.context)
+        self.end = self.start + timedelta(days=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_batches(self):
+        """Batches are split by station, month and size"""
+        batches = list(export.iter_batches(
+            self.recsdb, self.uuids, self.start, self.end,
+            fields=['pm25'], context=self.context, chunk_size=3))
+        self.assertEqual(
+            [(uuid, month, batch.num_rows) for uuid, month, batch in batches
+             if uuid == 'cn:shanghai:hongkou'],
+            [('cn:shanghai:hongkou', '2016-07', 3),
+             ('cn:shanghai:hongkou', '2016-07', 1),
+             ('cn:shanghai:hongkou', '2016-08', 3),
+             ('cn:shanghai:hongkou', '2016-08', 3)])
+        self.assertEqual(batches[0][2].schema.names, ['uuid', 'ts', 'pm25'])
+
+    def test_export_parquet(self):
+        """Records are exported to a partitioned Parquet dataset"""
+        written = export.export_dataset(
+            self.recsdb, self.tmpdir, ['cn:shanghai:hongkou'],
+            self.start, self.end, fields=['pm25', 'pm10'],
+            context=self.context, chunk_size=2)
+        self.assertEqual(written, [
+            os.path.join(self.tmpdir, 'uuid=cn:shanghai:hongkou',
+                         'month={}'.format(month), 'part-0.parquet')
+            for month in ('2016-07', '2016-08')
+        ])
+        table = pq.read_table(written[1])
+        self.assertEqual(table.num_rows, 6)
+        self.assertEqual(table.column('pm10').to_pylist(),
+                         [4.0, 5.0, 6.0, 7.0, 8.0, 9.0])
+
+    def test_export_stream(self):
+        """Records are exported to a single Arrow IPC stream"""
+        sink = pa.BufferOutputStream()
+        count = export.export_stream(self.recsdb, sink, self.uuids,
+                                     self.start, self.end,
+                                     context=self.context)
+        self.assertEqual(count, 20)
+        table = pa.ipc.open_stream(sink.getvalue()).read_all()
+        self.assertEqual(table.num_rows, 20)
+        self.assertEqual(table.column('co').null_count, 20)
+
+    def test_iter_batches_wide(self):
+        """Rows of the wide schema are copied column by column"""
+        recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+            'SCHEMA': 'wide',
+        }, DictCache({}))
+        recsdb.db_init()
+        recsdb.write_records(
+            get_records(self.uuids[0], self.start, 3, fields=('pm25', 'aqi')),
+            context=self.context)
+        batches = list(export.iter_batches(
+            recsdb, self.uuids, self.start, self.end,
+            fields=['pm10', 'pm25', 'aqi'], context=self.context))
+        self.assertEqual(len(batches), 1)
+        batch = batches[0][2]
+        self.assertEqual(batch.column(1).to_pylist(), [
+            self.start + timedelta(hours=i) for i in range(3)])
+        self.assertEqual(batch.column(2).null_count, 3)
+        self.assertEqual(batch.column(3).to_pylist(), [0.0, 1.0, 2.0])
+        self.assertEqual(batch.column(4).to_pylist(), [0.0, 1.0, 2.0])
@@ -65,3 +65,11 @@ class TestExtractPM25in(TestExtract):
             self.data_points[uuid][0]['fields']['co'],
             0.653
         )
+
+    def test_parsers_identical(self):
+        # lxml and html5lib backends give the same output
+        with open(self.sources[self.src_name]['content-fpath'], 'rb') as fd:
+            content = fd.read()
+        self.assertEqual(self.src.extract_lxml(content),
+                         self.src.extract_html5lib(content))
+        self.assertEqual(self.src.extract_lxml(content), self.data_points)
@@ -5,6 +5,8 @@ import unittest
 from importlib import import_module
 
 from openkongqi.conf import config_from_object, settings
+from openkongqi.exceptions import ConfigError
+from openkongqi.utils import parse_rate
 
 
 class emptyConf(object):
@@ -70,3 +72,99 @@ class TestFetch(unittest.TestCase):
 
         self.src.target = url
         self.assertIsNone(self.src.fetch())
+
+    def test_session_reused_per_host(self):
+        """Sources targeting the same host share one pooled session"""
+        from openkongqi.source.session import get_session
+        self.assertIs(get_session("http://pm25.in/shanghai"),
+                      get_session("http://pm25.in/beijing"))
+        self.assertIsNot(get_session("http://pm25.in/shanghai"),
+                         get_session("https://pm25.in/shanghai"))
+
+    def test_session_retry_policy(self):
+        """Pooled sessions mount the configured retry strategy"""
+        from openkongqi.source.session import get_session
+        s = get_session("http://retry-policy.com")
+        adapter = s.get_adapter("http://retry-policy.com")
+        self.assertEqual(adapter.max_retries.total,
+                         settings['HTTP']['RETRY_TOTAL'])
+        self.assertIn(429, adapter.max_retries.status_forcelist)
+
+    @httpretty.activate
+    def test_session_rejects_cookies(self):
+        """Cookies set on a pooled session are never sent back"""
+        url = "http://cookies-resp.com"
+        httpretty.register_uri(
+            httpretty.GET, url,
+            body="This is NOT an empty response",
+            status=200,
+            set_cookie="session=abc",
+        )
+
+        self.src.target = url
+        self.src.fetch()
+        self.src.fetch()
+        self.assertNotIn('Cookie', httpretty.last_request().headers)
+
+    @httpretty.activate
+    def test_not_modified_resp(self):
+        """Send validators from the last status and skip a 304 response"""
+        url = "http://not-modified-resp.com"
+        httpretty.register_uri(
+            httpretty.GET, url,
+            body="",
+            status=304,
+        )
+
+        self.src.target = url
+        self.src._last_status = {
+            'code': 200,
+            'last-modified': 'Wed, 13 Jul 2016 02:54:00 GMT',
+            'etag': '"abc"',
+        }
+        self.assertIsNone(self.src.fetch())
+        headers = httpretty.last_request().headers
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Wed, 13 Jul 2016 02:54:00 GMT')
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        # validators are carried over for the next scrape
+        data = self.src.get_status_data()
+        self.assertEqual(data['code'], 304)
+        self.assertEqual(data['etag'], '"abc"')
+
+    def test_throttle_delay(self):
+        """Take a token from the bucket of the target host"""
+        taken = []
+
+        class Cache(object):
+            def take_token(self, key, rate, capacity):
+                taken.append((key, rate, capacity))
+                return 0.5
+
+        self.src._cachedb = Cache()
+        src_info = settings['SOURCES'][self.src.name]
+        self.assertEqual(
+            self.src.get_throttle_delay("http://pm25.in/shanghai"), 0)
+        src_info['ratelimit'] = {'rate': '30/m', 'burst': 2}
+        try:
+            self.assertEqual(
+                self.src.get_throttle_delay("http://pm25.in/shanghai"), 0.5)
+        finally:
+            del src_info['ratelimit']
+        self.assertEqual(taken, [('okq:ratelimit:pm25.in', 0.5, 2)])
+
+
+class TestParseRate(unittest.TestCase):
+
+    def test_parse_rate(self):
+        """Rates are converted to operations per second"""
+        self.assertEqual(parse_rate('30/m'), 0.5)
+        self.assertEqual(parse_rate('7200/h'), 2.0)
+        self.assertEqual(parse_rate('3'), 3.0)
+        self.assertEqual(parse_rate(0.5), 0.5)
+
+    def test_parse_rate_invalid(self):
+        """Invalid and non-positive rates raise a ConfigError"""
+        for rate in ('10/d', 'ten/m', '0/m', '-1/s', 0, -2.5, 'nan'):
+            with self.assertRaises(ConfigError):
+                parse_rate(rate)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from openkongqi.filecache import FileCache
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cachepath = tempfile.mkdtemp()
+        self.cache = FileCache(self.cachepath)
+        self.ts = datetime(2016, 7, 13, 2, 54)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachepath)
+
+    def test_set(self):
+        """Content is written in the cache and returned for reading"""
+        content = b"<html>" + b"x" * 200000 + b"</html>"
+        fd, size, digest = self.cache.set('pm25.in:shanghai',
+                                          io.BytesIO(content), self.ts)
+        with fd:
+            self.assertEqual(fd.read(), content)
+        self.assertEqual(size, len(content))
+        self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+        fp = self.cache.get_fp('pm25.in:shanghai', self.ts)
+        self.assertEqual(os.path.getsize(fp), len(content))
+
+    def test_set_latest(self):
+        """The latest link points to the last cached content"""
+        fd, _, _ = self.cache.set('pm25.in:shanghai', io.BytesIO(b"a"),
+                                  self.ts)
+        fd.close()
+        fd = self.cache.get_latest('pm25.in:shanghai')
+        with fd:
+            self.assertEqual(fd.read(), "a")
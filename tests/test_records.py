@@ -0,0 +1,851 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import pytz
+from sqlalchemy import event, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.pool import QueuePool
+
+from openkongqi.cache.base import BaseCacheWrapper
+from openkongqi.conf import global_settings, settings
+from openkongqi.exceptions import ConfigError
+from openkongqi.records import pgsql
+from openkongqi.records.base import create_recsdb
+from openkongqi.records.pgsql import (
+    iter_copy_chunks, partition_bounds, partition_name)
+from openkongqi.records.sqlalch import Record
+
+
+class DictCache(BaseCacheWrapper):
+    """In-memory cache database"""
+
+    def create_cnx(self, db_settings):
+        return {}
+
+    def set(self, key, value, ttl=None):
+        self._cnx[key] = value
+
+    def get(self, key):
+        return self._cnx.get(key)
+
+    def get_many(self, keys):
+        return [self._cnx.get(key) for key in keys]
+
+    def set_many(self, mapping, ttl=None):
+        self._cnx.update(mapping)
+
+    def incr(self, key):
+        self._cnx[key] = int(self._cnx.get(key, 0)) + 1
+        return self._cnx[key]
+
+
+def get_records(uuid, start, count, fields=('pm25', 'pm10')):
+    return {
+        uuid: [
+            {
+                'ts': start + timedelta(hours=i),
+                'fields': {field: float(i) for field in fields},
+            }
+            for i in range(count)
+        ]
+    }
+
+
+class TestSQLiteRecords(unittest.TestCase):
+
+    db_settings = {
+        'ENGINE': 'openkongqi.records.sqlite3',
+        'NAME': ':memory:',
+    }
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.cache = DictCache({})
+        self.recsdb = create_recsdb(self.db_settings, self.cache)
+        self.recsdb.db_init()
+        self.start = datetime(2016, 7, 13, 2, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def count_rows(self):
+        return self.recsdb._cnx.execute(
+            "SELECT COUNT(*) FROM records").scalar()
+
+    def test_write_records(self):
+        """Records are written with one row per field"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 6)
+        latest = self.recsdb.get_latest(self.uuid, context=self.context)
+        self.assertEqual(latest['ts'], self.start + timedelta(hours=2))
+
+    def test_write_records_latest_many(self):
+        """Latest records are read and written in a single round trip"""
+        uuids = ['cn:shanghai:hongkou', 'cn:shanghai:jingan']
+        records = {}
+        for uuid in uuids:
+            records.update(get_records(uuid, self.start, 2))
+        with mock.patch.object(self.cache, 'get',
+                               wraps=self.cache.get) as get, \
+                mock.patch.object(self.cache, 'set',
+                                  wraps=self.cache.set) as set_:
+            self.recsdb.write_records(records, context=self.context)
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(set_.call_count, 0)
+        latest = self.recsdb.get_latest_many(uuids, context=self.context)
+        self.assertEqual(
+            [latest[uuid]['ts'] for uuid in uuids],
+            [self.start + timedelta(hours=1)] * 2)
+
+    def test_write_records_duplicates(self):
+        """Duplicated records are skipped by the database"""
+        records = get_records(self.uuid, self.start, 3)
+        self.recsdb.write_records(records, context=self.context)
+        self.recsdb.write_records(get_records(self.uuid, self.start, 5),
+                                  ignore_check_latest=True,
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 10)
+
+    def test_write_records_batches(self):
+        """Rows are inserted in several batches"""
+        self.recsdb._batch_size = 4
+        self.recsdb.write_records(get_records(self.uuid, self.start, 7),
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 14)
+
+    def test_get_records(self):
+        """Records are grouped by timestamp"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=1),
+            context=self.context))
+        self.assertEqual(records, [
+            {'ts': self.start, 'fields': {'pm25': 0.0, 'pm10': 0.0}},
+            {'ts': self.start + timedelta(hours=1),
+             'fields': {'pm25': 1.0, 'pm10': 1.0}},
+        ])
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=5),
+            fields=['pm10'], context=self.context))
+        self.assertEqual([r['fields'] for r in records],
+                         [{'pm10': 0.0}, {'pm10': 1.0}, {'pm10': 2.0}])
+
+    def test_get_records_many(self):
+        """Records of several stations are read with chunked queries"""
+        uuids = ['cn:shanghai:hongkou', 'cn:shanghai:jingan',
+                 'cn:shanghai:pudong']
+        for uuid in uuids:
+            self.recsdb.write_records(get_records(uuid, self.start, 2),
+                                      context=self.context)
+        self.recsdb._in_chunk_size = 2
+        records = list(self.recsdb.get_records_many(
+            reversed(uuids), self.start, self.start + timedelta(hours=1),
+            fields=['pm25'], context=self.context))
+        self.assertEqual([uuid for uuid, _ in records],
+                         [uuid for uuid in uuids for _ in range(2)])
+        self.assertEqual(records[1][1], {
+            'ts': self.start + timedelta(hours=1), 'fields': {'pm25': 1.0}})
+
+    def test_get_records_many_wildcard(self):
+        """Wildcard region uuids are expanded to their stations"""
+        station_map = {
+            u'虹口': {'uuid': 'shanghai:hongkou'},
+            u'静安': {'uuid': 'shanghai:jingan'},
+        }
+        for uuid in ('cn:shanghai:hongkou', 'cn:shanghai:jingan',
+                     'th:bangkok:silom'):
+            self.recsdb.write_records(get_records(uuid, self.start, 1),
+                                      context=self.context)
+        # the station maps are loaded on import
+        with mock.patch.dict(settings, STATIONS_MAP_DIR=global_settings[
+                'STATIONS_MAP_DIR']), \
+                mock.patch('openkongqi.stations.get_station_map',
+                           return_value=station_map):
+            records = list(self.recsdb.get_records_many(
+                ['cn:*'], self.start, self.start, context=self.context))
+        self.assertEqual([uuid for uuid, _ in records],
+                         ['cn:shanghai:hongkou', 'cn:shanghai:jingan'])
+
+    def test_get_records_single_query(self):
+        """Records are read with a single query"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 48),
+                                  context=self.context)
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.recsdb.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            records = list(self.recsdb.get_records(
+                self.uuid, self.start, self.start + timedelta(days=2),
+                context=self.context))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(len(records), 48)
+        self.assertEqual(len(statements), 1)
+
+
+class TestSQLiteWideRecords(TestSQLiteRecords):
+
+    db_settings = {
+        'ENGINE': 'openkongqi.records.sqlite3',
+        'NAME': ':memory:',
+        'SCHEMA': 'wide',
+    }
+
+    def count_rows(self):
+        return self.recsdb._cnx.execute(
+            "SELECT COUNT(*) FROM records_wide").scalar()
+
+    def test_write_records(self):
+        """Records are written with one row per record"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 3)
+        latest = self.recsdb.get_latest(self.uuid, context=self.context)
+        self.assertEqual(latest['ts'], self.start + timedelta(hours=2))
+
+    def test_write_records_duplicates(self):
+        """Duplicated records are merged by the database"""
+        records = get_records(self.uuid, self.start, 3)
+        self.recsdb.write_records(records, context=self.context)
+        self.recsdb.write_records(get_records(self.uuid, self.start, 5),
+                                  ignore_check_latest=True,
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 5)
+
+    def test_write_records_batches(self):
+        """Rows are inserted in several batches"""
+        self.recsdb._batch_size = 4
+        self.recsdb.write_records(get_records(self.uuid, self.start, 7),
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 7)
+
+    def test_write_records_merge(self):
+        """A record written twice is merged, existing values are kept"""
+        self.recsdb.write_records({self.uuid: [{
+            'ts': self.start,
+            'fields': {'pm25': 1.0, 'aqi': 10.0},
+        }]}, context=self.context)
+        self.recsdb.write_records({self.uuid: [{
+            'ts': self.start,
+            'fields': {'pm25': 2.0, 'pm10': 3.0, 'aqi': 20.0, 'co2': 4.0},
+        }]}, ignore_check_latest=True, context=self.context)
+        self.assertEqual(self.count_rows(), 1)
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start, context=self.context))
+        self.assertEqual([r['fields'] for r in records], [
+            {'pm25': 1.0, 'pm10': 3.0, 'aqi': 10.0, 'co2': 4.0},
+        ])
+
+    def test_write_records_merge_same_call(self):
+        """A record duplicated in a single call is merged into one row"""
+        records = {self.uuid: [
+            {'ts': self.start, 'fields': {'pm25': 1.0, 'aqi': 10.0}},
+            {'ts': self.start + timedelta(hours=1), 'fields': {'pm25': 5.0}},
+            {'ts': self.start,
+             'fields': {'pm25': 2.0, 'pm10': 3.0, 'aqi': 20.0, 'co2': 4.0}},
+        ]}
+        rows, _ = self.recsdb.prepare_records(records, context=self.context)
+        self.assertEqual(len(rows), 2)
+        self.recsdb.write_records(records, ignore_check_latest=True,
+                                  context=self.context)
+        self.assertEqual(self.count_rows(), 2)
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start, context=self.context))
+        self.assertEqual([r['fields'] for r in records], [
+            {'pm25': 1.0, 'pm10': 3.0, 'aqi': 10.0, 'co2': 4.0},
+        ])
+
+    def test_extra_fields(self):
+        """Unknown fields are stored in the extra column"""
+        records = get_records(self.uuid, self.start, 2,
+                              fields=('pm25', 'aqi'))
+        self.recsdb.write_records(records, context=self.context)
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=1),
+            context=self.context))
+        self.assertEqual([r['fields'] for r in records], [
+            {'pm25': 0.0, 'aqi': 0.0},
+            {'pm25': 1.0, 'aqi': 1.0},
+        ])
+        records = list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=1),
+            fields=['aqi'], context=self.context))
+        self.assertEqual([r['fields'] for r in records],
+                         [{'aqi': 0.0}, {'aqi': 1.0}])
+
+
+class TestSQLiteMigrate(unittest.TestCase):
+
+    db_settings = {
+        'ENGINE': 'openkongqi.records.sqlite3',
+        'NAME': ':memory:',
+    }
+
+    def setUp(self):
+        self.recsdb = create_recsdb(self.db_settings, DictCache({}))
+
+    def get_indexes(self):
+        return [
+            index['name'] for index in
+            inspect(self.recsdb.get_engine()).get_indexes('records')
+        ]
+
+    def test_migrate_creates_indexes(self):
+        """Indexes missing from an existing table are created"""
+        self.recsdb.db_init()
+        self.recsdb._cnx.execute("DROP INDEX ix_records_uuid_ts")
+        self.assertEqual(self.get_indexes(), [])
+        self.assertEqual(self.recsdb.db_migrate(), ['ix_records_uuid_ts'])
+        self.assertEqual(self.get_indexes(), ['ix_records_uuid_ts'])
+        # nothing to do the second time
+        self.assertEqual(self.recsdb.db_migrate(), [])
+
+    def test_migrate_upgrades_indexes(self):
+        """Indexes covering other columns are recreated"""
+        self.recsdb.db_init()
+        self.recsdb._cnx.execute("DROP INDEX ix_records_uuid_ts")
+        self.recsdb._cnx.execute(
+            "CREATE INDEX ix_records_uuid_ts ON records (uuid)")
+        self.assertEqual(self.recsdb.db_migrate(), ['ix_records_uuid_ts'])
+
+
+class TestPgIndexes(unittest.TestCase):
+
+    def test_index_key(self):
+        """Indexes are compared with their included columns"""
+        recsdb = pgsql.RecordsWrapper.__new__(pgsql.RecordsWrapper)
+        index = next(iter(Record.__table__.indexes))
+        self.assertEqual(recsdb.get_index_key(index),
+                         (['uuid', 'ts'], ['key', 'value']))
+        self.assertEqual(
+            recsdb.get_reflected_index_key({
+                'column_names': ['uuid', 'ts'],
+                'include_columns': ['key', 'value'],
+            }),
+            recsdb.get_index_key(index))
+        self.assertNotEqual(
+            recsdb.get_reflected_index_key({'column_names': ['uuid', 'ts']}),
+            recsdb.get_index_key(index))
+
+
+class TestPartitions(unittest.TestCase):
+
+    def test_partition_bounds(self):
+        """Partitions bounds follow the calendar"""
+        ts = datetime(2016, 12, 13, 2)
+        self.assertEqual(partition_bounds(ts, 'day'),
+                         (datetime(2016, 12, 13), datetime(2016, 12, 14)))
+        self.assertEqual(partition_bounds(ts, 'month'),
+                         (datetime(2016, 12, 1), datetime(2017, 1, 1)))
+        self.assertEqual(partition_bounds(ts, 'year'),
+                         (datetime(2016, 1, 1), datetime(2017, 1, 1)))
+
+    def test_partition_bounds_utc(self):
+        """Aware timestamps are converted to UTC"""
+        ts = pytz.timezone('Asia/Shanghai').localize(datetime(2016, 8, 1, 2))
+        self.assertEqual(partition_bounds(ts, 'month'),
+                         (datetime(2016, 7, 1), datetime(2016, 8, 1)))
+
+    def test_ensure_partitions(self):
+        """Partitions are remembered only once they exist"""
+        recsdb = pgsql.RecordsWrapper.__new__(pgsql.RecordsWrapper)
+        recsdb._schema = 'eav'
+        recsdb._partition = 'month'
+        recsdb._partitions = set()
+        start = datetime(2016, 7, 1)
+        engine = mock.MagicMock()
+        engine.begin.return_value.__enter__.return_value.execute \
+            .side_effect = ProgrammingError("CREATE TABLE", {}, Exception())
+        with mock.patch.object(recsdb, 'get_engine', return_value=engine), \
+                mock.patch.object(recsdb, 'get_partitions',
+                                  return_value=[]):
+            with self.assertRaises(ProgrammingError):
+                recsdb.ensure_partitions([start])
+        self.assertEqual(recsdb._partitions, set())
+        # created by another worker meanwhile
+        with mock.patch.object(recsdb, 'get_engine', return_value=engine), \
+                mock.patch.object(
+                    recsdb, 'get_partitions',
+                    return_value=[('records_p20160701', start,
+                                   datetime(2016, 8, 1))]):
+            recsdb.ensure_partitions([start])
+        self.assertEqual(recsdb._partitions, {start})
+
+    def test_partition_name(self):
+        self.assertEqual(partition_name('records', datetime(2016, 7, 1)),
+                         'records_p20160701')
+
+
+class TestSQLiteRollups(unittest.TestCase):
+
+    db_settings = {
+        'ENGINE': 'openkongqi.records.sqlite3',
+        'NAME': ':memory:',
+        'ROLLUPS': ['hour', 'day'],
+    }
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.recsdb = create_recsdb(self.db_settings, DictCache({}))
+        self.recsdb.db_init()
+        self.start = datetime(2016, 7, 13, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def test_get_aggregates(self):
+        """Rollups are maintained when writing records"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 36),
+                                  context=self.context)
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start, self.start + timedelta(days=2), 'day',
+            context=self.context))
+        self.assertEqual([a['ts'] for a in aggregates],
+                         [self.start, self.start + timedelta(days=1)])
+        self.assertEqual(aggregates[0]['fields']['pm25'], {
+            'count': 24, 'mean': 11.5, 'min': 0.0, 'max': 23.0})
+        self.assertEqual(aggregates[1]['fields']['pm10'], {
+            'count': 12, 'mean': 29.5, 'min': 24.0, 'max': 35.0})
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start, self.start + timedelta(hours=2), 'hour',
+            fields=['pm10'], context=self.context))
+        self.assertEqual(len(aggregates), 3)
+        self.assertEqual(list(aggregates[2]['fields']), ['pm10'])
+
+    def test_rollups_incremental(self):
+        """Buckets are recomputed, duplicated records aren't counted twice"""
+        records = get_records(self.uuid, self.start, 36)
+        first = {self.uuid: records[self.uuid][:30]}
+        self.recsdb.write_records(first, context=self.context)
+        self.recsdb.write_records(records, ignore_check_latest=True,
+                                  context=self.context)
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start + timedelta(days=1),
+            self.start + timedelta(days=1), 'day', context=self.context))
+        self.assertEqual(aggregates[0]['fields']['pm25']['count'], 12)
+        self.assertEqual(aggregates[0]['fields']['pm25']['max'], 35.0)
+
+    def test_rollups_touched_buckets(self):
+        """Only the buckets of the written records are recomputed"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 36),
+                                  context=self.context)
+        self.recsdb._cnx.execute(
+            "UPDATE records_rollup SET count = 99 WHERE resolution = 'hour'")
+        self.recsdb.write_records({self.uuid: [{
+            'ts': self.start + timedelta(hours=20, minutes=30),
+            'fields': {'pm25': 40.0},
+        }]}, ignore_check_latest=True, context=self.context)
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start + timedelta(hours=19),
+            self.start + timedelta(hours=20), 'hour', fields=['pm25'],
+            context=self.context))
+        self.assertEqual([a['fields']['pm25'] for a in aggregates], [
+            {'count': 99, 'mean': 19.0 / 99, 'min': 19.0, 'max': 19.0},
+            {'count': 2, 'mean': 30.0, 'min': 20.0, 'max': 40.0},
+        ])
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start, self.start, 'day', fields=['pm25'],
+            context=self.context))
+        self.assertEqual(aggregates[0]['fields']['pm25']['count'], 25)
+
+
+class TestSQLiteWideRollups(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+            'SCHEMA': 'wide',
+            'ROLLUPS': ['hour'],
+        }, DictCache({}))
+        self.recsdb.db_init()
+        self.start = datetime(2016, 7, 13, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def get_rollup_keys(self):
+        return sorted(row[0] for row in self.recsdb._cnx.execute(
+            "SELECT key FROM records_rollup"))
+
+    def test_non_numeric(self):
+        """Non-numeric values are left out of the rollups"""
+        self.recsdb.write_records({self.uuid: [
+            {'ts': self.start, 'fields': {'pm25': 1.0, 'level': 'good'}},
+            {'ts': self.start + timedelta(minutes=30),
+             'fields': {'pm25': 3.0, 'aqi': 'N/A', 'level': 'bad'}},
+            {'ts': self.start + timedelta(minutes=40),
+             'fields': {'aqi': 20, 'flag': True}},
+        ]}, context=self.context)
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start, self.start, 'hour', context=self.context))
+        self.assertEqual(aggregates[0]['fields'], {
+            'pm25': {'count': 2, 'mean': 2.0, 'min': 1.0, 'max': 3.0},
+            'aqi': {'count': 1, 'mean': 20.0, 'min': 20.0, 'max': 20.0},
+        })
+
+    def test_non_numeric_merged(self):
+        """No empty rollup is left for a value merged into a non-numeric
+        one"""
+        self.recsdb.write_records({self.uuid: [
+            {'ts': self.start, 'fields': {'pm25': 1.0, 'aqi': 'N/A'}},
+        ]}, context=self.context)
+        self.recsdb.write_records({self.uuid: [
+            {'ts': self.start, 'fields': {'aqi': 20.0}},
+        ]}, ignore_check_latest=True, context=self.context)
+        self.assertEqual(self.get_rollup_keys(), ['pm25'])
+
+    def test_lock_rollups(self):
+        """Rollup rows are created then locked before being recomputed"""
+        bucket = self.start.replace(tzinfo=None)
+        conn = mock.MagicMock()
+        self.recsdb.lock_rollups(self.uuid, 'hour',
+                                 {bucket: {'pm25', 'aqi'}}, conn)
+        (insert, rows), (lock, ) = [
+            call[0] for call in conn.execute.call_args_list]
+        self.assertEqual([(row['bucket'], row['key'], row['count'])
+                          for row in rows],
+                         [(bucket, 'aqi', 0), (bucket, 'pm25', 0)])
+        self.assertIn('FOR UPDATE',
+                      str(lock.compile(dialect=postgresql.dialect())))
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+            'WRITE_BEHIND': {
+                'PATH': os.path.join(self.tmpdir, 'queue.sqlite3'),
+                'MAX_RECORDS': 5,
+                'INTERVAL': 3600,
+            },
+        }, DictCache({}))
+        self.recsdb.db_init()
+        self.start = datetime(2016, 7, 13, 2, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_records(self):
+        return list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(days=1),
+            context=self.context))
+
+    def test_write_behind(self):
+        """Records are queued until the queue is full"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        self.assertEqual(self.get_records(), [])
+        self.assertEqual(self.recsdb.get_size(), 3)
+        # the latest record is set right away
+        latest = self.recsdb.get_latest(self.uuid, context=self.context)
+        self.assertEqual(latest['ts'], self.start + timedelta(hours=2))
+        self.recsdb.write_records(get_records(self.uuid, self.start, 6),
+                                  context=self.context)
+        self.assertEqual(self.recsdb.get_size(), 0)
+        records = self.get_records()
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records[-1]['fields'], {'pm25': 5.0, 'pm10': 5.0})
+
+    def test_flush(self):
+        """Queued records are written on flush"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 2),
+                                  context=self.context)
+        self.assertEqual(self.recsdb.flush(), 2)
+        self.assertEqual(len(self.get_records()), 2)
+        self.assertEqual(self.recsdb.flush(), 0)
+
+    def test_flush_chunks(self):
+        """Records are flushed in chunks, each removed once written"""
+        self.recsdb._max_records = 100
+        self.recsdb.write_records(get_records(self.uuid, self.start, 12),
+                                  context=self.context)
+        self.recsdb._max_records = 5
+        write_records = self.recsdb._recsdb.write_records
+        chunks = []
+
+        def fail_second(records, **kwargs):
+            chunks.append(len(records[self.uuid]))
+            if len(chunks) == 2:
+                raise IOError("records database is down")
+            write_records(records, **kwargs)
+
+        with mock.patch.object(self.recsdb._recsdb, 'write_records',
+                               side_effect=fail_second):
+            with self.assertRaises(IOError):
+                self.recsdb.flush()
+        self.assertEqual(chunks, [5, 5])
+        self.assertEqual(self.recsdb.get_size(), 7)
+        self.assertEqual(self.recsdb.flush(), 7)
+        self.assertEqual(len(self.get_records()), 12)
+
+    def test_flush_claim(self):
+        """A chunk is claimed while it is written, another flush waits"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 2),
+                                  context=self.context)
+        write_records = self.recsdb._recsdb.write_records
+        locked = []
+
+        def try_claim(records, **kwargs):
+            other = sqlite3.connect(self.recsdb._path, timeout=0,
+                                    isolation_level=None)
+            try:
+                other.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                locked.append(True)
+            else:
+                other.execute("ROLLBACK")
+            finally:
+                other.close()
+            write_records(records, **kwargs)
+
+        with mock.patch.object(self.recsdb._recsdb, 'write_records',
+                               side_effect=try_claim):
+            self.assertEqual(self.recsdb.flush(), 2)
+        self.assertEqual(locked, [True])
+        self.assertEqual(self.recsdb.get_size(), 0)
+
+
+class TestSQLiteSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_recsdb(self, **settings):
+        db_settings = {
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': os.path.join(self.tmpdir, 'openkongqi'),
+        }
+        db_settings.update(settings)
+        return create_recsdb(db_settings, DictCache({}))
+
+    def pragma(self, recsdb, name):
+        with recsdb.get_engine().connect() as conn:
+            return conn.execute("PRAGMA {}".format(name)).scalar()
+
+    def test_pragmas(self):
+        """Connections are set up with the configured pragmas"""
+        recsdb = self.create_recsdb(CACHE_SIZE=-4000)
+        self.assertEqual(self.pragma(recsdb, 'journal_mode'), 'wal')
+        # NORMAL
+        self.assertEqual(self.pragma(recsdb, 'synchronous'), 1)
+        self.assertEqual(self.pragma(recsdb, 'cache_size'), -4000)
+        recsdb = self.create_recsdb(JOURNAL_MODE='DELETE', SYNCHRONOUS=None)
+        self.assertEqual(self.pragma(recsdb, 'journal_mode'), 'delete')
+
+    def test_pool_options(self):
+        """Pool options are passed to the engine"""
+        recsdb = self.create_recsdb(POOL_SIZE=3, POOL_PRE_PING=True)
+        pool = recsdb.get_engine().pool
+        self.assertEqual(pool.size(), 3)
+        self.assertTrue(pool._pre_ping)
+
+    def test_pool_timeout(self):
+        """Any queue pool option pools a file database"""
+        recsdb = self.create_recsdb(POOL_TIMEOUT=5)
+        pool = recsdb.get_engine().pool
+        self.assertIsInstance(pool, QueuePool)
+        self.assertEqual(pool.timeout(), 5)
+
+    def test_memory_pool_options(self):
+        """Queue pool options are refused for in-memory databases"""
+        with self.assertRaises(ConfigError):
+            self.create_recsdb(NAME=':memory:', MAX_OVERFLOW=2)
+
+
+class TestResultCache(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.cache = DictCache({})
+        self.recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+            'RESULT_CACHE': {'TTL': 60},
+        }, self.cache)
+        self.recsdb.db_init()
+        self.start = datetime(2016, 7, 13, 2, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def get_records(self):
+        return list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(days=1),
+            context=self.context))
+
+    def count_queries(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.recsdb.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', count)
+        return statements
+
+    def test_cached_results(self):
+        """Repeated reads are served from the cache database"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        statements = self.count_queries()
+        records = self.get_records()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(self.get_records(), records)
+        self.assertEqual(len(statements), 1)
+
+    def test_invalidation(self):
+        """Writing records of a station invalidates its results"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        self.assertEqual(len(self.get_records()), 3)
+        # other stations don't invalidate the results
+        other = 'cn:shanghai:jingan'
+        self.recsdb.write_records(get_records(other, self.start, 3),
+                                  context=self.context)
+        statements = self.count_queries()
+        self.get_records()
+        self.assertEqual(len(statements), 0)
+        self.recsdb.write_records(get_records(self.uuid, self.start, 5),
+                                  context=self.context)
+        self.assertEqual(len(self.get_records()), 5)
+
+    def test_microseconds(self):
+        """Sub-second ranges and timestamps are kept"""
+        start = self.start + timedelta(microseconds=500)
+        self.recsdb.write_records(get_records(self.uuid, start, 2),
+                                  context=self.context)
+        # same second, other microseconds
+        self.assertEqual(list(self.recsdb.get_records(
+            self.uuid, self.start, self.start, context=self.context)), [])
+        for _ in range(2):
+            records = list(self.recsdb.get_records(
+                self.uuid, start, start, context=self.context))
+            self.assertEqual([r['ts'] for r in records], [start])
+
+
+class TestBulkLoad(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+
+    def test_bulk_load(self):
+        """Older records are loaded as well"""
+        recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': ':memory:',
+        }, DictCache({}))
+        recsdb.db_init()
+        start = datetime(2016, 7, 13, 2, tzinfo=pytz.utc)
+        uuid = 'cn:shanghai:hongkou'
+        recsdb.write_records(
+            get_records(uuid, start + timedelta(hours=10), 2),
+            context=self.context)
+        recsdb.bulk_load(get_records(uuid, start, 12), context=self.context)
+        records = list(recsdb.get_records(
+            uuid, start, start + timedelta(days=1), context=self.context))
+        self.assertEqual(len(records), 12)
+
+    @unittest.skipIf(not os.environ.get('PG'),
+                     "PG (PostgreSQL DSN of a test database) is not set")
+    def test_bulk_load_pgsql(self):
+        """Records are copied to partitions created before the load"""
+        url = make_url(os.environ['PG'])
+        recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.pgsql',
+            'DRIVER': url.drivername.partition('+')[2] or 'psycopg2',
+            'USERNAME': url.username,
+            'PASSWORD': url.password,
+            'HOST': url.host,
+            'PORT': url.port or 5432,
+            'NAME': url.database,
+            'PARTITION': 'day',
+            'ROLLUPS': ['day'],
+            'COPY_SIZE': 5,
+        }, DictCache({}))
+        engine = recsdb.get_engine()
+
+        def drop_tables():
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "DROP TABLE IF EXISTS records, records_rollup CASCADE"))
+
+        drop_tables()
+        self.addCleanup(engine.dispose)
+        self.addCleanup(drop_tables)
+        recsdb.db_init()
+        start = datetime(2016, 7, 13, 20, tzinfo=pytz.utc)
+        uuid = 'cn:shanghai:hongkou'
+        # naive timestamps are UTC
+        recsdb.write_records({uuid: [{
+            'ts': datetime(2016, 7, 14, 2), 'fields': {'pm25': 1.0},
+        }]}, context=self.context)
+        self.assertEqual(
+            recsdb.bulk_load(get_records(uuid, start, 12),
+                             context=self.context), 23)
+        self.assertEqual(
+            [partition[0] for partition in recsdb.get_partitions()
+             if partition[1] < datetime(2016, 8, 1)],
+            ['records_p20160713', 'records_p20160714'])
+        records = list(recsdb.get_records(
+            uuid, start, start + timedelta(days=1), context=self.context))
+        self.assertEqual(len(records), 12)
+        aggregates = list(recsdb.get_aggregates(
+            uuid, start, start + timedelta(days=1), 'day',
+            context=self.context))
+        self.assertEqual([a['fields']['pm25']['count'] for a in aggregates],
+                         [4, 8])
+        latest = recsdb.get_latest(uuid, context=self.context)
+        self.assertEqual(latest['ts'], start + timedelta(hours=11))
+
+    def test_copy_chunks(self):
+        """Rows are serialized to CSV chunks"""
+        ts = datetime(2016, 7, 31, 23, tzinfo=pytz.utc)
+        rows = [
+            {'ts': ts + timedelta(hours=i), 'uuid': 'a', 'pm25': 1.5,
+             'pm10': None, 'extra': {'aqi': 3} if i else None}
+            for i in range(3)
+        ]
+        chunks = list(iter_copy_chunks(
+            rows, ['ts', 'uuid', 'pm25', 'pm10', 'extra'], 2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[0].read().splitlines(), [
+            '2016-07-31 23:00:00,a,1.5,,',
+            '2016-08-01 00:00:00,a,1.5,,"{""aqi"": 3}"',
+        ])
+        self.assertEqual(chunks[1].read().splitlines(), [
+            '2016-08-01 01:00:00,a,1.5,,"{""aqi"": 3}"',
+        ])
+
+    def test_bulk_load_pgsql_driver(self):
+        """Records are written without COPY by other drivers than psycopg2"""
+        recsdb = pgsql.RecordsWrapper.__new__(pgsql.RecordsWrapper)
+        engine = mock.MagicMock()
+        engine.dialect.driver = 'pg8000'
+        records = get_records('cn:shanghai:hongkou',
+                              datetime(2016, 7, 13, tzinfo=pytz.utc), 2)
+        with mock.patch.object(recsdb, 'get_engine', return_value=engine), \
+                mock.patch.object(recsdb, 'write_records') as write_records:
+            self.assertIsNone(recsdb.bulk_load(records, context=self.context))
+        write_records.assert_called_once_with(
+            records, ignore_check_latest=True, context=self.context)
+        self.assertFalse(engine.begin.called)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytz
+
+from .test_records import DictCache, get_records
+
+try:
+    import aiosqlite
+except ImportError:         # pragma: no cover
+    aiosqlite = None
+else:
+    from openkongqi.records.aio import create_async_recsdb
+
+
+@unittest.skipIf(aiosqlite is None, "aiosqlite is not installed")
+class TestAsyncRecords(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+    schema = 'eav'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recsdb = create_async_recsdb({
+            'ENGINE': 'openkongqi.records.sqlite3',
+            'NAME': os.path.join(self.tmpdir, 'openkongqi'),
+            'SCHEMA': self.schema,
+        }, DictCache({}))
+        self.recsdb._recsdb.db_init()
+        self.start = datetime(2016, 7, 13, 2, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.recsdb.dispose())
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def collect(self, agen):
+        return [item async for item in agen]
+
+    def test_write_get_records(self):
+        """Records are written and streamed asynchronously"""
+        self.run_async(self.recsdb.write_records(
+            get_records(self.uuid, self.start, 3), context=self.context))
+        latest = self.run_async(self.recsdb.get_latest(
+            self.uuid, context=self.context))
+        self.assertEqual(latest['ts'], self.start + timedelta(hours=2))
+        records = self.run_async(self.collect(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=1),
+            context=self.context)))
+        self.assertEqual(records, [
+            {'ts': self.start, 'fields': {'pm25': 0.0, 'pm10': 0.0}},
+            {'ts': self.start + timedelta(hours=1),
+             'fields': {'pm25': 1.0, 'pm10': 1.0}},
+        ])
+        # the synchronous API reads the same database
+        records = list(self.recsdb._recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=5),
+            fields=['pm10'], context=self.context))
+        self.assertEqual(len(records), 3)
+
+
+class TestAsyncWideRecords(TestAsyncRecords):
+
+    schema = 'wide'
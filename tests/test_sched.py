@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import unittest
+from unittest import mock
+
+from openkongqi.conf import config_from_object, settings
+
+
+class emptyConf(object):
+    settings = {}
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        settings['SOURCES'].update({
+            'pm25.in:beijing': {
+                'target': 'http://pm25.in/beijing',
+                'uuid': 'cn:beijing',
+                'modname': 'openkongqi.source.pm25in',
+                'tz': 'Asia/Shanghai',
+            },
+            'taqm:taipei': {
+                'target': 'https://taqm.epa.gov.tw/pm25/en/PM25A.aspx',
+                'uuid': 'tw',
+                'modname': 'openkongqi.source.pm25in',
+                'tz': 'Asia/Taipei',
+                'queue': 'taiwan',
+            },
+            'aqicn:taipei': {
+                'target': 'https://aqicn.org/city/taipei',
+                'uuid': 'tw',
+                'modname': 'openkongqi.source.pm25in',
+                'tz': 'Asia/Taipei',
+                'queue': 'taiwan',
+            },
+        })
+        from openkongqi.sched import get_schedule
+        self.get_schedule = get_schedule
+
+    def get_batches(self, schedule, task='openkongqi.tasks.scrape_batch'):
+        self.assertTrue(all(entry['task'] == task
+                            for entry in schedule.values()))
+        return sorted(entry['args'][0] for entry in schedule.values())
+
+    def test_schedule(self):
+        """One entry per source by default"""
+        schedule = self.get_schedule(60)
+        self.assertEqual(len(schedule), 4)
+        self.assertEqual(schedule['taqm:taipei']['task'],
+                         'openkongqi.tasks.scrape')
+
+    def test_batch_by_queue(self):
+        """Sources sharing a queue are scraped by the same entry"""
+        self.assertEqual(
+            self.get_batches(self.get_schedule(60, group_by='queue')),
+            [['aqicn:taipei', 'taqm:taipei'],
+             ['pm25.in:beijing', 'pm25.in:shanghai']])
+
+    def test_batch_by_host(self):
+        """Sources are grouped by queue and host"""
+        self.assertEqual(
+            self.get_batches(self.get_schedule(60, group_by='host')),
+            [['aqicn:taipei'],
+             ['pm25.in:beijing', 'pm25.in:shanghai'],
+             ['taqm:taipei']])
+
+    def test_batch_size(self):
+        """Groups are split in batches of a maximum size"""
+        self.assertEqual(
+            self.get_batches(self.get_schedule(60, group_by='queue',
+                                               batch_size=1)),
+            [['aqicn:taipei'], ['pm25.in:beijing'], ['pm25.in:shanghai'],
+             ['taqm:taipei']])
+
+    def test_async_batches(self):
+        """Asynchronous batches group the sources by queue by default"""
+        schedule = self.get_schedule(60, asynchronous=True)
+        self.assertIn('async::0', schedule)
+        self.assertEqual(
+            self.get_batches(schedule, task='openkongqi.tasks.scrape_async'),
+            [['aqicn:taipei', 'taqm:taipei'],
+             ['pm25.in:beijing', 'pm25.in:shanghai']])
+
+    def test_async_route(self):
+        """Asynchronous batches are routed with their first source"""
+        from openkongqi.routes import source_router
+        self.assertEqual(
+            source_router('openkongqi.tasks.scrape_async',
+                          (['taqm:taipei', 'aqicn:taipei'], ), {}, {}),
+            {'queue': 'taiwan', 'routing_key': 'taiwan'})
+
+    def test_flush_schedule(self):
+        """Write-behind queues are flushed every INTERVAL seconds"""
+        self.assertNotIn('flush_records', self.get_schedule(60))
+        records = dict(settings['DATABASES']['records'],
+                       WRITE_BEHIND={'INTERVAL': 30})
+        with mock.patch.dict(settings['DATABASES'], records=records):
+            schedule = self.get_schedule(60, group_by='queue')
+        self.assertEqual(schedule['flush_records'], {
+            'task': 'openkongqi.tasks.flush_records',
+            'schedule': timedelta(seconds=30),
+        })
+
+    def test_flush_schedule_queues(self):
+        """One flush entry is routed to the queue of each host"""
+        records = dict(settings['DATABASES']['records'],
+                       WRITE_BEHIND={'QUEUES': ['host-a', 'host-b']})
+        with mock.patch.dict(settings['DATABASES'], records=records):
+            schedule = self.get_schedule(60)
+        self.assertNotIn('flush_records', schedule)
+        self.assertEqual(schedule['flush_records:host-b']['options'],
+                         {'queue': 'host-b', 'routing_key': 'host-b'})
+        self.assertEqual(schedule['flush_records:host-a']['schedule'],
+                         timedelta(seconds=60))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from importlib import import_module
+
+import pytz
+from urllib3.exceptions import ProtocolError
+
+from openkongqi.conf import config_from_object, settings
+from openkongqi.filecache import FileCache
+from openkongqi.source import pool
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+TEST_DATA_PATH = os.path.join(here, 'data')
+
+
+class emptyConf(object):
+    settings = {}
+
+
+class DictStatus(object):
+    """In-memory status database"""
+
+    def __init__(self):
+        self.data = {}
+
+    def set_status(self, name, data):
+        self.data[name] = data
+
+    def get_status(self, name):
+        return self.data.get(name)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        mod = import_module('openkongqi.source.pm25in')
+        self.fetches = []
+        test = self
+
+        class Source(mod.Source):
+            circuit_threshold = 2
+            failing = True
+
+            def fetch(self):
+                test.fetches.append(self._now)
+                self._info = None
+                self._statuscode = None if self.failing else 200
+                return None
+
+        self.src = Source('pm25.in:shanghai')
+        self.src._status = DictStatus()
+
+    def get_status(self):
+        return self.src._status.get_status(self.src.name)
+
+    def test_open_after_threshold(self):
+        """The circuit opens after consecutive failures"""
+        self.src.scrape()
+        self.assertEqual(self.get_status()['failures'], 1)
+        self.assertEqual(self.get_status()['circuit'], 'closed')
+        self.src.scrape()
+        self.assertEqual(self.get_status()['failures'], 2)
+        self.assertEqual(self.get_status()['circuit'], 'open')
+        self.assertIn('latency', self.get_status())
+        # scheduled scrapes are skipped, forced ones are not
+        self.src.scrape()
+        self.assertEqual(len(self.fetches), 2)
+        self.src.scrape(force=True)
+        self.assertEqual(len(self.fetches), 3)
+
+    def test_half_open_probe(self):
+        """A probe closes the circuit on success or doubles the backoff"""
+        past = datetime.now(pytz.utc) - timedelta(seconds=1)
+        self.src._status.set_status(self.src.name, {
+            'code': None,
+            'failures': 2,
+            'circuit': 'open',
+            'retry-at': past.strftime('%Y%m%d%H%M%S'),
+        })
+        self.src.scrape()
+        self.assertEqual(len(self.fetches), 1)
+        status = self.get_status()
+        self.assertEqual(status['circuit'], 'open')
+        retry_at = pytz.utc.localize(
+            datetime.strptime(status['retry-at'], '%Y%m%d%H%M%S'))
+        self.assertEqual(retry_at - self.fetches[0].replace(microsecond=0),
+                         timedelta(seconds=2 * self.src.circuit_backoff))
+
+        status['retry-at'] = past.strftime('%Y%m%d%H%M%S')
+        self.src.failing = False
+        self.src.scrape()
+        self.assertEqual(self.get_status()['failures'], 0)
+        self.assertEqual(self.get_status()['circuit'], 'closed')
+
+
+class TestUnchangedContent(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        mod = import_module('openkongqi.source.pm25in')
+        self.extracted = []
+        self.saved = []
+        test = self
+
+        class Source(mod.Source):
+            content = b"<html></html>"
+            headers = None
+
+            def fetch(self):
+                self._info = self.headers
+                self._statuscode = 200
+                return io.BytesIO(self.content)
+
+            def extract(self, content):
+                test.extracted.append(content.read())
+                return {}
+
+            def save_data(self, data, ignore_check_latest=False):
+                if test.save_error is not None:
+                    raise test.save_error
+                test.saved.append(data)
+
+        self.save_error = None
+        self.cachepath = tempfile.mkdtemp()
+        self.src = Source('pm25.in:shanghai')
+        self.src._status = DictStatus()
+        self.src._cache = FileCache(self.cachepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachepath)
+
+    def get_status(self):
+        return self.src._status.get_status(self.src.name)
+
+    def test_skip_unchanged(self):
+        """Identical content is neither extracted nor saved again"""
+        self.src.scrape()
+        self.assertFalse(self.get_status()['unchanged'])
+        digest = self.get_status()['digest']
+        self.src.scrape()
+        self.assertTrue(self.get_status()['unchanged'])
+        self.assertEqual(self.get_status()['digest'], digest)
+        self.assertEqual(self.extracted, [b"<html></html>"])
+        self.assertEqual(len(self.saved), 1)
+
+        self.src.content = b"<html>new</html>"
+        self.src.scrape()
+        self.assertFalse(self.get_status()['unchanged'])
+        self.assertEqual(len(self.extracted), 2)
+        self.assertEqual(len(self.saved), 2)
+
+    def test_retry_after_save_error(self):
+        """Content is saved again by the next scrape if saving failed"""
+        self.save_error = IOError("records database is down")
+        with self.assertRaises(IOError):
+            self.src.scrape()
+        self.assertNotIn('digest', self.get_status())
+        self.save_error = None
+        self.src.scrape()
+        self.assertFalse(self.get_status()['unchanged'])
+        self.assertIn('digest', self.get_status())
+        self.assertEqual(len(self.extracted), 2)
+        self.assertEqual(len(self.saved), 1)
+        self.src.scrape()
+        self.assertTrue(self.get_status()['unchanged'])
+        self.assertEqual(len(self.saved), 1)
+
+    def test_validators_after_save_error(self):
+        """Validators are only kept once the content is saved"""
+        self.src.headers = {'ETag': '"abc"'}
+        self.save_error = IOError("records database is down")
+        with self.assertRaises(IOError):
+            self.src.scrape()
+        self.assertNotIn('etag', self.get_status())
+        self.src.prepare_scrape()
+        self.assertEqual(self.src.get_conditional_headers(), {})
+        self.save_error = None
+        self.src.scrape()
+        self.assertEqual(self.get_status()['etag'], '"abc"')
+        self.src.prepare_scrape()
+        self.assertEqual(self.src.get_conditional_headers(),
+                         {'If-None-Match': '"abc"'})
+
+
+class TestStreamReadError(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        mod = import_module('openkongqi.source.pm25in')
+        self.saved = []
+        test = self
+
+        class Body(io.BytesIO):
+            """Streamed body whose connection drops after a chunk"""
+
+            def read(self, size=-1):
+                if self.tell():
+                    raise ProtocolError("Connection broken: IncompleteRead")
+                return super(Body, self).read(4)
+
+        class Source(mod.Source):
+
+            def fetch(self):
+                self._info = {'ETag': '"abc"'}
+                self._statuscode = 200
+                return Body(b"<html></html>")
+
+            def save_data(self, data, ignore_check_latest=False):
+                test.saved.append(data)
+
+        self.cachepath = tempfile.mkdtemp()
+        self.src = Source('pm25.in:shanghai')
+        self.src._status = DictStatus()
+        self.src._cache = FileCache(self.cachepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachepath)
+
+    def test_read_error(self):
+        """A body failing mid-read is a failed fetch, nothing is cached"""
+        self.assertIsNone(self.src.scrape())
+        self.assertEqual(os.listdir(self.cachepath), [])
+        self.assertEqual(self.saved, [])
+        status = self.src._status.get_status(self.src.name)
+        self.assertEqual(status['failures'], 1)
+        self.assertNotIn('digest', status)
+        self.assertNotIn('etag', status)
+        self.src.scrape()
+        status = self.src._status.get_status(self.src.name)
+        self.assertEqual(status['failures'], 2)
+
+
+class TestExtractPool(unittest.TestCase):
+
+    def setUp(self):
+        confobj = emptyConf()
+        config_from_object(confobj)
+        mod = import_module('openkongqi.source.pm25in')
+        self.saved = []
+        test = self
+        with open(os.path.join(TEST_DATA_PATH, 'pm25.in',
+                               'shanghai.html'), 'rb') as fd:
+            self.content = fd.read()
+
+        class Source(mod.Source):
+
+            def fetch(self):
+                self._info = None
+                self._statuscode = 200
+                return io.BytesIO(test.content)
+
+            def save_data(self, data, ignore_check_latest=False):
+                test.saved.append(data)
+
+        self.cachepath = tempfile.mkdtemp()
+        self.src = Source('pm25.in:shanghai')
+        self.src._status = DictStatus()
+        self.src._cache = FileCache(self.cachepath)
+        # the pool of the workers, started with forkserver or spawn
+        settings['EXTRACT_WORKERS'] = 1
+        self.pool = pool.get_extract_pool()
+
+    def tearDown(self):
+        pool.shutdown_extract_pool()
+        settings['EXTRACT_WORKERS'] = 0
+        shutil.rmtree(self.cachepath)
+
+    def test_extract_pool_settings(self):
+        """Pool processes aren't forked and get the worker settings"""
+        self.assertEqual(self.pool._mp_context.get_start_method(),
+                         pool.get_start_method())
+        self.assertNotEqual(pool.get_start_method(), 'fork')
+        future = self.src.scrape(executor=self.pool)
+        self.src.finish(future)
+        self.assertEqual(self.saved, [self.src.extract(self.content)])
+
+    def test_extract_in_pool(self):
+        """Extraction is submitted to the pool, data is saved on finish"""
+        future = self.src.scrape(executor=self.pool)
+        self.assertIsNotNone(future)
+        self.assertEqual(self.saved, [])
+        self.src.finish(future)
+        self.assertEqual(self.saved, [self.src.extract(self.content)])
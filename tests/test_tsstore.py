@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytz
+
+from openkongqi.records.base import create_recsdb
+
+from .test_records import DictCache, get_records
+
+try:
+    import numpy as np
+except ImportError:         # pragma: no cover
+    np = None
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestTSStore(unittest.TestCase):
+
+    context = {'moduuid': 'pm25in'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recsdb = create_recsdb({
+            'ENGINE': 'openkongqi.records.tsstore',
+            'PATH': self.tmpdir,
+        }, DictCache({}))
+        self.recsdb.db_init()
+        # records over two months
+        self.start = datetime(2016, 7, 31, 20, tzinfo=pytz.utc)
+        self.uuid = 'cn:shanghai:hongkou'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_records(self, hours=24, **kwargs):
+        return list(self.recsdb.get_records(
+            self.uuid, self.start, self.start + timedelta(hours=hours),
+            context=self.context, **kwargs))
+
+    def test_write_records(self):
+        """Records are written and read back across months"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 10),
+                                  context=self.context)
+        records = self.get_records()
+        self.assertEqual(len(records), 10)
+        self.assertEqual(records[5], {
+            'ts': datetime(2016, 8, 1, 1, tzinfo=pytz.utc),
+            'fields': {'pm25': 5.0, 'pm10': 5.0},
+        })
+        self.assertEqual(
+            self.get_records(hours=2, fields=['pm10']),
+            [{'ts': self.start + timedelta(hours=i), 'fields': {'pm10': i}}
+             for i in range(3)])
+        latest = self.recsdb.get_latest(self.uuid, context=self.context)
+        self.assertEqual(latest['ts'], self.start + timedelta(hours=9))
+
+    def test_write_records_out_of_order(self):
+        """Older records are merged, duplicates skipped"""
+        records = get_records(self.uuid, self.start, 10)
+        self.recsdb.write_records({self.uuid: records[self.uuid][6:]},
+                                  context=self.context)
+        self.recsdb.write_records(records, ignore_check_latest=True,
+                                  context=self.context)
+        records = self.get_records()
+        self.assertEqual([r['fields']['pm25'] for r in records],
+                         [float(i) for i in range(10)])
+
+    def test_get_series(self):
+        """Series are read as slices of the memory-mapped files"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 10),
+                                  context=self.context)
+        series = self.recsdb.get_series(
+            self.uuid, 'pm25', self.start + timedelta(hours=2),
+            self.start + timedelta(hours=6), context=self.context)
+        self.assertEqual([len(arr) for arr in series], [2, 3])
+        self.assertIsInstance(series[0], np.memmap)
+        self.assertEqual(series[1]['value'].tolist(), [4.0, 5.0, 6.0])
+
+    def test_partial_append(self):
+        """A partial record left by an interrupted append is dropped"""
+        from openkongqi.records import tsstore
+        self.recsdb.write_records(get_records(self.uuid, self.start, 3),
+                                  context=self.context)
+        fpath = self.recsdb.get_path(
+            'pm25in:{}'.format(self.uuid), '2016-07', 'pm25.bin')
+        with open(fpath, 'ab') as f:
+            f.write(b'\x00' * 5)
+        self.assertEqual(len(tsstore.load_series(fpath)), 3)
+        records = get_records(self.uuid, self.start, 4)
+        self.recsdb.write_records({self.uuid: records[self.uuid][3:]},
+                                  context=self.context)
+        series = tsstore.load_series(fpath)
+        self.assertEqual(series['value'].tolist(), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(os.path.getsize(fpath), 4 * tsstore.DTYPE.itemsize)
+
+    def test_get_aggregates(self):
+        """Values are aggregated per bucket"""
+        self.recsdb.write_records(get_records(self.uuid, self.start, 10),
+                                  context=self.context)
+        aggregates = list(self.recsdb.get_aggregates(
+            self.uuid, self.start, self.start + timedelta(days=1), 'day',
+            context=self.context))
+        self.assertEqual([a['ts'] for a in aggregates], [
+            datetime(2016, 7, 31, tzinfo=pytz.utc),
+            datetime(2016, 8, 1, tzinfo=pytz.utc),
+        ])
+        self.assertEqual(aggregates[1]['fields']['pm25'], {
+            'count': 6, 'mean': 6.5, 'min': 4.0, 'max': 9.0})
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the parser backends of a source on a saved page.
+
+By default, compares the ``html5lib`` and ``lxml`` backends of the pm25.in
+source on the test fixture::
+
+    $ python -m utils.bench_extract
+    $ python -m utils.bench_extract -n 50 pm25.in:shanghai page.html
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import os
+import timeit
+
+here = os.path.abspath(os.path.dirname(__file__))
+FIXTURE = os.path.join(here, os.pardir, 'tests', 'data', 'pm25.in',
+                       'shanghai.html')
+
+
+class emptyConf(object):
+    settings = {}
+
+
+def create_parser():
+    """Return command-line parser."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=20,
+                        help="number of extractions per backend")
+    parser.add_argument("-p", "--parsers", default="html5lib,lxml",
+                        help="comma separated parser backends")
+    parser.add_argument("source", nargs="?", default="pm25.in:shanghai",
+                        help="name of a valid source")
+    parser.add_argument("fpath", nargs="?", default=FIXTURE,
+                        help="path to a saved page of the source")
+    return parser
+
+
+def main():
+    """Command-line entry."""
+    args = create_parser().parse_args()
+
+    from openkongqi.conf import config_from_object
+    config_from_object(emptyConf())
+    from openkongqi.utils import get_source
+
+    src = get_source(args.source)
+    with open(args.fpath, 'rb') as fd:
+        content = fd.read()
+
+    results = {}
+    outputs = {}
+    for parser in args.parsers.split(','):
+        method = getattr(src, 'extract_{}'.format(parser))
+        outputs[parser] = method(content)
+        results[parser] = min(timeit.repeat(lambda: method(content),
+                                            number=args.number,
+                                            repeat=3)) / args.number
+
+    baseline = max(results.values())
+    print("{:<10} {:>12} {:>8}".format("PARSER", "MS/EXTRACT", "SPEEDUP"))
+    for parser, duration in sorted(results.items(), key=lambda i: -i[1]):
+        print("{:<10} {:>12.3f} {:>7.1f}x".format(
+            parser, duration * 1000, baseline / duration))
+    identical = all(output == outputs[parser]
+                    for output in outputs.values())
+    print("identical output: {}".format(identical))
+
+
+if __name__ == '__main__':
+    main()